@@ -0,0 +1,110 @@
+"""
+Benchmark the try-on alignment search: AngleRatioSolver / find_best_angle_ratio against the former SLSQP search.
+
+Both searches run on synthetic cloth / template mask pairs prepared as in easyphoto_tryon_infer, and are compared by
+time and by the exact IoU and objective of their results.
+
+    python benchmarks/bench_tryon_alignment.py --cases 20
+
+The SLSQP search is loaded from the revision before the commits of user-034, found by the tag of their subjects, or
+from --baseline_rev.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from tryon_benchmark_utils import cloth_mask, load_tryon_utils, request_baseline_rev, timeit  # noqa: E402
+
+
+def make_case(rng):
+    """A reference cloth and the same cloth worn in a template, moved, stretched and rotated."""
+    shape_seed = int(rng.integers(1 << 31))
+    ref_size = (int(rng.integers(500, 900)), int(rng.integers(600, 1000)))
+    mask_ref = cloth_mask(ref_size, (40, 40, ref_size[0] - 40, ref_size[1] - 40), 0.0, np.random.default_rng(shape_seed))
+
+    template_size = (int(rng.integers(400, 800)), int(rng.integers(500, 900)))
+    margin_x, margin_y = rng.integers(20, 120, size=2)
+    template_box = (margin_x, margin_y, template_size[0] - rng.integers(20, 120), template_size[1] - margin_y)
+    mask_template = cloth_mask(template_size, template_box, float(rng.uniform(-8, 8)), np.random.default_rng(shape_seed))
+    return mask_ref, mask_template
+
+
+def prepare(tryon_utils, mask_ref, mask_template):
+    # Step1 and Step3 of easyphoto_tryon_infer: the masks are cropped around their cloth, then the polygons are aligned
+    _, box_ref = tryon_utils.mask_to_box(mask_ref)
+    _, box_template = tryon_utils.mask_to_box(mask_template)
+    mask_ref = tryon_utils.crop_image(mask_ref, box_ref, expand_ratio=1.2)
+    mask_template = tryon_utils.crop_image(mask_template, box_template, expand_ratio=1.2)
+
+    resized_mask_ref = tryon_utils.resize_and_stretch(
+        np.stack([mask_ref] * 3, axis=-1), target_size=(mask_template.shape[1], mask_template.shape[0])
+    )[:, :, 0]
+    polygon1 = tryon_utils.mask_to_polygon(resized_mask_ref)
+    polygon2 = tryon_utils.mask_to_polygon(mask_template)
+    rotation_angle2 = tryon_utils.compute_rotation_angle(polygon2)
+    rotation_angle1 = tryon_utils.compute_rotation_angle(polygon1)
+    rotation_angle2 = 0 if rotation_angle2 > 20 else rotation_angle2
+    rotation_angle1 = 0 if rotation_angle1 > 20 else rotation_angle1
+    x, y = mask_template.shape[1] // 2, mask_template.shape[0] // 2
+    return polygon1, polygon2, x, y, rotation_angle2 - rotation_angle1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=20, help="The number of synthetic mask pairs.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="The best time of repeat runs is reported.")
+    parser.add_argument(
+        "--baseline_rev",
+        type=str,
+        default=None,
+        help="The git revision of tryon_utils with the SLSQP search, by default the one before the commits of user-034.",
+    )
+    args = parser.parse_args()
+
+    tryon_utils = load_tryon_utils()
+    baseline = load_tryon_utils(args.baseline_rev or request_baseline_rev("user-034"))
+    rng = np.random.default_rng(args.seed)
+
+    print(
+        f"{'case':>4} {'slsqp_s':>8} {'solver_s':>8} {'speedup':>7} {'slsqp_iou':>9} {'solver_iou':>10} {'slsqp_obj':>9} {'solver_obj':>10}"
+    )
+    total_baseline, total_solver, results = 0.0, 0.0, []
+    for case in range(args.cases):
+        polygon1, polygon2, x, y, angle_target = prepare(tryon_utils, *make_case(rng))
+        inputs = (polygon1, polygon2, np.array([0.0, 1.0]), x, y, angle_target, 100, 0.7)
+        # Both searches print their progress
+        with contextlib.redirect_stdout(io.StringIO()):
+            baseline_parameters, baseline_time = timeit(baseline.find_best_angle_ratio, *inputs, repeat=args.repeat)
+            solver_parameters, solver_time = timeit(tryon_utils.find_best_angle_ratio, *inputs, repeat=args.repeat)
+
+        # Both results are scored by the same exact evaluation
+        solver = tryon_utils.AngleRatioSolver(polygon1, polygon2, x, y, angle_target)
+        baseline_iou, baseline_in_iou = solver.iou(*baseline_parameters)
+        solver_iou, solver_in_iou = solver.iou(*solver_parameters)
+        baseline_objective = solver.objective(baseline_iou, baseline_in_iou, baseline_parameters[0])
+        solver_objective = solver.objective(solver_iou, solver_in_iou, solver_parameters[0])
+
+        total_baseline += baseline_time
+        total_solver += solver_time
+        results.append((baseline_iou, solver_iou))
+        print(
+            f"{case:>4} {baseline_time:>8.3f} {solver_time:>8.3f} {baseline_time / solver_time:>6.1f}x "
+            f"{baseline_iou:>9.4f} {solver_iou:>10.4f} {baseline_objective:>9.4f} {solver_objective:>10.4f}"
+        )
+
+    results = np.array(results)
+    print(
+        f"Total: SLSQP {total_baseline:.2f}s, solver {total_solver:.2f}s, speedup {total_baseline / total_solver:.1f}x. "
+        f"Mean IoU: SLSQP {results[:, 0].mean():.4f}, solver {results[:, 1].mean():.4f}, "
+        f"solver IoU >= SLSQP IoU - 1e-3 in {int(np.sum(results[:, 1] >= results[:, 0] - 1e-3))}/{len(results)} cases."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Benchmark the try-on mask and overlay kernels on a 4K template.
+
+The kernels (mask_roi and color_histogram of tryon_utils, compose_affine of geometry_utils) are compared with the numpy / cv2
+code they replace, and the functions rebuilt on them (get_background_color, resize_and_stretch,
+align_and_overlay_images, merge_with_inner_canny, copy_white_mask_to_template) with their former version, loaded from a
+git revision. Each line reports both times, the speedup and how close the results are.
+
+    python benchmarks/bench_tryon_kernels.py --repeat 3
+
+The former versions are loaded from the revision before the commits of user-038, found by the tag of their subjects,
+or from --baseline_rev.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import warnings
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from tryon_benchmark_utils import cloth_mask, load_tryon_utils, request_baseline_rev, timeit  # noqa: E402
+
+
+def make_inputs(rng, template_size, ref_size):
+    """A template with a worn cloth and a reference cloth of a dominant color with a printed pattern."""
+    width, height = template_size
+    template = np.uint8(np.clip(np.linspace(0, 255, width)[None, :, None] * 0.6 + rng.integers(0, 100, (height, width, 3)), 0, 255))
+    template_box = (int(width * 0.3), int(height * 0.15), int(width * 0.7), int(height * 0.95))
+    mask_template = cloth_mask(template_size, template_box, 5.0, np.random.default_rng(1))
+
+    mask_ref = cloth_mask(ref_size, (60, 60, ref_size[0] - 60, ref_size[1] - 60), 0.0, np.random.default_rng(1))
+    img_ref = np.full((ref_size[1], ref_size[0], 3), 255, np.uint8)
+    img_ref[mask_ref > 0] = (120, 60, 200)
+    # a print of 16 px blocks of random colors
+    blocks = (ref_size[0] // 16, ref_size[1] // 16)
+    pattern = cv2.resize(np.uint8(rng.random(blocks[::-1]) < 0.3), (blocks[0] * 16, blocks[1] * 16), interpolation=cv2.INTER_NEAREST)
+    colors = cv2.resize(
+        rng.integers(0, 256, (blocks[1], blocks[0], 3), dtype=np.uint8), (blocks[0] * 16, blocks[1] * 16), interpolation=cv2.INTER_NEAREST
+    )
+    img_ref[: blocks[1] * 16, : blocks[0] * 16][(pattern > 0) & (mask_ref[: blocks[1] * 16, : blocks[0] * 16] > 0)] = colors[
+        (pattern > 0) & (mask_ref[: blocks[1] * 16, : blocks[0] * 16] > 0)
+    ]
+    return template, mask_template, img_ref, mask_ref
+
+
+def difference(a, b):
+    """The max absolute difference of two arrays and the share of different pixels, or their shapes when they differ."""
+    a, b = np.asarray(a), np.asarray(b)
+    if a.shape != b.shape:
+        return f"shape {a.shape} vs {b.shape}"
+    if a.size == 0:
+        return "empty"
+    diff = np.abs(a.astype(np.int64) - b.astype(np.int64))
+    if diff.max() == 0:
+        return "identical"
+    if diff.ndim == 3:
+        diff = diff.max(axis=-1)
+    return f"max abs diff {int(diff.max())}, {np.count_nonzero(diff > 8) / diff.size:.2%} pixels differ by > 8"
+
+
+def flat_difference(expected, result):
+    """The max absolute difference of the align_and_overlay_images results farther than 2 pixels from an edge."""
+    kernel = np.ones((3, 3), np.uint8)
+    edges = np.zeros(expected[2].shape, np.uint8)
+    for image in expected[:4]:
+        gradient = cv2.morphologyEx(np.uint8(image), cv2.MORPH_GRADIENT, kernel)
+        edges |= np.uint8((gradient.max(axis=-1) if gradient.ndim == 3 else gradient) > 8)
+    flat = cv2.dilate(edges, np.ones((5, 5), np.uint8)) == 0
+    diffs = [np.abs(np.int64(a) - np.int64(b)) for a, b in zip(expected[:3], result[:3])]
+    return max(int((diff.max(axis=-1) if diff.ndim == 3 else diff)[flat].max()) for diff in diffs)
+
+
+def report(name, baseline_time, time, note):
+    print(f"{name:<50} {baseline_time * 1000:>10.1f} {time * 1000:>9.1f} {baseline_time / max(time, 1e-9):>7.1f}x  {note}")
+
+
+def naive_roi(mask):
+    ys, xs = np.nonzero(mask)
+    return (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
+
+
+def naive_histogram(img, mask, top_k=20):
+    colors, counts = np.unique(img[mask > 0], axis=0, return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:top_k]
+    return colors[order], counts[order]
+
+
+def sequential_warp(img, size, angle, ratio, canvas):
+    """Resize to size, paste to the center of canvas, then rotate and scale around the center of canvas."""
+    resized = cv2.resize(img, size, interpolation=cv2.INTER_LINEAR)
+    pasted = np.zeros((canvas[1], canvas[0], 3), np.uint8)
+    x, y = (canvas[0] - size[0]) // 2, (canvas[1] - size[1]) // 2
+    pasted[y : y + size[1], x : x + size[0]] = resized
+    rotation = cv2.getRotationMatrix2D((canvas[0] / 2, canvas[1] / 2), angle, ratio)
+    return cv2.warpAffine(pasted, rotation, canvas, flags=cv2.INTER_LINEAR)
+
+
+def composed_warp(tryon_utils, img, size, angle, ratio, canvas):
+    """The same transforms composed into one warpAffine, the image is sampled once."""
+    sx, sy = size[0] / img.shape[1], size[1] / img.shape[0]
+    stretch = [[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5]]
+    paste = [[1, 0, (canvas[0] - size[0]) // 2], [0, 1, (canvas[1] - size[1]) // 2]]
+    rotation = cv2.getRotationMatrix2D((canvas[0] / 2, canvas[1] / 2), angle, ratio)
+    matrix = tryon_utils.compose_affine(stretch, paste, rotation)[:2]
+    return cv2.warpAffine(img, matrix, canvas, flags=cv2.INTER_LINEAR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--template_size", type=int, nargs=2, default=[3840, 2160], help="The width and height of the template.")
+    parser.add_argument("--ref_size", type=int, nargs=2, default=[1400, 1800], help="The width and height of the reference.")
+    parser.add_argument("--repeat", type=int, default=3, help="The best time of repeat runs is reported.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--baseline_rev",
+        type=str,
+        default=None,
+        help="The git revision of tryon_utils before the kernels, by default the one before the commits of user-038.",
+    )
+    args = parser.parse_args()
+
+    tryon_utils = load_tryon_utils()
+    baseline = load_tryon_utils(args.baseline_rev or request_baseline_rev("user-038"))
+    rng = np.random.default_rng(args.seed)
+    template, mask_template, img_ref, mask_ref = make_inputs(rng, tuple(args.template_size), tuple(args.ref_size))
+    repeat = args.repeat
+
+    print(f"Template {args.template_size[0]}x{args.template_size[1]}, reference {args.ref_size[0]}x{args.ref_size[1]}.")
+    print(f"{'':<50} {'before_ms':>10} {'after_ms':>9} {'speedup':>8}")
+
+    # kernels against the code they replace
+    expected, baseline_time = timeit(naive_roi, mask_template, repeat=repeat)
+    result, kernel_time = timeit(tryon_utils.mask_roi, mask_template, repeat=repeat)
+    report("mask_roi (4K mask)", baseline_time, kernel_time, "same box" if tuple(result) == tuple(expected) else f"{result} vs {expected}")
+
+    for name, img, mask in [("reference cloth", img_ref, mask_ref), ("4K region", template, np.full(template.shape[:2], 255, np.uint8))]:
+        expected, baseline_time = timeit(naive_histogram, img, mask, repeat=repeat)
+        result, kernel_time = timeit(tryon_utils.color_histogram, img, mask, repeat=repeat)
+        same = np.array_equal(expected[1], result[1]) and np.array_equal(expected[0][0], result[0][0])
+        report(f"color_histogram ({name})", baseline_time, kernel_time, "same counts and top color" if same else "different histogram")
+
+    size = tryon_utils.mask_roi(mask_template)
+    size = (size[2] - size[0], size[3] - size[1])
+    expected, baseline_time = timeit(sequential_warp, img_ref, size, 5.0, 1.1, tuple(args.template_size), repeat=repeat)
+    result, kernel_time = timeit(composed_warp, tryon_utils, img_ref, size, 5.0, 1.1, tuple(args.template_size), repeat=repeat)
+    report("compose_affine, 1 warp vs resize + paste + rotate", baseline_time, kernel_time, difference(expected, result))
+
+    # rebuilt functions against their former version, the former distance to white overflows in uint8
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected, baseline_time = timeit(baseline.get_background_color, img_ref, mask_ref, repeat=repeat)
+        result, kernel_time = timeit(tryon_utils.get_background_color, img_ref, mask_ref, repeat=repeat)
+    report("get_background_color", baseline_time, kernel_time, f"{tuple(int(c) for c in expected)} vs {tuple(int(c) for c in result)}")
+
+    target_size = (mask_template.shape[1], mask_template.shape[0])
+    expected, baseline_time = timeit(baseline.resize_and_stretch, img_ref, target_size, repeat=repeat)
+    result, kernel_time = timeit(tryon_utils.resize_and_stretch, img_ref, target_size, repeat=repeat)
+    report("resize_and_stretch (to 4K)", baseline_time, kernel_time, difference(expected, result))
+
+    # Step1 and Step3 of easyphoto_tryon_infer on the 4K template
+    _, box_ref = tryon_utils.mask_to_box(mask_ref)
+    _, box_template = tryon_utils.mask_to_box(mask_template)
+    crop_ref = tryon_utils.crop_image(img_ref, box_ref, expand_ratio=1.2)
+    crop_mask_ref = np.stack([tryon_utils.crop_image(mask_ref, box_ref, expand_ratio=1.2)] * 3, axis=-1)
+    crop_template = tryon_utils.crop_image(template, box_template, expand_ratio=1.2)
+    crop_mask_template = tryon_utils.crop_image(mask_template, box_template, expand_ratio=1.2)
+    for angle, ratio, dx, dy in [(0.0, 1.0, 0.0, 0.0), (-5.0, 1.1, 30.0, -20.0)]:
+        inputs = (crop_ref, crop_template, crop_mask_ref, crop_mask_template)
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected, baseline_time = timeit(baseline.align_and_overlay_images, *inputs, angle, ratio, dx, dy, repeat=repeat)
+            result, kernel_time = timeit(tryon_utils.align_and_overlay_images, *inputs, angle, ratio, dx, dy, repeat=repeat)
+        report(
+            f"align_and_overlay_images ({angle}, {ratio}, {dx}, {dy})",
+            baseline_time,
+            kernel_time,
+            f"IoU {expected[-1]:.4f} vs {result[-1]:.4f}, overlay {difference(expected[0], result[0])}, "
+            f"{flat_difference(expected, result)} away from edges",
+        )
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        overlay, _, mask1, mask2, _ = tryon_utils.align_and_overlay_images(crop_ref, crop_template, crop_mask_ref, crop_mask_template)
+    expected, baseline_time = timeit(baseline.merge_with_inner_canny, overlay, mask1, mask2, repeat=repeat)
+    result, kernel_time = timeit(tryon_utils.merge_with_inner_canny, overlay, mask1, mask2, repeat=repeat)
+    report("merge_with_inner_canny", baseline_time, kernel_time, ", ".join(difference(a, b) for a, b in zip(expected, result)))
+
+    box = tryon_utils.expand_roi(box_template, ratio=1.2, max_box=[0, 0, template.shape[1], template.shape[0]])
+    generation = cv2.resize(crop_template[:, :, ::-1], (box[2] - box[0], box[3] - box[1]))
+    mask = cv2.resize(crop_mask_template, (box[2] - box[0], box[3] - box[1]), interpolation=cv2.INTER_NEAREST)
+    expected, baseline_time = timeit(lambda: baseline.copy_white_mask_to_template(generation, mask, template.copy(), box), repeat=repeat)
+    result, kernel_time = timeit(lambda: tryon_utils.copy_white_mask_to_template(generation, mask, template.copy(), box), repeat=repeat)
+    report("copy_white_mask_to_template (4K)", baseline_time, kernel_time, difference(expected, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Shared helpers of the try-on benchmarks: load tryon_utils without the webui, from the working tree or from a git
+revision as the baseline, and draw synthetic cloth masks.
+"""
+import importlib
+import os
+import re
+import subprocess
+import sys
+import time
+import types
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+EASYPHOTO_UTILS_DIR = "scripts/easyphoto_utils"
+
+
+def load_tryon_utils(rev=None):
+    """
+    Load tryon_utils.py of the working tree, or of the git revision rev, as a standalone module. The modules of
+    easyphoto_utils it imports relatively are loaded from the same tree, without the package __init__ and the webui.
+    """
+    package = types.ModuleType(f"tryon_benchmark_{'worktree' if rev is None else re.sub(r'[^0-9A-Za-z]', '_', rev)}")
+    package.__path__ = [os.path.join(REPO_ROOT, EASYPHOTO_UTILS_DIR)] if rev is None else []
+    sys.modules[package.__name__] = package
+    if rev is None:
+        return importlib.import_module(f"{package.__name__}.tryon_utils")
+    return _load_rev_module(package.__name__, "tryon_utils", rev)
+
+
+def _load_rev_module(package, name, rev):
+    if f"{package}.{name}" in sys.modules:
+        return sys.modules[f"{package}.{name}"]
+    path = f"{EASYPHOTO_UTILS_DIR}/{name}.py"
+    source = subprocess.check_output(["git", "show", f"{rev}:{path}"], cwd=REPO_ROOT).decode("utf-8")
+    for sibling in re.findall(r"^from \.(\w+) import", source, flags=re.MULTILINE):
+        _load_rev_module(package, sibling, rev)
+    module = types.ModuleType(f"{package}.{name}")
+    module.__file__ = f"{rev}:{path}"
+    module.__package__ = package
+    sys.modules[module.__name__] = module
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def request_baseline_rev(request_id):
+    """
+    The git revision before a request: the parent of the first commit whose subject starts with [request_id]. It does
+    not depend on the hashes, which change with a rebase or a squash.
+    """
+    log = subprocess.check_output(["git", "log", "--reverse", "--format=%H %s"], cwd=REPO_ROOT).decode("utf-8")
+    for line in log.splitlines():
+        commit, _, subject = line.partition(" ")
+        if subject.startswith(f"[{request_id}]"):
+            return f"{commit}^"
+    raise RuntimeError(f"No commit of {request_id} in the git history, pass the baseline revision explicitly.")
+
+
+def cloth_polygon(width, height, rng):
+    """The outline of a T-shirt in a width x height box, with random sleeves and hem."""
+    sleeve = rng.uniform(0.15, 0.25)
+    neck = rng.uniform(0.15, 0.25)
+    hem = rng.uniform(-0.05, 0.05)
+    points = [
+        (0.5 - neck / 2, 0.0),
+        (0.5 + neck / 2, 0.0),
+        (1.0 - sleeve, 0.05),
+        (1.0, 0.3),
+        (1.0 - sleeve / 2, 0.4),
+        (1.0 - sleeve, 0.35),
+        (1.0 - sleeve + hem, 1.0),
+        (sleeve - hem, 1.0),
+        (sleeve, 0.35),
+        (sleeve / 2, 0.4),
+        (0.0, 0.3),
+        (sleeve, 0.05),
+    ]
+    return np.array([(x * width, y * height) for x, y in points], np.float64)
+
+
+def cloth_mask(size, box, angle, rng):
+    """
+    A uint8 mask of size (width, height) with a cloth in box (left, upper, right, lower), rotated by angle degrees. The
+    shape of the cloth is drawn from rng, the same seed gives the same cloth.
+    """
+    mask = np.zeros((size[1], size[0]), np.uint8)
+    polygon = cloth_polygon(box[2] - box[0], box[3] - box[1], rng) + [box[0], box[1]]
+    center = ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)
+    rotation = cv2.getRotationMatrix2D(center, angle, 1.0)
+    polygon = polygon @ rotation[:, :2].T + rotation[:, 2]
+    cv2.fillPoly(mask, [np.round(polygon).astype(np.int32)], 255)
+    return mask
+
+
+def timeit(func, *args, repeat=1, **kwargs):
+    """The result of func and its best time over repeat runs, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
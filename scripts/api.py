@@ -9,8 +9,9 @@ import torch
 from fastapi import FastAPI
 from modules.api import api
 from scripts.easyphoto_infer import easyphoto_infer_forward, easyphoto_video_infer_forward
-from scripts.easyphoto_train import easyphoto_train_forward
+from scripts.easyphoto_train import easyphoto_train_forward, get_train_progress_path
 from scripts.easyphoto_utils import decode_base64_to_video, ep_logger, encode_video_to_base64
+from scripts.train_kohya.utils.progress_events import read_progress_events
 
 
 def easyphoto_train_forward_api(_: gr.Blocks, app: FastAPI):
@@ -89,6 +90,28 @@ def easyphoto_train_forward_api(_: gr.Blocks, app: FastAPI):
         return {"message": message}
 
 
+def easyphoto_train_progress_api(_: gr.Blocks, app: FastAPI):
+    @app.post("/easyphoto/easyphoto_train_progress")
+    def _easyphoto_train_progress_api(
+        datas: dict,
+    ):
+        # Poll with the returned offset to only get the events written since the previous call.
+        user_id = datas.get("user_id", "tmp")
+        offset = int(datas.get("offset", 0))
+
+        if user_id in ("", ".", "..") or user_id != os.path.basename(user_id):
+            return {"message": "Invalid user id.", "events": [], "offset": 0}
+        try:
+            events, offset = read_progress_events(get_train_progress_path(user_id), offset)
+            message = "success"
+        except Exception as e:
+            events = []
+            message = f"Read train progress error, error info:{str(e)}"
+            ep_logger.error(message)
+
+        return {"message": message, "events": events, "offset": offset}
+
+
 def easyphoto_infer_forward_api(_: gr.Blocks, app: FastAPI):
     @app.post("/easyphoto/easyphoto_infer_forward")
     def _easyphoto_infer_forward_api(
@@ -484,6 +507,7 @@ try:
     import modules.script_callbacks as script_callbacks
 
     script_callbacks.on_app_started(easyphoto_train_forward_api)
+    script_callbacks.on_app_started(easyphoto_train_progress_api)
     script_callbacks.on_app_started(easyphoto_infer_forward_api)
     script_callbacks.on_app_started(easyphoto_video_infer_forward_api)
 except Exception as e:
@@ -15,10 +15,13 @@ user_id_outpath_samples = os.path.join(data_dir, "outputs/easyphoto-user-id-info
 cloth_id_outpath_samples = os.path.join(data_dir, "outputs/easyphoto-cloth-id-infos")
 scene_id_outpath_samples = os.path.join(data_dir, "outputs/easyphoto-scene-id-infos")
 cache_log_file_path = os.path.join(data_dir, "outputs/easyphoto-tmp/train_kohya_log.txt")
+frame_store_path = os.path.join(data_dir, "outputs/easyphoto-tmp/frame_store")
+sam_embedding_cache_path = os.path.join(data_dir, "outputs/easyphoto-tmp/sam_embeddings")
 
 # gallery_dir
 tryon_preview_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)).replace("scripts", "images"), "tryon")
 tryon_gallery_dir = os.path.join(cloth_id_outpath_samples, "gallery")
+cloth_lora_registry_path = os.path.join(cloth_id_outpath_samples, "cloth_lora_registry.json")
 
 # prompts
 validation_prompt = "easyphoto_face, easyphoto, 1person"
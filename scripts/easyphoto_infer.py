@@ -28,11 +28,13 @@ from scripts.easyphoto_config import (
     easyphoto_outpath_samples,
     easyphoto_txt2img_samples,
     easyphoto_video_outpath_samples,
+    frame_store_path,
     models_path,
     user_id_outpath_samples,
     validation_prompt,
 )
 from scripts.easyphoto_utils import (
+    AnimateDiffDecoder,
     Face_Skin,
     FIRE_forward,
     PSGAN_Inference,
@@ -43,11 +45,11 @@ from scripts.easyphoto_utils import (
     check_id_valid,
     check_scene_valid,
     color_transfer,
-    convert_to_video,
     crop_and_paste,
     ep_logger,
     get_controlnet_version,
     get_mov_all_images,
+    get_mov_chunks,
     modelscope_models_to_cpu,
     modelscope_models_to_gpu,
     switch_ms_model_cpu,
@@ -55,6 +57,17 @@ from scripts.easyphoto_utils import (
     unload_models,
     seed_everything,
     auto_to_gpu_model,
+    read_video_frames,
+    FramePool,
+    FrameStore,
+    MultiFormatVideoWriter,
+    VideoChunkBlender,
+    color_shift_frame,
+    face_fusion_frame,
+    get_video_encoder,
+    get_video_prefix,
+    paste_back_frame,
+    VideoStreamWriter,
 )
 from scripts.sdwebui import (
     get_checkpoint_type,
@@ -373,6 +386,7 @@ def inpaint(
     animatediff_reserve_scale=1,
     animatediff_last_image=None,
     loractl_flag=False,
+    batch_size=1,
 ):
     assert input_image is not None, f"input_image must not be none"
     controlnet_units_list = []
@@ -410,6 +424,8 @@ def inpaint(
         animatediff_reserve_scale=animatediff_reserve_scale,
         animatediff_last_image=animatediff_last_image,
         loractl_flag=loractl_flag,
+        batch_size=batch_size,
+        do_not_save_grid=batch_size > 1,
     )
 
     return image
@@ -2225,6 +2241,17 @@ def easyphoto_video_infer_forward(
     if lcm_accelerate:
         lcm_lora_name_and_weight = "lcm_lora_sd15:0.60"
 
+    # chunked mode is only available in v2v, the template video is processed in overlapping chunks
+    video_chunk_frames = int(shared.opts.data.get("easyphoto_video_chunk_frames", 0)) if tabs == 2 else 0
+    video_chunk_overlap = int(shared.opts.data.get("easyphoto_video_chunk_overlap", 4))
+    if video_chunk_frames > 0 and video_chunk_overlap >= video_chunk_frames:
+        ep_logger.warning(
+            f"The chunk overlap ({video_chunk_overlap}) must be smaller than the chunk size ({video_chunk_frames}), "
+            f"use {video_chunk_frames - 1} instead."
+        )
+        video_chunk_overlap = video_chunk_frames - 1
+    # the frames are not kept in chunked mode, at most this number of frames of the written video is returned as a preview
+    video_chunk_preview_frames = 16
     try:
         # choose tabs select
         #
@@ -2251,8 +2278,12 @@ def easyphoto_video_infer_forward(
             max_frames = int(max_frames)
             max_fps = int(max_fps)
 
-            template_images, actual_fps = get_mov_all_images(init_video, max_fps)
-            template_images = [template_images[:max_frames]] if max_frames != -1 else [template_images]
+            if video_chunk_frames > 0:
+                # Long videos are split into overlapping chunks, which are read, diffused and encoded one by one.
+                template_images, actual_fps = get_mov_chunks(init_video, max_fps, video_chunk_frames, video_chunk_overlap, max_frames)
+            else:
+                template_images, actual_fps = get_mov_all_images(init_video, max_fps)
+                template_images = [template_images[:max_frames]] if max_frames != -1 else [template_images]
     except Exception:
         torch.cuda.empty_cache()
         traceback.print_exc()
@@ -2526,6 +2557,46 @@ def easyphoto_video_infer_forward(
                 ipa_retinaface_keypoints.append(_ipa_retinaface_keypoints[0])
                 ipa_retinaface_masks.append(_ipa_retinaface_masks[0])
 
+    if video_chunk_frames > 0:
+        # In chunked mode, the finished frames are cross-faded and written to the encoder chunk by chunk,
+        # only the box of faces is kept for crop_at_last, so the memory does not grow with the video length.
+        video_chunk_blender = VideoChunkBlender(video_chunk_overlap)
+        video_chunk_writer = None
+        video_chunk_face_box = None
+        if video_interpolation:
+            ep_logger.warning("Video interpolation is not supported in chunked video mode, skip it.")
+
+        def write_video_chunk_frames(frames):
+            nonlocal video_chunk_writer, video_chunk_face_box
+            if video_chunk_writer is None:
+                video_chunk_writer = VideoStreamWriter(os.path.join(easyphoto_video_outpath_samples, "origin"), actual_fps, mode=save_as)
+            for frame in frames:
+                video_chunk_writer.write(frame)
+                if crop_at_last:
+                    _last_retinaface_boxes, _, _ = call_face_crop(retinaface_detection, frame, crop_at_last_ratio, "last_image")
+                    if len(_last_retinaface_boxes) == 0:
+                        continue
+                    box = _last_retinaface_boxes[0]
+                    if video_chunk_face_box is None:
+                        video_chunk_face_box = list(box)
+                    else:
+                        video_chunk_face_box = [
+                            min(video_chunk_face_box[0], box[0]),
+                            min(video_chunk_face_box[1], box[1]),
+                            max(video_chunk_face_box[2], box[2]),
+                            max(video_chunk_face_box[3], box[3]),
+                        ]
+
+    # The frames of each template are kept in the frame store instead of lists of PIL images,
+    # and all of them are released at the end of the request.
+    # The post-processing workers attach the frames by name, so they need the shm or memmap backend.
+    frame_store_backend = shared.opts.data.get("easyphoto_video_frame_store", "memory")
+    postprocess_workers = int(shared.opts.data.get("easyphoto_video_postprocess_workers", 0))
+    if postprocess_workers > 0 and frame_store_backend == "memory":
+        frame_store_backend = "shm"
+    frame_store = FrameStore(frame_store_backend, frame_store_path)
+    postprocess_pool = FramePool(postprocess_workers)
+
     outputs = []
     loop_message = ""
     for template_idx, template_image in enumerate(template_images):
@@ -2552,8 +2623,15 @@ def easyphoto_video_infer_forward(
             # open the template image
             if not isinstance(template_image, list):
                 template_image = [template_image]
-            template_image = [Image.fromarray(np.uint8(_)).convert("RGB") for _ in template_image]
-            loop_template_image = copy.deepcopy(template_image)
+            first_template_frame = np.array(Image.fromarray(np.uint8(template_image[0])).convert("RGB"))
+            frame_store.create("template", (len(template_image),) + first_template_frame.shape)
+            for idx, _template_image in enumerate(template_image):
+                frame_store.write("template", idx, Image.fromarray(np.uint8(_template_image)).convert("RGB"))
+            # The decoded frames are no longer needed once they are in the frame store.
+            if isinstance(template_images, list):
+                template_images[template_idx] = None
+            template_image = None
+            loop_template_image = frame_store.images("template")
 
             # crop images from templates and get the box of each photos
             input_image, loop_template_crop_safe_box = call_face_crop_templates(
@@ -2609,7 +2687,8 @@ def easyphoto_video_infer_forward(
                 input_image, input_image_retinaface_boxes, input_image_retinaface_keypoints, input_masks
             ):
                 # backup input template and mask
-                original_input_template = copy.deepcopy(_input_image)
+                # _input_image is only rebound rather than modified below, so a reference is enough.
+                original_input_template = _input_image
                 if _input_image_retinaface_box is None:
                     replaced_input_image.append(_input_image)
                     new_input_image.append(_input_image)
@@ -2828,209 +2907,201 @@ def easyphoto_video_infer_forward(
             else:
                 sum_input_mask = Image.fromarray(np.uint8(np.max(np.array(sum_input_mask), axis=0)))
 
-            first_diffusion_output_image = inpaint(
-                input_image,
-                sum_input_mask,
-                controlnet_pairs,
-                diffusion_steps=first_diffusion_steps,
-                cfg_scale=7 if not lcm_accelerate else 2,
-                denoising_strength=first_denoising_strength,
-                input_prompt=input_prompts[0],
-                hr_scale=1.0,
-                seed=seed,
-                sd_model_checkpoint=sd_model_checkpoint,
-                default_positive_prompt=DEFAULT_POSITIVE_AD,
-                default_negative_prompt=additional_neg_prompt + ", " + DEFAULT_NEGATIVE_AD,
-                sampler="DPM++ 2M SDE Karras" if not lcm_accelerate else "Euler a",
-                animatediff_flag=True,
-                animatediff_fps=int(actual_fps),
-            )
-
-            _outputs = []
-            frame_idx = 0
-            for idx, [
-                _first_diffusion_output_image,
-                _loop_template_image,
-                _loop_template_crop_safe_box,
-                _input_image_retinaface_box,
-                _template_image_original_face_area,
-            ] in enumerate(
-                zip(
-                    first_diffusion_output_image,
-                    loop_template_image,
-                    loop_template_crop_safe_box,
-                    input_image_retinaface_boxes,
-                    template_image_original_face_area,
-                )
-            ):
-                if _input_image_retinaface_box is not None:
-                    # TODO : this color shift is too hardcode and naive for video
-                    if color_shift_middle:
-                        try:
-                            # apply color shift
-                            ep_logger.info(f"Start {idx} color shift middle.")
-                            _first_diffusion_output_image_uint8 = np.uint8(np.array(_first_diffusion_output_image))
-                            # crop image first
-                            _first_diffusion_output_image_crop = Image.fromarray(
-                                _first_diffusion_output_image_uint8[
-                                    _input_image_retinaface_box[1] : _input_image_retinaface_box[3],
-                                    _input_image_retinaface_box[0] : _input_image_retinaface_box[2],
-                                    :,
-                                ]
-                            )
+            # The frames are written to the frame store chunk by chunk while the VAE decodes the rest of the video.
+            streamed_frame_indexes = set()
 
-                            # apply color shift
-                            _first_diffusion_output_image_crop_color_shift = np.array(copy.deepcopy(_first_diffusion_output_image_crop))
-                            _first_diffusion_output_image_crop_color_shift = color_transfer(
-                                _first_diffusion_output_image_crop_color_shift, _template_image_original_face_area
-                            )
-
-                            # detect face area
-                            face_skin_mask = np.float32(
-                                face_skin(
-                                    _first_diffusion_output_image_crop, retinaface_detection, needs_index=[[1, 2, 3, 4, 5, 10, 11, 12, 13]]
-                                )[0]
-                            )
-                            face_skin_mask = cv2.blur(face_skin_mask, (32, 32)) / 255
+            def stream_decoded_frames(start, images):
+                for offset, image in enumerate(images):
+                    if start + offset >= len(input_image):
+                        break
+                    if len(streamed_frame_indexes) == 0:
+                        frame_store.create("frames", (len(input_image),) + np.shape(image))
+                    frame_store.write("frames", start + offset, image)
+                    streamed_frame_indexes.add(start + offset)
 
-                            # paste back to photo
-                            _first_diffusion_output_image_uint8[
+            if AnimateDiffDecoder is not None:
+                AnimateDiffDecoder.consumer = stream_decoded_frames
+            try:
+                first_diffusion_output_image = inpaint(
+                    input_image,
+                    sum_input_mask,
+                    controlnet_pairs,
+                    diffusion_steps=first_diffusion_steps,
+                    cfg_scale=7 if not lcm_accelerate else 2,
+                    denoising_strength=first_denoising_strength,
+                    input_prompt=input_prompts[0],
+                    hr_scale=1.0,
+                    seed=seed,
+                    sd_model_checkpoint=sd_model_checkpoint,
+                    default_positive_prompt=DEFAULT_POSITIVE_AD,
+                    default_negative_prompt=additional_neg_prompt + ", " + DEFAULT_NEGATIVE_AD,
+                    sampler="DPM++ 2M SDE Karras" if not lcm_accelerate else "Euler a",
+                    animatediff_flag=True,
+                    animatediff_fps=int(actual_fps),
+                )
+            finally:
+                if AnimateDiffDecoder is not None:
+                    AnimateDiffDecoder.consumer = None
+
+            # The post-processing runs stage by stage over all frames. The model calls of a stage run frame by frame in this
+            # process, then the numpy / cv2 work of the stage is handed to the post-processing workers, which modify the
+            # frames of the frame store in place.
+            num_frames = len(first_diffusion_output_image)
+            if len(streamed_frame_indexes) != num_frames:
+                # nothing or not every frame is streamed, e.g. the webui decode is used
+                frame_store.put("frames", first_diffusion_output_image)
+            first_diffusion_output_image = None
+            face_frame_indexes = [idx for idx in range(num_frames) if input_image_retinaface_boxes[idx] is not None]
+
+            # TODO : this color shift is too hardcode and naive for video
+            if color_shift_middle:
+                color_shift_tasks = []
+                for idx in face_frame_indexes:
+                    try:
+                        ep_logger.info(f"Start {idx} color shift middle.")
+                        _input_image_retinaface_box = input_image_retinaface_boxes[idx]
+                        # crop image first
+                        _first_diffusion_output_image_crop = Image.fromarray(
+                            frame_store["frames"][
+                                idx,
                                 _input_image_retinaface_box[1] : _input_image_retinaface_box[3],
                                 _input_image_retinaface_box[0] : _input_image_retinaface_box[2],
                                 :,
-                            ] = _first_diffusion_output_image_crop_color_shift * face_skin_mask + np.array(
-                                _first_diffusion_output_image_crop
-                            ) * (
-                                1 - face_skin_mask
-                            )
-                            _first_diffusion_output_image = Image.fromarray(np.uint8(_first_diffusion_output_image_uint8))
-                        except Exception as e:
-                            torch.cuda.empty_cache()
-                            traceback.print_exc()
-                            ep_logger.error(f"Color Shift Middle {idx} error. Continue. Error Info: {e}")
-
-                    if roop_images[0] is not None and apply_face_fusion_after:
-                        try:
-                            # Fusion of facial photos with user photos
-                            ep_logger.info(f"Start {idx} second face fusion.")
-                            _fusion_image = image_face_fusion(dict(template=_first_diffusion_output_image, user=roop_images[0]))[
-                                OutputKeys.OUTPUT_IMG
-                            ]  # swap_face(target_img=output_image, source_img=roop_image, model="inswapper_128.onnx", upscale_options=UpscaleOptions())
-                            _fusion_image = Image.fromarray(cv2.cvtColor(_fusion_image, cv2.COLOR_BGR2RGB))
-
-                            # The edge shadows generated by fusion are filtered out by taking intersections of masks of faces before and after fusion.
-                            # detect face area
-                            # fusion_image_mask and input_image_mask are 0, 1 masks of shape [h, w, 3]
-                            _fusion_image_mask, _fusion_image_eyes_mask, _fusion_image_lips_mask = face_skin(
-                                _fusion_image, retinaface_detection, needs_index=[[1, 2, 3, 4, 5, 11, 12, 13], [4, 5], [12, 13]]
-                            )
-                            _input_image_mask, _input_image_eyes_mask, _input_image_lips_mask = face_skin(
-                                _first_diffusion_output_image,
-                                retinaface_detection,
-                                needs_index=[[1, 2, 3, 4, 5, 11, 12, 13], [4, 5], [12, 13]],
-                            )
+                            ]
+                        )
 
-                            # The face blending here utilized some rather hard techniques. The face is currently divided into three parts:
-                            # 1. The eyes are taken from the results of face fusion,
-                            # 2. The skin is derived from the proportional blending of both sources
-                            # 3. The lips are taken from the diffusion.
-                            _fusion_image_mask, _input_image_mask = np.int32(np.float32(_fusion_image_mask) > 128), np.int32(
-                                np.float32(_input_image_mask) > 128
-                            )
-                            _combine_mask = np.uint8(_input_image_mask * _fusion_image_mask * 255)
-                            _combine_mask = (
-                                cv2.erode(
-                                    cv2.dilate(_combine_mask, np.ones((8, 8), np.uint8), iterations=1),
-                                    np.ones((16, 16), np.uint8),
-                                    iterations=1,
-                                )
-                                * after_face_fusion_ratio
-                            )
-                            _combine_mask[
-                                cv2.dilate(np.float32(_fusion_image_eyes_mask), np.ones((16, 16), np.uint8), iterations=1) > 128
-                            ] = 255
-                            _combine_mask[np.float32(_input_image_lips_mask) > 128] = 0
-                            _combine_mask = cv2.blur(np.array(_combine_mask), (8, 8)) / 255
-
-                            cv2.imwrite("1.jpg", cv2.cvtColor(np.uint8(np.array(_fusion_image) * _combine_mask), cv2.COLOR_BGR2RGB))
-                            cv2.imwrite("2.jpg", cv2.cvtColor(np.uint8(np.array(_fusion_image)), cv2.COLOR_BGR2RGB))
-                            cv2.imwrite("3.jpg", cv2.cvtColor(np.uint8(np.array(_first_diffusion_output_image)), cv2.COLOR_BGR2RGB))
-                            # paste back to photo
-                            _fusion_image = np.array(_fusion_image) * _combine_mask + np.array(_first_diffusion_output_image) * (
-                                1 - _combine_mask
-                            )
-                            _fusion_image = Image.fromarray(np.uint8(_fusion_image))
-                            _input_image = _fusion_image
-                        except Exception as e:
-                            _fusion_image = _first_diffusion_output_image
-                            _input_image = _first_diffusion_output_image
-                            torch.cuda.empty_cache()
-                            traceback.print_exc()
-                            ep_logger.error(f"Apply Face Fusion After {idx} error. Continue. Error Info: {e}")
-                    else:
-                        _fusion_image = _first_diffusion_output_image
-                        _input_image = _first_diffusion_output_image
-
-                    # use original template face area to transfer makeup
-                    if makeup_transfer:
-                        try:
-                            _input_image_uint8 = np.uint8(np.array(_input_image))
-                            _input_image_crop = Image.fromarray(
-                                _input_image_uint8[
-                                    _input_image_retinaface_box[1] : _input_image_retinaface_box[3],
-                                    _input_image_retinaface_box[0] : _input_image_retinaface_box[2],
-                                    :,
-                                ]
-                            )
-                            _template_image_original_face_area = Image.fromarray(np.uint8(_template_image_original_face_area))
+                        # detect face area
+                        face_skin_mask = np.array(
+                            face_skin(
+                                _first_diffusion_output_image_crop, retinaface_detection, needs_index=[[1, 2, 3, 4, 5, 10, 11, 12, 13]]
+                            )[0]
+                        )
+                        color_shift_tasks.append((idx, _input_image_retinaface_box, template_image_original_face_area[idx], face_skin_mask))
+                    except Exception as e:
+                        torch.cuda.empty_cache()
+                        traceback.print_exc()
+                        ep_logger.error(f"Color Shift Middle {idx} error. Continue. Error Info: {e}")
 
-                            # makeup transfer
-                            _input_image_crop_makeup_transfer = _input_image_crop.resize([256, 256])
-                            _template_image_original_face_area = Image.fromarray(np.uint8(_template_image_original_face_area)).resize(
-                                [256, 256]
-                            )
-                            _input_image_crop_makeup_transfer = psgan_inference(
-                                _input_image_crop_makeup_transfer, _template_image_original_face_area
-                            )
-                            _input_image_crop_makeup_transfer = _input_image_crop_makeup_transfer.resize(
-                                [np.shape(_input_image_crop)[1], np.shape(_input_image_crop)[0]]
-                            )
+                # apply color shift and paste back to photo
+                errors = postprocess_pool.map(color_shift_frame, frame_store, ["frames"], color_shift_tasks)
+                for task, error in zip(color_shift_tasks, errors):
+                    if error is not None:
+                        ep_logger.error(f"Color Shift Middle {task[0]} error. Continue. Error Info: {error}")
 
-                            # detect face area
-                            face_skin_mask = np.float32(
-                                face_skin(_input_image_crop, retinaface_detection, needs_index=[[1, 2, 3, 4, 5, 10, 11, 12, 13]])[0]
-                            )
-                            face_skin_mask = cv2.blur(face_skin_mask, (32, 32)) / 255 * makeup_transfer_ratio
+            if roop_images[0] is not None and apply_face_fusion_after:
+                fusion_names = ["fusion", "fusion_mask", "fusion_eyes_mask", "input_mask", "input_lips_mask"]
+                for name in fusion_names:
+                    frame_store.create(name, frame_store["frames"].shape)
+
+                fusion_tasks = []
+                for idx in face_frame_indexes:
+                    try:
+                        # Fusion of facial photos with user photos
+                        ep_logger.info(f"Start {idx} second face fusion.")
+                        _first_diffusion_output_image = frame_store.images("frames")[idx]
+                        _fusion_image = image_face_fusion(dict(template=_first_diffusion_output_image, user=roop_images[0]))[
+                            OutputKeys.OUTPUT_IMG
+                        ]  # swap_face(target_img=output_image, source_img=roop_image, model="inswapper_128.onnx", upscale_options=UpscaleOptions())
+                        _fusion_image = Image.fromarray(cv2.cvtColor(_fusion_image, cv2.COLOR_BGR2RGB))
 
-                            # paste back to photo
+                        # The edge shadows generated by fusion are filtered out by taking intersections of masks of faces before and after fusion.
+                        # detect face area
+                        # fusion_image_mask and input_image_mask are 0, 1 masks of shape [h, w, 3]
+                        _fusion_image_mask, _fusion_image_eyes_mask, _fusion_image_lips_mask = face_skin(
+                            _fusion_image, retinaface_detection, needs_index=[[1, 2, 3, 4, 5, 11, 12, 13], [4, 5], [12, 13]]
+                        )
+                        _input_image_mask, _input_image_eyes_mask, _input_image_lips_mask = face_skin(
+                            _first_diffusion_output_image,
+                            retinaface_detection,
+                            needs_index=[[1, 2, 3, 4, 5, 11, 12, 13], [4, 5], [12, 13]],
+                        )
+                        for name, image in zip(
+                            fusion_names,
+                            [_fusion_image, _fusion_image_mask, _fusion_image_eyes_mask, _input_image_mask, _input_image_lips_mask],
+                        ):
+                            frame_store.write(name, idx, image)
+                        fusion_tasks.append((idx, after_face_fusion_ratio))
+                    except Exception as e:
+                        torch.cuda.empty_cache()
+                        traceback.print_exc()
+                        ep_logger.error(f"Apply Face Fusion After {idx} error. Continue. Error Info: {e}")
+
+                # The face blending is done in face_fusion_frame, the result is pasted back to the frame.
+                errors = postprocess_pool.map(face_fusion_frame, frame_store, ["frames"] + fusion_names, fusion_tasks)
+                for task, error in zip(fusion_tasks, errors):
+                    if error is not None:
+                        ep_logger.error(f"Apply Face Fusion After {task[0]} error. Continue. Error Info: {error}")
+                for name in fusion_names:
+                    frame_store.release(name)
+
+            # use original template face area to transfer makeup
+            if makeup_transfer:
+                for idx in face_frame_indexes:
+                    try:
+                        _input_image_retinaface_box = input_image_retinaface_boxes[idx]
+                        _input_image_uint8 = frame_store["frames"][idx]
+                        _input_image_crop = Image.fromarray(
                             _input_image_uint8[
                                 _input_image_retinaface_box[1] : _input_image_retinaface_box[3],
                                 _input_image_retinaface_box[0] : _input_image_retinaface_box[2],
                                 :,
-                            ] = np.array(_input_image_crop_makeup_transfer) * face_skin_mask + np.array(_input_image_crop) * (
-                                1 - face_skin_mask
-                            )
-                            _input_image = Image.fromarray(np.uint8(np.clip(_input_image_uint8, 0, 255)))
-                        except Exception as e:
-                            torch.cuda.empty_cache()
-                            traceback.print_exc()
-                            ep_logger.error(f"Makeup Transfer {idx} error. Continue. Error Info: {e}")
-                else:
-                    _input_image = _loop_template_image
-
-                # If it is a large template for cutting, paste the reconstructed image back
-                if crop_face_preprocess:
-                    if _loop_template_crop_safe_box is not None:
-                        ep_logger.info(f"Start {idx} paste crop image to origin template.")
+                            ]
+                        )
 
-                        x1, y1, x2, y2 = _loop_template_crop_safe_box
-                        _loop_template_image = np.array(_loop_template_image)
-                        _loop_template_image[y1:y2, x1:x2] = np.array(_input_image.resize([x2 - x1, y2 - y1], Image.Resampling.LANCZOS))
+                        # makeup transfer
+                        _input_image_crop_makeup_transfer = _input_image_crop.resize([256, 256])
+                        _template_image_original_face_area = Image.fromarray(np.uint8(template_image_original_face_area[idx])).resize(
+                            [256, 256]
+                        )
+                        _input_image_crop_makeup_transfer = psgan_inference(
+                            _input_image_crop_makeup_transfer, _template_image_original_face_area
+                        )
+                        _input_image_crop_makeup_transfer = _input_image_crop_makeup_transfer.resize(
+                            [np.shape(_input_image_crop)[1], np.shape(_input_image_crop)[0]]
+                        )
 
-                        # backup for old code, will be delete in 2 weeks.
-                        # _loop_template_image = _loop_template_image[_loop_template_padding_size: -_loop_template_padding_size, _loop_template_padding_size: -_loop_template_padding_size]
+                        # detect face area
+                        face_skin_mask = np.float32(
+                            face_skin(_input_image_crop, retinaface_detection, needs_index=[[1, 2, 3, 4, 5, 10, 11, 12, 13]])[0]
+                        )
+                        face_skin_mask = cv2.blur(face_skin_mask, (32, 32)) / 255 * makeup_transfer_ratio
 
-                    _input_image = Image.fromarray(np.uint8(_loop_template_image))
+                        # paste back to photo
+                        _input_image_uint8[
+                            _input_image_retinaface_box[1] : _input_image_retinaface_box[3],
+                            _input_image_retinaface_box[0] : _input_image_retinaface_box[2],
+                            :,
+                        ] = np.clip(
+                            np.array(_input_image_crop_makeup_transfer) * face_skin_mask
+                            + np.array(_input_image_crop) * (1 - face_skin_mask),
+                            0,
+                            255,
+                        )
+                    except Exception as e:
+                        torch.cuda.empty_cache()
+                        traceback.print_exc()
+                        ep_logger.error(f"Makeup Transfer {idx} error. Continue. Error Info: {e}")
+
+            # If it is a large template for cutting, paste the reconstructed image back.
+            # The frames without face paste the template itself, as it was done frame by frame before.
+            if crop_face_preprocess:
+                paste_back_tasks = [
+                    (idx, loop_template_crop_safe_box[idx], input_image_retinaface_boxes[idx] is None)
+                    for idx in range(num_frames)
+                    if loop_template_crop_safe_box[idx] is not None
+                ]
+                ep_logger.info(f"Start paste {len(paste_back_tasks)} crop images to origin template.")
+                errors = postprocess_pool.map(paste_back_frame, frame_store, ["frames", "template"], paste_back_tasks)
+                for task, error in zip(paste_back_tasks, errors):
+                    if error is not None:
+                        ep_logger.error(f"Paste {task[0]} crop image to origin template error. Continue. Error Info: {error}")
+
+            frame_store.release("output")
+            for idx in range(num_frames):
+                if crop_face_preprocess or input_image_retinaface_boxes[idx] is None:
+                    _input_image = loop_template_image[idx]
+                else:
+                    _input_image = frame_store.images("frames")[idx]
 
                 if skin_retouching_bool:
                     try:
@@ -3083,7 +3154,7 @@ def easyphoto_video_infer_forward(
                         # define font and label
                         _input_image = cv2.putText(
                             np.array(_input_image, np.uint8),
-                            "frame_idx: {}, similarity score: {:.2f}".format(frame_idx, loop_output_image_faceid),
+                            "frame_idx: {}, similarity score: {:.2f}".format(idx, loop_output_image_faceid),
                             (40, 40),
                             cv2.FONT_HERSHEY_SIMPLEX,
                             0.5,
@@ -3096,8 +3167,20 @@ def easyphoto_video_infer_forward(
                         traceback.print_exc()
                         ep_logger.error(f"Count similarity error: {e}")
 
-                frame_idx += 1
-                _outputs.append(_input_image)
+                if "output" not in frame_store:
+                    frame_store.create("output", (num_frames,) + np.shape(_input_image))
+                frame_store.write("output", idx, _input_image)
+            frame_store.release("frames")
+            _outputs = frame_store.images("output")
+
+            if video_chunk_frames > 0:
+                # Cross-fade with the tail of the last chunk and stream the finished frames to the encoder.
+                chunk_start = template_idx * (video_chunk_frames - video_chunk_overlap)
+                write_video_chunk_frames(video_chunk_blender.push(chunk_start, _outputs))
+                if loop_message != "":
+                    loop_message += "\n"
+                loop_message += f"Chunk {str(template_idx + 1)} Success."
+                continue
 
             if video_interpolation:
                 modelscope_models_to_cpu()
@@ -3113,9 +3196,11 @@ def easyphoto_video_infer_forward(
                     ep_logger.error(f"Video Interpolation error. Continue. Error Info: {e}")
                 modelscope_models_to_gpu()
 
-            output_video, output_gif, prefix = convert_to_video(
-                os.path.join(easyphoto_video_outpath_samples, "origin"), _outputs, actual_fps, mode=save_as
-            )
+            # The origin video and the crop video are encoded in a single pass over the frames.
+            prefix = get_video_prefix(os.path.join(easyphoto_video_outpath_samples, "origin"))
+            video_encoders = [
+                get_video_encoder(save_as, os.path.join(easyphoto_video_outpath_samples, "origin", f"{prefix}.{save_as}"), actual_fps)
+            ]
 
             if crop_at_last:
                 # get max box of face
@@ -3145,14 +3230,23 @@ def easyphoto_video_infer_forward(
                     last_retinaface_box[1] + height,
                 ]
 
-                # crop
-                _new_outputs = []
-                for _output in _outputs:
-                    _new_outputs.append(_output.crop(last_retinaface_box))
-                output_video, output_gif, _ = convert_to_video(
-                    os.path.join(easyphoto_video_outpath_samples, "crop"), _new_outputs, actual_fps, prefix=prefix + "_crop", mode=save_as
+                video_encoders.append(
+                    get_video_encoder(
+                        save_as,
+                        os.path.join(easyphoto_video_outpath_samples, "crop", f"{prefix}_crop.{save_as}"),
+                        actual_fps,
+                        crop_box=[int(x) for x in last_retinaface_box],
+                    )
                 )
-                _outputs = _new_outputs
+
+            video_writer = MultiFormatVideoWriter(video_encoders)
+            video_writer.write_all(_outputs)
+            output_path = video_writer.close()[-1]
+            output_video, output_gif = (None, output_path) if save_as == "gif" else (output_path, None)
+
+            if crop_at_last:
+                # crop
+                _outputs = [_output.crop(last_retinaface_box) for _output in _outputs]
 
             outputs += _outputs
             if loop_message != "":
@@ -3169,4 +3263,40 @@ def easyphoto_video_infer_forward(
                 loop_message += "\n"
             loop_message += f"Template {str(template_idx + 1)} error: Error info is {e}."
 
+    postprocess_pool.close()
+    frame_store.close()
+
+    if video_chunk_frames > 0:
+        output_video, output_gif = None, None
+        try:
+            write_video_chunk_frames(video_chunk_blender.flush())
+            if video_chunk_writer is not None:
+                output_video, output_gif, prefix = video_chunk_writer.close()
+                preview_stride = max(1, math.ceil(video_chunk_writer.encoder.frame_num / video_chunk_preview_frames))
+
+                if crop_at_last and video_chunk_face_box is not None:
+                    # make width and height can be divisible by 2
+                    x1, y1 = int(video_chunk_face_box[0]), int(video_chunk_face_box[1])
+                    x2 = x1 + int(video_chunk_face_box[2] - x1) // 2 * 2
+                    y2 = y1 + int(video_chunk_face_box[3] - y1) // 2 * 2
+
+                    # crop the encoded video frame by frame instead of keeping all frames in memory
+                    crop_writer = VideoStreamWriter(
+                        os.path.join(easyphoto_video_outpath_samples, "crop"), actual_fps, prefix=prefix + "_crop", mode=save_as
+                    )
+                    for idx, frame in enumerate(read_video_frames(output_video if output_video is not None else output_gif)):
+                        crop_writer.write(frame[y1:y2, x1:x2])
+                        if idx % preview_stride == 0:
+                            outputs.append(Image.fromarray(np.ascontiguousarray(frame[y1:y2, x1:x2])))
+                    output_video, output_gif, _ = crop_writer.close()
+                else:
+                    for idx, frame in enumerate(read_video_frames(output_video if output_video is not None else output_gif)):
+                        if idx % preview_stride == 0:
+                            outputs.append(Image.fromarray(frame))
+        except Exception as e:
+            torch.cuda.empty_cache()
+            traceback.print_exc()
+            ep_logger.error(f"Chunked video output error: Error info is {e}.")
+            loop_message += f"\nChunked video output error: Error info is {e}."
+
     return loop_message, output_video, output_gif, outputs
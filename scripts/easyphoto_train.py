@@ -1,5 +1,8 @@
+import hashlib
+import json
 import os
 import platform
+import shutil
 import subprocess
 import sys
 import numpy as np
@@ -7,6 +10,7 @@ from glob import glob
 from shutil import copyfile
 
 from modules.sd_models_config import config_default, config_sdxl
+from modules.shared import opts
 from PIL import Image, ImageOps
 
 from scripts.easyphoto_config import (
@@ -20,9 +24,59 @@ from scripts.easyphoto_config import (
 )
 from scripts.easyphoto_utils import check_files_exists_and_download, check_id_valid, check_scene_valid, ep_logger, unload_models
 from scripts.sdwebui import get_checkpoint_type, unload_sd
+from scripts.train_kohya.train_scheduler import get_training_scheduler
+from scripts.train_kohya.train_worker import run_training_command
 from scripts.train_kohya.utils.lora_utils import convert_lora_to_safetensors
+from scripts.train_kohya.utils.progress_events import ProgressEvents
 
 python_executable_path = sys.executable
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_train_progress_path(user_id):
+    """The structured progress events (JSON lines) of the training of user_id, see train_kohya/utils/progress_events.py."""
+    return os.path.join(os.path.dirname(cache_log_file_path), f"train_progress_{user_id}.jsonl")
+
+
+def report_train_finished(progress_file_path, message):
+    """Write the final event of a training to its progress events and return the message."""
+    progress_events = ProgressEvents(progress_file_path)
+    progress_events.emit("finished", message=message)
+    progress_events.close()
+    return message
+
+
+def promote_incremental_lora(user_id, weights_save_path, previous_best_outputs_path, webui_save_path):
+    """Replace the Lora of the user with the incrementally trained one only if it improves the face id score."""
+    best_outputs_path = os.path.join(weights_save_path, "best_outputs")
+    try:
+        with open(os.path.join(best_outputs_path, "face_id_score.json"), "r") as f:
+            face_id_score = json.load(f)
+    except Exception as e:
+        ep_logger.error(f"Failed to obtain the face id score of the incremental training, keep the previous Lora. Error info: {e}")
+        return "Failed to obtain the face id score of the incremental training, the previous Lora is kept."
+
+    score, baseline_score = face_id_score["score"], face_id_score["baseline_score"]
+    if baseline_score is not None and score <= baseline_score:
+        message = (
+            f"The incremental training does not improve the face id score ({score:.4f} <= {baseline_score:.4f}), "
+            "the previous Lora is kept."
+        )
+        ep_logger.info(message)
+        return message
+
+    shutil.rmtree(previous_best_outputs_path, ignore_errors=True)
+    shutil.copytree(best_outputs_path, previous_best_outputs_path)
+    copyfile(os.path.join(previous_best_outputs_path, f"{user_id}.safetensors"), webui_save_path)
+    message = f"The incremental training has been completed, the face id score is {score:.4f} (previous {baseline_score})."
+    ep_logger.info(message)
+    return message
+
+
 # base, portrait, sdxl
 check_hash = {}
 
@@ -75,7 +129,9 @@ def easyphoto_train_forward(
             ids.append(os.path.splitext(_scene)[0])
     ids = sorted(ids)
 
-    if user_id in ids:
+    # With incremental training, the photos of an existing user update the Lora of the user.
+    incremental_bool = user_id in ids and opts.data.get("easyphoto_train_incremental", False) and train_mode_choose != "Train Scene Lora"
+    if user_id in ids and not incremental_bool:
         ep_logger.error("User id non-repeatability.")
         return "User id non-repeatability."
     
@@ -121,6 +177,15 @@ def easyphoto_train_forward(
             ep_logger.error("To save training time and VRAM, please turn off validation in SDXL training.")
             return "To save training time and VRAM, please turn off validation in SDXL training."
 
+    # Check conflicted arguments in incremental training.
+    if incremental_bool:
+        if sdxl_pipeline_flag or not validation:
+            ep_logger.error("Incremental training compares the face id scores of validation, it needs validation with a SD1.5 checkpoint.")
+            return "Incremental training compares the face id scores of validation, it needs validation with a SD1.5 checkpoint."
+        if enable_rl:
+            ep_logger.warning("Reinforcement learning is skipped in incremental training.")
+            enable_rl = False
+
     # Template address
     training_templates_path = os.path.join(easyphoto_models_path, "training_templates")
     # Raw data backup
@@ -143,6 +208,19 @@ def easyphoto_train_forward(
     sd_save_path = os.path.join(easyphoto_models_path, "stable-diffusion-v1-5")
     if sdxl_pipeline_flag:
         sd_save_path = sd_save_path.replace("stable-diffusion-v1-5", "stable-diffusion-xl/stabilityai_stable_diffusion_xl_base_1.0")
+    # Preprocessing outputs of each photo by content hash, reused by incremental training.
+    preprocess_cache_path = os.path.join(cache_outpath_samples, user_id, "preprocess_cache")
+    if incremental_bool:
+        previous_best_outputs_path = os.path.join(weights_save_path, "best_outputs")
+        previous_best_weight_path = os.path.join(previous_best_outputs_path, f"{user_id}.safetensors")
+        if not os.path.exists(previous_best_weight_path):
+            ep_logger.error(f"Failed to find the previous Lora {previous_best_weight_path} for incremental training.")
+            return f"Failed to find the previous Lora {previous_best_weight_path} for incremental training."
+        # Train in a new folder, the previous best outputs are replaced only if the new Lora is better.
+        weights_save_path = os.path.join(cache_outpath_samples, user_id, "user_weights_incremental")
+        shutil.rmtree(weights_save_path, ignore_errors=True)
+        # The processed images are rebuilt from all the photos of the user.
+        shutil.rmtree(images_save_path, ignore_errors=True)
     if enable_rl and not train_scene_lora_bool:
         ddpo_weight_save_path = os.path.join(cache_outpath_samples, user_id, "ddpo_weights")
         face_lora_path = os.path.join(weights_save_path, f"best_outputs/{user_id}.safetensors")
@@ -153,6 +231,7 @@ def easyphoto_train_forward(
     os.makedirs(images_save_path, exist_ok=True)
     os.makedirs(os.path.dirname(os.path.abspath(webui_save_path)), exist_ok=True)
 
+    max_train_steps_limit = int(max_train_steps)
     max_train_steps = int(min(len(instance_images) * int(steps_per_photos), int(max_train_steps)))
     local_validation_prompt = None
     if isinstance(instance_images[0], list):
@@ -161,13 +240,45 @@ def easyphoto_train_forward(
             local_validation_prompt = [instance[1] for instance in instance_images]
         instance_images = [instance[0] for instance in instance_images]
 
-    for index, user_image in enumerate(instance_images):
+    # An incremental training adds the new photos after the photos of the user, skipping the photos already there.
+    backup_index = 0
+    backup_hashes = set()
+    if incremental_bool:
+        backup_photos = glob(os.path.join(original_backup_path, "*.jpg"))
+        backup_index = max([int(os.path.splitext(os.path.basename(path))[0]) for path in backup_photos], default=-1) + 1
+        backup_hashes = {file_sha256(path) for path in backup_photos}
+    for user_image in instance_images:
         image = Image.open(user_image["name"])
         image = ImageOps.exif_transpose(image).convert("RGB")
-        image.save(os.path.join(original_backup_path, str(index) + ".jpg"))
+        backup_path = os.path.join(original_backup_path, str(backup_index) + ".jpg")
+        image.save(backup_path)
+        if incremental_bool:
+            photo_hash = file_sha256(backup_path)
+            if photo_hash in backup_hashes:
+                os.remove(backup_path)
+                continue
+            backup_hashes.add(photo_hash)
+        backup_index += 1
+
+    if incremental_bool:
+        # Fine-tune the previous Lora on all the photos of the user with a reduced step budget.
+        num_photos = len(glob(os.path.join(original_backup_path, "*.jpg")))
+        steps_ratio = float(opts.data.get("easyphoto_train_incremental_steps_ratio", 0.3))
+        max_train_steps = int(min(num_photos * int(steps_per_photos), max_train_steps_limit) * steps_ratio)
+        max_train_steps = max(max_train_steps, int(val_and_checkpointing_steps))
+        ep_logger.info(f"Incremental training on {num_photos} photos for {max_train_steps} steps.")
     
     if local_validation_prompt is None:
         local_validation_prompt = validation_prompt if not train_scene_lora_bool else training_prefix_prompt + ", " + validation_prompt_scene
+    # Run preprocess and training in the persistent worker if enabled, see train_kohya/train_worker.py.
+    use_train_worker = opts.data.get("easyphoto_train_worker", False)
+    # With GPUs set, concurrent trainings run in the GPU slots of the scheduler, each with its own port and progress file.
+    training_scheduler = get_training_scheduler(opts.data.get("easyphoto_train_gpus", ""), os.path.dirname(cache_log_file_path))
+    train_log_file_path = cache_log_file_path if training_scheduler is None else training_scheduler.job_progress_path(user_id)
+    # The structured progress events of this training, restarted for each training.
+    progress_file_path = get_train_progress_path(user_id)
+    os.makedirs(os.path.dirname(progress_file_path), exist_ok=True)
+    open(progress_file_path, "w").close()
     # preprocess
     preprocess_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocess.py")
     command = [
@@ -179,13 +290,15 @@ def easyphoto_train_forward(
         f"--inputs_dir={original_backup_path}",
         f"--ref_image_path={ref_image_path}",
         f"--crop_ratio={crop_ratio}",
+        f"--cache_dir={preprocess_cache_path}",
+        f"--progress_file={progress_file_path}",
     ]
     if skin_retouching_bool:
         command += ["--skin_retouching_bool"]
     if train_scene_lora_bool:
         command += ["--train_scene_lora_bool"]
     try:
-        subprocess.run(command, check=True)
+        run_training_command(command, use_worker=use_train_worker, scheduler=training_scheduler, job_name=user_id)
     except subprocess.CalledProcessError as e:
         ep_logger.error(f"Error executing the command: {e}")
 
@@ -193,10 +306,12 @@ def easyphoto_train_forward(
     train_images = glob(os.path.join(images_save_path, "*.jpg"))
     if len(train_images) == 0:
         ep_logger.error("Failed to obtain preprocessed images, please check the preprocessing process.")
-        return "Failed to obtain preprocessed images, please check the preprocessing process."
+        return report_train_finished(progress_file_path, "Failed to obtain preprocessed images, please check the preprocessing process.")
     if not os.path.exists(json_save_path):
         ep_logger.error("Failed to obtain preprocessed metadata.jsonl, please check the preprocessing process.")
-        return "Failed to obtain preprocessed metadata.jsonl, please check the preprocessing process."
+        return report_train_finished(
+            progress_file_path, "Failed to obtain preprocessed metadata.jsonl, please check the preprocessing process."
+        )
 
     if not sdxl_pipeline_flag:
         train_kohya_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train_kohya/train_lora.py")
@@ -208,9 +323,9 @@ def easyphoto_train_forward(
         ep_logger.info("train_ddpo_path : {}".format(train_kohya_path))
 
     # outputs/easyphoto-tmp/train_kohya_log.txt, use to cache log and flush to UI
-    ep_logger.info("cache_log_file_path: {}".format(cache_log_file_path))
-    if not os.path.exists(os.path.dirname(cache_log_file_path)):
-        os.makedirs(os.path.dirname(cache_log_file_path), exist_ok=True)
+    ep_logger.info("train_log_file_path: {}".format(train_log_file_path))
+    if not os.path.exists(os.path.dirname(train_log_file_path)):
+        os.makedirs(os.path.dirname(train_log_file_path), exist_ok=True)
 
     # Extra arguments to run SDXL training.
     env = None
@@ -227,6 +342,7 @@ def easyphoto_train_forward(
 
     unload_models()
     random_seed = np.random.randint(1, 1e6)
+    early_stopping_patience = int(opts.data.get("easyphoto_train_early_stopping_patience", 0))
     if platform.system() == "Windows":
         pwd = os.getcwd()
         dataloader_num_workers = 0  # for solve multi process bug
@@ -265,10 +381,18 @@ def easyphoto_train_forward(
             "--template_mask",
             "--merge_best_lora_based_face_id",
             f"--merge_best_lora_name={user_id}",
-            f"--cache_log_file={cache_log_file_path}",
+            f"--cache_log_file={train_log_file_path}",
+            f"--progress_file={progress_file_path}",
         ]
         if validation and not train_scene_lora_bool:
             command += ["--validation"]
+        if validation and not train_scene_lora_bool and early_stopping_patience > 0:
+            command += [f"--early_stopping_patience={early_stopping_patience}"]
+        if incremental_bool:
+            command += [f"--network_weights={os.path.relpath(previous_best_weight_path, pwd)}"]
+            command += [f"--baseline_best_outputs_dir={os.path.relpath(previous_best_outputs_path, pwd)}"]
+        if opts.data.get("easyphoto_train_cache_latents", False):
+            command += ["--cache_latents"]
         if sdxl_pipeline_flag:
             command += [f"--original_config={original_config}"]
             command += [f"--pretrained_vae_model_name_or_path={pretrained_vae_model_name_or_path}"]
@@ -278,8 +402,9 @@ def easyphoto_train_forward(
             # We do not train the text encoders for SDXL Scene Lora.
             if sdxl_pipeline_flag:
                 command = [c for c in command if not c.startswith("--train_text_encoder")]
+                command += ["--cache_text_encoder_outputs"]
         try:
-            subprocess.run(command, env=env, check=True)
+            run_training_command(command, env=env, use_worker=use_train_worker, scheduler=training_scheduler, job_name=user_id)
         except subprocess.CalledProcessError as e:
             ep_logger.error(f"Error executing the command: {e}")
 
@@ -297,7 +422,8 @@ def easyphoto_train_forward(
                 f"{train_ddpo_path}",
                 f"--run_name={user_id}",
                 f"--logdir={os.path.relpath(ddpo_weight_save_path, pwd)}",
-                f"--cache_log_file={cache_log_file_path}",
+                f"--cache_log_file={train_log_file_path}",
+                f"--progress_file={progress_file_path}",
                 f"--pretrained_model_name_or_path={os.path.relpath(sd_save_path, pwd)}",
                 f"--pretrained_model_ckpt={os.path.relpath(webui_load_path, pwd)}",
                 f"--original_config={original_config}",
@@ -325,12 +451,12 @@ def easyphoto_train_forward(
             try:
                 ep_logger.info("Start RL (reinforcement learning). The max time of RL is {}.".format(max_rl_time))
                 # Since `accelerate` spawns a new process, set `timeout` in `subprocess.run` does not take effects.
-                subprocess.run(command, env=env, check=True)
+                run_training_command(command, env=env, use_worker=use_train_worker, scheduler=training_scheduler, job_name=user_id)
             except subprocess.CalledProcessError as e:
                 ep_logger.error(f"Error executing the command: {e}")
             finally:
                 # The cached log file will be cleared when times out or errors occur.
-                with open(cache_log_file_path, "w") as _:
+                with open(train_log_file_path, "w") as _:
                     pass
     else:
         command = [
@@ -368,10 +494,18 @@ def easyphoto_train_forward(
             "--template_mask",
             "--merge_best_lora_based_face_id",
             f"--merge_best_lora_name={user_id}",
-            f"--cache_log_file={cache_log_file_path}",
+            f"--cache_log_file={train_log_file_path}",
+            f"--progress_file={progress_file_path}",
         ]
         if validation and not train_scene_lora_bool:
             command += ["--validation"]
+        if validation and not train_scene_lora_bool and early_stopping_patience > 0:
+            command += [f"--early_stopping_patience={early_stopping_patience}"]
+        if incremental_bool:
+            command += [f"--network_weights={previous_best_weight_path}"]
+            command += [f"--baseline_best_outputs_dir={previous_best_outputs_path}"]
+        if opts.data.get("easyphoto_train_cache_latents", False):
+            command += ["--cache_latents"]
         if sdxl_pipeline_flag:
             command += [f"--original_config={original_config}"]
             command += [f"--pretrained_vae_model_name_or_path={pretrained_vae_model_name_or_path}"]
@@ -381,8 +515,9 @@ def easyphoto_train_forward(
             # We do not train the text encoders for SDXL Scene Lora.
             if sdxl_pipeline_flag:
                 command = [c for c in command if not c.startswith("--train_text_encoder")]
+                command += ["--cache_text_encoder_outputs"]
         try:
-            subprocess.run(command, env=env, check=True)
+            run_training_command(command, env=env, use_worker=use_train_worker, scheduler=training_scheduler, job_name=user_id)
         except subprocess.CalledProcessError as e:
             ep_logger.error(f"Error executing the command: {e}")
 
@@ -400,7 +535,8 @@ def easyphoto_train_forward(
                 f"{train_ddpo_path}",
                 f"--run_name={user_id}",
                 f"--logdir={ddpo_weight_save_path}",
-                f"--cache_log_file={cache_log_file_path}",
+                f"--cache_log_file={train_log_file_path}",
+                f"--progress_file={progress_file_path}",
                 f"--pretrained_model_name_or_path={sd_save_path}",
                 f"--pretrained_model_ckpt={webui_load_path}",
                 f"--original_config={original_config}",
@@ -428,12 +564,12 @@ def easyphoto_train_forward(
             try:
                 ep_logger.info("Start RL (reinforcement learning). The max time of RL is {}.".format(max_rl_time))
                 # Since `accelerate` spawns a new process, set `timeout` in `subprocess.run` does not take effects.
-                subprocess.run(command, env=env, check=True)
+                run_training_command(command, env=env, use_worker=use_train_worker, scheduler=training_scheduler, job_name=user_id)
             except subprocess.CalledProcessError as e:
                 ep_logger.error(f"Error executing the command: {e}")
             finally:
                 # The cached log file will be cleared when times out or errors occur.
-                with open(cache_log_file_path, "w") as _:
+                with open(train_log_file_path, "w") as _:
                     pass
 
     best_weight_path = os.path.join(weights_save_path, f"best_outputs/{user_id}.safetensors")
@@ -442,7 +578,11 @@ def easyphoto_train_forward(
     if sdxl_pipeline_flag:
         best_weight_path = os.path.join(weights_save_path, "pytorch_lora_weights.safetensors")
     if not os.path.exists(best_weight_path):
-        return "Failed to obtain Lora after training, please check the training process."
+        return report_train_finished(progress_file_path, "Failed to obtain Lora after training, please check the training process.")
+
+    if incremental_bool:
+        message = promote_incremental_lora(user_id, weights_save_path, previous_best_outputs_path, webui_save_path)
+        return report_train_finished(progress_file_path, message)
 
     copyfile(best_weight_path, webui_save_path)
 
@@ -450,8 +590,10 @@ def easyphoto_train_forward(
         # Currently, the best (reward_mean) ddpo lora checkpoint will be selected and saved to the WebUI Lora folder.
         best_output_dir = os.path.join(ddpo_weight_save_path, "best_outputs")
         if not os.path.exists(best_output_dir):
-            return "Failed to obtain checkpoints after reinforcement learning, please check the training process."
+            return report_train_finished(
+                progress_file_path, "Failed to obtain checkpoints after reinforcement learning, please check the training process."
+            )
         ddpo_lora_path = os.path.join(best_output_dir, "pytorch_lora_weights.bin")
         convert_lora_to_safetensors(ddpo_lora_path, ddpo_webui_save_path)
 
-    return "The training has been completed."
+    return report_train_finished(progress_file_path, "The training has been completed.")
@@ -18,7 +18,9 @@ from segment_anything import SamPredictor, sam_model_registry
 from scripts.easyphoto_config import (
     cache_log_file_path,
     cloth_id_outpath_samples,
+    cloth_lora_registry_path,
     easyphoto_outpath_samples,
+    sam_embedding_cache_path,
     validation_tryon_prompt,
     tryon_gallery_dir,
     DEFAULT_CLOTH_LORA,
@@ -28,6 +30,7 @@ from scripts.easyphoto_utils import (
     align_and_overlay_images,
     apply_mask_to_image,
     check_files_exists_and_download,
+    ClothLoraRegistry,
     compute_rotation_angle,
     copy_white_mask_to_template,
     crop_image,
@@ -42,16 +45,19 @@ from scripts.easyphoto_utils import (
     prepare_tryon_train_data,
     resize_and_stretch,
     resize_image_with_pad,
+    SamEmbeddingCache,
     seg_by_box,
     find_connected_components,
     cleanup_decorator,
 )
 from scripts.sdwebui import get_checkpoint_type, reload_sd_model_vae, switch_sd_model_vae
+from scripts.train_kohya.train_worker import run_training_command
 
 python_executable_path = sys.executable
 # base portrait sdxl add_text2image add_ipa_base add_ipa_sdxl add_video add_tryon
 check_hash = {}
 sam_predictor = None
+sam_embedding_cache = None
 
 
 @switch_sd_model_vae()
@@ -161,6 +167,31 @@ def easyphoto_tryon_infer_forward(
     return_msg = ""
 
     webui_save_path = os.path.join(models_path, f"Lora/{cloth_uuid}.safetensors")
+
+    # A re-uploaded cloth reuses the LoRA trained for it before. The other training params are fixed below, so the
+    # checkpoint and the steps are the ones that change the LoRA.
+    cloth_lora_registry = None
+    train_params = {"sd_model_checkpoint": sd_model_checkpoint, "max_train_steps": int(max_train_steps)}
+    if ref_image_selected_tab != 0 and not os.path.exists(webui_save_path) and opts.data.get("easyphoto_tryon_lora_reuse", True):
+        if reference_mask is None:
+            _, reference_mask = easyphoto_tryon_mask_forward(reference_image, "Reference")
+
+        cloth_lora_registry = ClothLoraRegistry(
+            cloth_lora_registry_path, max_distance=int(opts.data.get("easyphoto_tryon_lora_reuse_distance", 4))
+        )
+        reused_cloth_uuid = cloth_lora_registry.lookup(
+            reference_image["image"],
+            reference_mask,
+            train_params,
+            is_valid=lambda uuid: os.path.exists(os.path.join(models_path, f"Lora/{uuid}.safetensors")),
+        )
+        ep_logger.info(cloth_lora_registry.summary())
+        if reused_cloth_uuid is not None:
+            return_msg += f"The same cloth has been trained as {reused_cloth_uuid}, reuse its LoRA instead of training {cloth_uuid}.\n"
+            ep_logger.info(f"Reuse the LoRA of {reused_cloth_uuid} for {cloth_uuid}.")
+            cloth_uuid = reused_cloth_uuid
+            webui_save_path = os.path.join(models_path, f"Lora/{cloth_uuid}.safetensors")
+
     if os.path.exists(webui_save_path):
         return_msg += f"Use exists LoRA of {cloth_uuid}.\n"
         ep_logger.info(f"LoRA of user id: {cloth_uuid} exists. Start Infer.")
@@ -244,6 +275,7 @@ def easyphoto_tryon_infer_forward(
         sam_predictor = None
         torch.cuda.empty_cache()
 
+        use_train_worker = opts.data.get("easyphoto_train_worker", False)
         if platform.system() == "Windows":
             pwd = os.getcwd()
             dataloader_num_workers = 0  # for solve multi process bug
@@ -278,8 +310,10 @@ def easyphoto_tryon_infer_forward(
                 "--mixed_precision=fp16",
                 f"--cache_log_file={cache_log_file_path}",
             ]
+            if opts.data.get("easyphoto_train_cache_latents", False):
+                command += ["--cache_latents"]
             try:
-                subprocess.run(command, check=True)
+                run_training_command(command, use_worker=use_train_worker)
             except subprocess.CalledProcessError as e:
                 ep_logger.error(f"Error executing the command: {e}")
 
@@ -314,8 +348,10 @@ def easyphoto_tryon_infer_forward(
                 "--mixed_precision=fp16",
                 f"--cache_log_file={cache_log_file_path}",
             ]
+            if opts.data.get("easyphoto_train_cache_latents", False):
+                command += ["--cache_latents"]
             try:
-                subprocess.run(command, check=True)
+                run_training_command(command, use_worker=use_train_worker)
             except subprocess.CalledProcessError as e:
                 ep_logger.error(f"Error executing the command: {e}")
 
@@ -328,6 +364,8 @@ def easyphoto_tryon_infer_forward(
         Image.open(ref_image_path).save(os.path.join(cloth_gallery_dir, f"{cloth_uuid}.jpg"))
         # save to models/LoRA
         copyfile(best_weight_path, webui_save_path)
+        if cloth_lora_registry is not None:
+            cloth_lora_registry.register(reference_image["image"], reference_mask, train_params, cloth_uuid)
 
     # infer
     # get random seed
@@ -483,179 +521,173 @@ def easyphoto_tryon_infer_forward(
     mask_template_input = copy.deepcopy(mask_template)
 
     # Step5: generation
+    # The controlnet hints, masks and paste-back boxes do not depend on the sample, so they are computed once and the
+    # first diffusion and the inner bound refine run batched over the samples (with seeds seed, seed + 1, ...).
+    target_width = box_template[2] - box_template[0]
+    target_height = box_template[3] - box_template[1]
+    resize_mask_template = mask_template.resize((target_width, target_height))
+    template_copy = np.array(template_copy, np.uint8)
+    mask_array = np.array(np.uint8(resize_mask_template))
+    if len(mask_array.shape) != 2:
+        mask_array = mask_array[:, :, 0]
+
+    first_controlnet_pairs = [
+        ["canny_no_pre", res_canny, 1.0, 0, "Crop and Resize"],
+        ["depth", resize_img_template, 1.0, 0],
+        ["color", resize_image_input, 0.5, 0],
+    ]
+    inner_controlnet_pairs = [
+        ["canny", resize_img_template, 1.0, 0],
+        ["depth", resize_img_template, 1.0, 0],
+    ]
+
+    if refine_bound:
+        padding = 30
+        box_pad = expand_box_by_pad(
+            box_template,
+            max_size=(template_copy.shape[1], template_copy.shape[0]),
+            padding_size=padding,
+        )
+        padding_size = abs(np.array(box_pad) - np.array(box_template))
+        input_mask_copy = np.pad(
+            mask_array,
+            (
+                (padding_size[1], padding_size[3]),
+                (padding_size[0], padding_size[2]),
+            ),
+            mode="constant",
+            constant_values=0,
+        )
+        input_mask = np.uint8(
+            cv2.dilate(input_mask_copy, np.ones((10, 10), np.uint8), iterations=1)
+            - cv2.erode(input_mask_copy, np.ones((10, 10), np.uint8), iterations=1)
+        )
+        input_mask = Image.fromarray(np.uint8(input_mask))
+
+    diffusion_batch = max(int(opts.data.get("easyphoto_tryon_diffusion_batch", 4)), 1)
+
     return_res = []
-    for i in range(batch_size):
-        ep_logger.info("Start First diffusion.")
-        # inpaint the main region
-        controlnet_pairs = [
-            ["canny_no_pre", res_canny, 1.0, 0, "Crop and Resize"],
-            ["depth", resize_img_template, 1.0, 0],
-            ["color", resize_image_input, 0.5, 0],
-        ]
+    for start in range(0, batch_size, diffusion_batch):
+        chunk_size = min(diffusion_batch, batch_size - start)
+        chunk_seed = int(seed) + start
 
-        result_img = inpaint(
+        ep_logger.info(f"Start First diffusion for samples {start} - {start + chunk_size - 1}.")
+        # inpaint the main region
+        result_imgs = inpaint(
             resize_image_input,
             mask_template_input,
-            controlnet_pairs,
+            first_controlnet_pairs,
             diffusion_steps=first_diffusion_steps,
             denoising_strength=first_denoising_strength,
             input_prompt=input_prompt,
             default_positive_prompt="",
             default_negative_prompt="",
             hr_scale=1.0,
-            seed=str(seed),
+            seed=chunk_seed,
             sd_model_checkpoint=sd_model_checkpoint,
-        )
-        result_img = result_img[0]
+            batch_size=chunk_size,
+        )[:chunk_size]
+        if len(result_imgs) < chunk_size:
+            ep_logger.warning(f"The first diffusion returns {len(result_imgs)} images for a batch of {chunk_size} samples.")
 
         # start inner bound refine
-        controlnet_pairs = [
-            ["canny", resize_img_template, 1.0, 0],
-            ["depth", resize_img_template, 1.0, 0],
-        ]
         refine_diffusion_steps = 30
         refine_denoising_strength = 0.7
 
-        result_img = inpaint(
-            result_img,
+        result_imgs = inpaint(
+            result_imgs,
             inner_bound_mask,
-            controlnet_pairs,
+            inner_controlnet_pairs,
             diffusion_steps=refine_diffusion_steps,
             denoising_strength=refine_denoising_strength,
             input_prompt=input_prompt,
             default_positive_prompt="",
             default_negative_prompt="",
             hr_scale=1.0,
-            seed=str(seed),
+            seed=chunk_seed,
             sd_model_checkpoint=sd_model_checkpoint,
-        )
-        result_img = result_img[0]
-
-        # resize diffusion results
-        target_width = box_template[2] - box_template[0]
-        target_height = box_template[3] - box_template[1]
-        result_img = result_img.resize((target_width, target_height))
-        resize_mask_template = mask_template.resize((target_width, target_height))
-
-        # copy back
-        template_copy = np.array(template_copy, np.uint8)
-
-        if len(np.array(np.uint8(resize_mask_template)).shape) == 2:
-            init_generation = copy_white_mask_to_template(
-                np.array(result_img),
-                np.array(np.uint8(resize_mask_template)),
-                template_copy,
-                box_template,
-            )
-        else:
-            init_generation = copy_white_mask_to_template(
-                np.array(result_img),
-                np.array(np.uint8(resize_mask_template))[:, :, 0],
-                template_copy,
+            batch_size=chunk_size,
+        )[:chunk_size]
+        if len(result_imgs) < chunk_size:
+            ep_logger.warning(f"The inner bound refine returns {len(result_imgs)} images for a batch of {chunk_size} samples.")
+
+        # resize diffusion results and copy back
+        init_generations = [
+            copy_white_mask_to_template(
+                np.array(result_img.resize((target_width, target_height))),
+                mask_array,
+                copy.deepcopy(template_copy),
                 box_template,
             )
-
-        return_res.append(Image.fromarray(np.uint8(init_generation)))
+            for result_img in result_imgs
+        ]
 
         if refine_bound:
             ep_logger.info("Start Refine Boundary.")
-            # refine bound
-            padding = 30
-
-            box_pad = expand_box_by_pad(
-                box_template,
-                max_size=(template_copy.shape[1], template_copy.shape[0]),
-                padding_size=padding,
-            )
-            padding_size = abs(np.array(box_pad) - np.array(box_template))
-
-            input_img = init_generation[box_pad[1] : box_pad[3], box_pad[0] : box_pad[2]]
-            input_control_img = template_copy[box_pad[1] : box_pad[3], box_pad[0] : box_pad[2]]
-
-            if len(np.array(np.uint8(resize_mask_template)).shape) == 2:
-                mask_array = np.array(np.uint8(resize_mask_template))
-            else:
-                mask_array = np.array(np.uint8(resize_mask_template))[:, :, 0]
-
-            input_mask = np.pad(
-                mask_array,
-                (
-                    (padding_size[1], padding_size[3]),
-                    (padding_size[0], padding_size[2]),
-                ),
-                mode="constant",
-                constant_values=0,
-            )
-
-            input_mask_copy = copy.deepcopy(input_mask)
-
-            input_mask = np.uint8(
-                cv2.dilate(np.array(input_mask), np.ones((10, 10), np.uint8), iterations=1)
-                - cv2.erode(np.array(input_mask), np.ones((10, 10), np.uint8), iterations=1)
-            )
-
-            # generate
-            controlnet_pairs = [["canny", input_control_img, 1.0, 0]]
-
-            input_mask = Image.fromarray(np.uint8(input_mask))
-            input_img = Image.fromarray(input_img)
-
             refine_diffusion_steps = 20
             refine_denoising_strength = 0.5
 
-            result_img = inpaint(
-                input_img,
-                input_mask,
-                controlnet_pairs,
-                diffusion_steps=refine_diffusion_steps,
-                denoising_strength=refine_denoising_strength,
-                input_prompt=input_prompt,
-                hr_scale=1.0,
-                seed=str(seed),
-                sd_model_checkpoint=sd_model_checkpoint,
-            )
-            result_img = result_img[0]
-
-            # resize diffusion results
-            target_width = box_pad[2] - box_pad[0]
-            target_height = box_pad[3] - box_pad[1]
-            result_img = result_img.resize((target_width, target_height))
-            input_mask = input_mask.resize((target_width, target_height))
-
-            final_generation = copy_white_mask_to_template(
-                np.array(result_img),
-                np.array(np.uint8(input_mask_copy)),
-                template_copy,
-                box_pad,
-            )
-
-            return_res.append(Image.fromarray(np.uint8(final_generation)))
+            # The canny hint of the boundary refine is the pasted generation itself, so it differs per sample and
+            # this stage cannot share one controlnet unit across the batch.
+            final_generations = []
+            for index, init_generation in enumerate(init_generations):
+                input_img = init_generation[box_pad[1] : box_pad[3], box_pad[0] : box_pad[2]]
+                controlnet_pairs = [["canny", input_img, 1.0, 0]]
+
+                result_img = inpaint(
+                    Image.fromarray(input_img),
+                    input_mask,
+                    controlnet_pairs,
+                    diffusion_steps=refine_diffusion_steps,
+                    denoising_strength=refine_denoising_strength,
+                    input_prompt=input_prompt,
+                    hr_scale=1.0,
+                    seed=chunk_seed + index,
+                    sd_model_checkpoint=sd_model_checkpoint,
+                )
+                result_img = result_img[0]
+
+                # resize diffusion results and copy back
+                result_img = result_img.resize((box_pad[2] - box_pad[0], box_pad[3] - box_pad[1]))
+                final_generations.append(
+                    copy_white_mask_to_template(
+                        np.array(result_img),
+                        np.array(np.uint8(input_mask_copy)),
+                        copy.deepcopy(init_generation),
+                        box_pad,
+                    )
+                )
         else:
-            final_generation = init_generation
-
-        save_image(
-            Image.fromarray(np.uint8(final_generation)),
-            easyphoto_outpath_samples,
-            "EasyPhoto",
-            None,
-            None,
-            opts.grid_format,
-            info=None,
-            short_filename=not opts.grid_extended_filename,
-            grid=True,
-            p=None,
-        )
+            final_generations = init_generations
+
+        for init_generation, final_generation in zip(init_generations, final_generations):
+            return_res.append(Image.fromarray(np.uint8(init_generation)))
+            if refine_bound:
+                return_res.append(Image.fromarray(np.uint8(final_generation)))
+
+            save_image(
+                Image.fromarray(np.uint8(final_generation)),
+                easyphoto_outpath_samples,
+                "EasyPhoto",
+                None,
+                None,
+                opts.grid_format,
+                info=None,
+                short_filename=not opts.grid_extended_filename,
+                grid=True,
+                p=None,
+            )
 
-        return_res.append(first_paste)
+            return_res.append(first_paste)
         torch.cuda.empty_cache()
 
-        ep_logger.info("Finished")
+    ep_logger.info("Finished")
 
     return "Success\n" + return_msg, return_res, template_mask, reference_mask
 
 
 def easyphoto_tryon_mask_forward(input_image, img_type):
-    global check_hash, sam_predictor
+    global check_hash, sam_predictor, sam_embedding_cache
 
     check_files_exists_and_download(check_hash.get("add_tryon", True), "add_tryon")
     check_hash["add_tryon"] = False
@@ -687,18 +719,24 @@ def easyphoto_tryon_mask_forward(input_image, img_type):
         sam = sam_model_registry["vit_l"]()
         sam.load_state_dict(torch.load(sam_checkpoint))
         sam_predictor = SamPredictor(sam.cuda())
+    if sam_embedding_cache is None:
+        # Refining the hints on the same image reuses its embedding instead of running the image encoder again.
+        sam_embedding_cache = SamEmbeddingCache(
+            int(opts.data.get("easyphoto_sam_embedding_cache_size", 8)),
+            sam_embedding_cache_path if opts.data.get("easyphoto_sam_embedding_disk_cache", False) else None,
+        )
 
     if num_connected < 2:
         ep_logger.info(f"{(img_type)} Refine input mask of by mask.")
         # support the input is a mask, we use box and sam to refine mask
         _, box_template = mask_to_box(mask[:, :, 0])
-        mask = np.uint8(seg_by_box(np.array(img), box_template, sam_predictor))
+        mask = np.uint8(seg_by_box(np.array(img), box_template, sam_predictor, embedding_cache=sam_embedding_cache))
     else:
         ep_logger.info(f"{(img_type)} Refine input mask of by points.")
         # support points is given, points are used to refine mask
         centroids = np.array(centroids)
         input_label = np.array([1] * centroids.shape[0])
-        sam_predictor.set_image(np.array(img))
+        sam_embedding_cache.set_image(sam_predictor, np.array(img))
         masks, _, _ = sam_predictor.predict(
             point_coords=centroids,
             point_labels=input_label,
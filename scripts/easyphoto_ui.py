@@ -33,6 +33,7 @@ from scripts.easyphoto_utils import (
     unload_models,
 )
 from scripts.sdwebui import get_checkpoint_type, get_scene_prompt
+from scripts.train_kohya.train_scheduler import get_training_scheduler
 
 if not check_loractl_conflict():
     from scripts.easyphoto_utils import LoraCtlScript
@@ -204,12 +205,29 @@ def upload_file(files, current_files):
     return instance_images
 
 
-def refresh_display():
+# The user id of the latest training started by each browser session, whose progress file the training logs show when the
+# training scheduler runs concurrent trainings.
+session_train_user_ids = {}
+
+
+def easyphoto_train_forward_in_session(request: gr.Request, sd_model_checkpoint, id_task, user_id, *args):
+    if request is not None:
+        session_train_user_ids[request.session_hash] = user_id
+    return easyphoto_train_forward(sd_model_checkpoint, id_task, user_id, *args)
+
+
+def refresh_display(request: gr.Request = None):
     if not os.path.exists(os.path.dirname(cache_log_file_path)):
         os.makedirs(os.path.dirname(cache_log_file_path), exist_ok=True)
     lines_limit = 3
     try:
-        with open(cache_log_file_path, "r", newline="") as f:
+        # The trainings run by the training scheduler write their own progress files, show the one of the user of this session.
+        log_file_path = cache_log_file_path
+        user_id = session_train_user_ids.get(request.session_hash, None) if request is not None else None
+        training_scheduler = get_training_scheduler(shared.opts.data.get("easyphoto_train_gpus", ""), os.path.dirname(cache_log_file_path))
+        if training_scheduler is not None and user_id is not None:
+            log_file_path = training_scheduler.job_progress_path(user_id)
+        with open(log_file_path, "r", newline="") as f:
             lines = []
             for s in f.readlines():
                 line = s.replace("\x00", "")
@@ -224,8 +242,9 @@ def refresh_display():
                 chatbot = [(None, "".join(lines[total_lines - lines_limit :]))]
             return chatbot
     except Exception:
-        with open(cache_log_file_path, "w") as f:
-            pass
+        if log_file_path == cache_log_file_path:
+            with open(cache_log_file_path, "w") as f:
+                pass
         return None
 
 
@@ -472,7 +491,7 @@ def on_ui_tabs():
                         refresh_button.click(fn=refresh_display, inputs=[], outputs=[logs_out])
 
                     run_button.click(
-                        fn=easyphoto_train_forward,
+                        fn=easyphoto_train_forward_in_session,
                         _js="ask_for_style_name",
                         inputs=[
                             sd_model_checkpoint,
@@ -2456,6 +2475,202 @@ def on_ui_settings():
             section=section,
         ),
     )
+    shared.opts.add_option(
+        "easyphoto_video_chunk_frames",
+        shared.OptionInfo(
+            0,
+            "Chunk size of video to video (Long videos are processed in overlapping chunks of this many frames to bound the memory, "
+            "0 means process the whole video at once.)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 8},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_video_chunk_overlap",
+        shared.OptionInfo(
+            4,
+            "Overlapped frames between chunks of video to video (The overlapped frames are cross-faded, at most the chunk size "
+            "minus one.)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_video_frame_store",
+        shared.OptionInfo(
+            "memory",
+            "Where to keep the intermediate frames of video inference (memmap keeps them in files under outputs/easyphoto-tmp, "
+            "shm keeps them in shared memory.)",
+            gr.Radio,
+            {"choices": ["memory", "memmap", "shm"]},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_motion_module_cache_mb",
+        shared.OptionInfo(
+            2048,
+            "Memory budget (MB) of the motion modules kept on CPU, switching to a cached motion module skips loading it from disk.",
+            gr.Slider,
+            {"minimum": 0, "maximum": 16384, "step": 256},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_animatediff_context_batch",
+        shared.OptionInfo(
+            1,
+            "Maximum number of AnimateDiff context windows stacked into one UNet forward (also limited by the free GPU memory).",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_animatediff_cn_resident_mb",
+        shared.OptionInfo(
+            2048,
+            "Memory budget (MB) of the ControlNet hints kept on the GPU during AnimateDiff sampling (0 copies each context "
+            "window to the GPU and back instead.)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 16384, "step": 256},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_animatediff_decode_chunk",
+        shared.OptionInfo(
+            1,
+            "Number of AnimateDiff frames decoded by the VAE at a time (0 decodes them with the webui default, without "
+            "streaming the frames to the post-processing).",
+            gr.Slider,
+            {"minimum": 0, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_sam_embedding_cache_size",
+        shared.OptionInfo(
+            8,
+            "Number of SAM image embeddings kept in memory for the try-on mask hints.",
+            gr.Slider,
+            {"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_sam_embedding_disk_cache",
+        shared.OptionInfo(
+            False,
+            "Also save the SAM image embeddings to outputs/easyphoto-tmp/sam_embeddings.",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_train_cache_latents",
+        shared.OptionInfo(
+            False,
+            "Encode the training images by the VAE once before the LoRA training instead of on every step (uses center crops).",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_train_worker",
+        shared.OptionInfo(
+            False,
+            "Run preprocessing and training in a persistent worker process that keeps the libraries and preprocessing models loaded.",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_train_gpus",
+        shared.OptionInfo(
+            "",
+            "GPU ids for concurrent trainings, e.g. 0,1,2,3 (one training per GPU, the others wait in a queue). Empty to train one at a time.",
+            gr.Textbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_train_incremental",
+        shared.OptionInfo(
+            False,
+            "Update the Lora of an existing user id incrementally with the new photos (kept only if the face id score improves).",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_train_incremental_steps_ratio",
+        shared.OptionInfo(
+            0.3,
+            "Ratio of the training steps of an incremental training to a full training.",
+            gr.Slider,
+            {"minimum": 0.1, "maximum": 1.0, "step": 0.05},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_train_early_stopping_patience",
+        shared.OptionInfo(
+            0,
+            "Stop training after this number of validations without improvement of the face id score (needs validation, 0 to disable).",
+            gr.Slider,
+            {"minimum": 0, "maximum": 10, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_tryon_diffusion_batch",
+        shared.OptionInfo(
+            4,
+            "Number of try-on samples diffused together in one batch (lower it if the try-on runs out of GPU memory).",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_tryon_lora_reuse",
+        shared.OptionInfo(
+            True,
+            "Reuse the cloth LoRA trained on the same reference image and mask instead of training a new one.",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_tryon_lora_reuse_distance",
+        shared.OptionInfo(
+            4,
+            "Max perceptual hash distance for a reference cloth to reuse a trained LoRA (0 only reuses exact duplicates).",
+            gr.Slider,
+            {"minimum": 0, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "easyphoto_video_postprocess_workers",
+        shared.OptionInfo(
+            0,
+            "Number of worker processes for the per-frame post-processing of video inference (0 runs it in the webui process, "
+            "the memory frame store is switched to shm when workers are used.)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
 
 
 script_callbacks.on_ui_settings(on_ui_settings)  # 注册进设置页
@@ -12,6 +12,7 @@ from .psgan_utils import PSGAN_Inference
 from .tryon_utils import (
     align_and_overlay_images,
     apply_mask_to_image,
+    ClothLoraRegistry,
     compute_rotation_angle,
     copy_white_mask_to_template,
     crop_image,
@@ -25,6 +26,7 @@ from .tryon_utils import (
     prepare_tryon_train_data,
     resize_and_stretch,
     resize_image_with_pad,
+    SamEmbeddingCache,
     seg_by_box,
     find_connected_components,
 )
@@ -48,9 +50,30 @@ from .common_utils import (
     cleanup_decorator,
     auto_to_gpu_model,
 )
+from .video_utils import (
+    FramePool,
+    FrameSequence,
+    FrameStore,
+    GifEncoder,
+    Mp4Encoder,
+    MultiFormatVideoWriter,
+    PngSequenceEncoder,
+    VideoEncoder,
+    WebpEncoder,
+    color_shift_frame,
+    face_fusion_frame,
+    get_mov_chunks,
+    get_video_encoder,
+    get_video_prefix,
+    paste_back_frame,
+    read_video_frames,
+    VideoChunkBlender,
+    VideoStreamWriter,
+)
 from .loractl_utils import check_loractl_conflict, LoraCtlScript
 from .animatediff_utils import (
     AnimateDiffControl,
+    AnimateDiffDecoder,
     AnimateDiffI2VLatent,
     AnimateDiffInfV2V,
     AnimateDiffLora,
@@ -6,7 +6,7 @@ from einops import rearrange
 from modules import hashes, shared, sd_models, devices
 from modules.devices import cpu, device, torch_gc
 
-from .motion_module import MotionWrapper, MotionModuleType
+from .motion_module import MotionWrapper, MotionModuleType, TemporalTransformer3DModel
 from .animatediff_logger import logger_animatediff as logger
 
 
@@ -77,6 +77,12 @@ class AnimateDiffMM:
             gn32_original_forward = self.gn32_original_forward
 
             def groupnorm32_mm_forward(self, x):
+                window_length = TemporalTransformer3DModel.window_length
+                if window_length is not None:
+                    # several context windows are stacked in the batch
+                    x = rearrange(x, "(b f) c h w -> b c f h w", f=window_length)
+                    x = gn32_original_forward(self, x)
+                    return rearrange(x, "b c f h w -> (b f) c h w", f=window_length)
                 x = rearrange(x, "(b f) c h w -> b c f h w", b=2)
                 x = gn32_original_forward(self, x)
                 x = rearrange(x, "b c f h w -> (b f) c h w", b=2)
@@ -113,6 +113,9 @@ class VanillaTemporalModule(nn.Module):
 
 
 class TemporalTransformer3DModel(nn.Module):
+    # Frames per context window, set while several context windows are stacked into one UNet forward.
+    window_length = None
+
     def __init__(
         self,
         in_channels,
@@ -164,7 +167,7 @@ class TemporalTransformer3DModel(nn.Module):
         self.proj_out = nn.Linear(inner_dim, in_channels)    
     
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
-        video_length = hidden_states.shape[0] // (2 if shared.opts.batch_cond_uncond else 1)
+        video_length = TemporalTransformer3DModel.window_length or hidden_states.shape[0] // (2 if shared.opts.batch_cond_uncond else 1)
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
 
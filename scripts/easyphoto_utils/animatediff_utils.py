@@ -5,8 +5,13 @@
 # rewrite AnimateDiffScript for easyphoto inject
 
 import copy
+import inspect
+import json
 import os
 import shutil
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
 from types import MethodType
 from typing import List, Optional
@@ -21,7 +26,7 @@ import torch
 from modules import (devices, hashes, images, img2img, masking, processing,
                      prompt_parser, scripts, sd_models, sd_samplers,
                      sd_samplers_common, shared)
-from modules.devices import device, dtype_vae, torch_gc
+from modules.devices import cpu, device, dtype_vae, torch_gc
 from modules.paths import data_path
 from modules.processing import (Processed, StableDiffusionProcessing,
                                 StableDiffusionProcessingImg2Img,
@@ -36,6 +41,9 @@ from PIL import Image, ImageFilter, ImageOps, PngImagePlugin
 from scripts.easyphoto_config import easyphoto_models_path
 from tqdm import tqdm
 
+from .video_utils import (GifEncoder, Mp4Encoder, MultiFormatVideoWriter,
+                          PngSequenceEncoder, WebpEncoder)
+
 try:
     from modules.sd_samplers_common import (approximation_indexes,
                                             images_tensor_to_samples)
@@ -48,6 +56,7 @@ try:
     from .animatediff.animatediff_logger import logger_animatediff as logger
     from .animatediff.animatediff_lora import AnimateDiffLora
     from .animatediff.animatediff_mm import AnimateDiffMM
+    from .animatediff.motion_module import TemporalTransformer3DModel
     from .animatediff.animatediff_output import AnimateDiffOutput
     from .animatediff.animatediff_prompt import AnimateDiffPromptSchedule
     from .animatediff.animatediff_ui import (AnimateDiffProcess,
@@ -61,11 +70,13 @@ except Exception as e:
     AnimateDiffInfV2V = None
     AnimateDiffLora = None
     AnimateDiffMM = None
+    TemporalTransformer3DModel = None
     AnimateDiffOutput = None
     AnimateDiffPromptSchedule = None
     AnimateDiffProcess = None
     AnimateDiffUiGroup = None
     AnimateDiffControl = None
+    AnimateDiffDecoder = None
     AnimateDiffI2VLatent = None
     motion_module = None
     video_visible = False
@@ -714,6 +725,36 @@ if video_visible:
                     else:
                         yield [e % video_length for e in range(j, j + batch_size * context_step, context_step)]
 
+        # All the context windows of a step as a [num_windows, batch_size] index tensor, computed once per setting
+        @staticmethod
+        @lru_cache(maxsize=1024)
+        def context_schedule(step, video_length, batch_size, stride, overlap, loop_setting):
+            return torch.tensor(
+                list(AnimateDiffInfV2V.uniform(step, video_length, batch_size, stride, overlap, loop_setting)), dtype=torch.long
+            )
+
+        # Stack every `group_size` context windows into one UNet forward. Returns a list of (index, keep), where index
+        # is the flattened batch of the group and keep is the last occurrence of each latent in it, so that the result
+        # is the same as running the windows one by one, where a later window overwrites an earlier one.
+        @staticmethod
+        @lru_cache(maxsize=1024)
+        def context_groups(step, video_length, batch_size, stride, overlap, loop_setting, group_size, batch_cond_uncond):
+            windows = AnimateDiffInfV2V.context_schedule(step, video_length, batch_size, stride, overlap, loop_setting)
+            if batch_cond_uncond:
+                windows = torch.cat([windows, windows + video_length], dim=1)
+            groups = []
+            for start in range(0, len(windows), group_size):
+                index = windows[start : start + group_size].reshape(-1)
+                _, first_in_reversed = np.unique(index.numpy()[::-1], return_index=True)
+                keep = torch.from_numpy(np.sort(len(index) - 1 - first_in_reversed))
+                groups.append((index, keep))
+            return groups
+
+        # Measured memory of one context window in a UNet forward, keyed by latent shape and window size.
+        window_memory = {}
+        # Memory of the ControlNet hints kept on the device during the current sampling run.
+        cn_resident_mb = 0
+
         def hack(self, params: AnimateDiffProcess):
             if AnimateDiffInfV2V.cfg_original_forward is not None:
                 logger.info("CFGDenoiser already hacked")
@@ -721,33 +762,53 @@ if video_visible:
 
             logger.info(f"Hacking CFGDenoiser forward function.")
             AnimateDiffInfV2V.cfg_original_forward = CFGDenoiser.forward
+            AnimateDiffInfV2V.cn_resident_mb = 0
             cn_script = self.cn_script
             prompt_scheduler = self.prompt_scheduler
 
-            def mm_cn_select(context: List[int]):
+            def mm_cn_resident(hint):
+                # Keep the full hints of the video on the ControlNet device for the whole sampling run, so that a context
+                # window is an index on the device instead of a copy to the device and back. Hints that do not fit in the
+                # memory budget stay on CPU.
+                cn_device = devices.get_device_for("controlnet")
+                if hint.device.type == torch.device(cn_device).type or torch.device(cn_device).type == "cpu":
+                    return hint
+                resident_mb = shared.opts.data.get("easyphoto_animatediff_cn_resident_mb", 2048)
+                hint_mb = hint.numel() * hint.element_size() / 1024**2
+                if AnimateDiffInfV2V.cn_resident_mb + hint_mb > resident_mb:
+                    return hint
+                AnimateDiffInfV2V.cn_resident_mb += hint_mb
+                return hint.to(device=cn_device)
+
+            def mm_cn_select(context: List[int], grouped: bool = False):
                 # take control images for current context.
+                # The index of a group of context windows can be as long as the hints or longer, so the per-frame hints
+                # of a group are always indexed, only a single shared hint is kept as is.
+                def per_frame(hint_length):
+                    return hint_length > 1 if grouped else hint_length > len(context)
+
                 if cn_script and cn_script.latest_network:
                     from scripts.hook import ControlModelType
                     for control in cn_script.latest_network.control_params:
                         if control.control_model_type not in [ControlModelType.IPAdapter, ControlModelType.Controlllite]:
-                            if control.hint_cond.shape[0] > len(context):
-                                control.hint_cond_backup = control.hint_cond
-                                control.hint_cond = control.hint_cond[context]
+                            if per_frame(control.hint_cond.shape[0]):
+                                control.hint_cond_backup = mm_cn_resident(control.hint_cond)
+                                control.hint_cond = control.hint_cond_backup[context]
                             control.hint_cond = control.hint_cond.to(device=devices.get_device_for("controlnet"))
                             if control.hr_hint_cond is not None:
-                                if control.hr_hint_cond.shape[0] > len(context):
-                                    control.hr_hint_cond_backup = control.hr_hint_cond
-                                    control.hr_hint_cond = control.hr_hint_cond[context]
+                                if per_frame(control.hr_hint_cond.shape[0]):
+                                    control.hr_hint_cond_backup = mm_cn_resident(control.hr_hint_cond)
+                                    control.hr_hint_cond = control.hr_hint_cond_backup[context]
                                 control.hr_hint_cond = control.hr_hint_cond.to(device=devices.get_device_for("controlnet"))
                         # IPAdapter and Controlllite are always on CPU.
-                        elif control.control_model_type == ControlModelType.IPAdapter and control.control_model.image_emb.shape[0] > len(context):
+                        elif control.control_model_type == ControlModelType.IPAdapter and per_frame(control.control_model.image_emb.shape[0]):
                             control.control_model.image_emb_backup = control.control_model.image_emb
                             control.control_model.image_emb = control.control_model.image_emb[context]
                             control.control_model.uncond_image_emb_backup = control.control_model.uncond_image_emb
                             control.control_model.uncond_image_emb = control.control_model.uncond_image_emb
                         elif control.control_model_type == ControlModelType.Controlllite:
                             for module in control.control_model.modules.values():
-                                if module.cond_image.shape[0] > len(context):
+                                if per_frame(module.cond_image.shape[0]):
                                     module.cond_image_backup = module.cond_image
                                     module.set_cond_image(module.cond_image[context])
             
@@ -757,11 +818,12 @@ if video_visible:
                     from scripts.hook import ControlModelType
                     for control in cn_script.latest_network.control_params:
                         if control.control_model_type not in [ControlModelType.IPAdapter, ControlModelType.Controlllite]:
+                            # resident hints are written back on the device, the others go back to CPU
                             if getattr(control, "hint_cond_backup", None) is not None:
-                                control.hint_cond_backup[context] = control.hint_cond.to(device="cpu")
+                                control.hint_cond_backup[context] = control.hint_cond.to(device=control.hint_cond_backup.device)
                                 control.hint_cond = control.hint_cond_backup
                             if control.hr_hint_cond is not None and getattr(control, "hr_hint_cond_backup", None) is not None:
-                                control.hr_hint_cond_backup[context] = control.hr_hint_cond.to(device="cpu")
+                                control.hr_hint_cond_backup[context] = control.hr_hint_cond.to(device=control.hr_hint_cond_backup.device)
                                 control.hr_hint_cond = control.hr_hint_cond_backup
                         elif control.control_model_type == ControlModelType.IPAdapter and getattr(control.control_model, "image_emb_backup", None) is not None:
                             control.control_model.image_emb = control.control_model.image_emb_backup
@@ -771,21 +833,47 @@ if video_visible:
                                 if getattr(module, "cond_image_backup", None) is not None:
                                     module.set_cond_image(module.cond_image_backup)
 
+            def mm_group_size(x_in, num_windows):
+                # Number of context windows in one UNet forward, limited by the setting and by the free device memory.
+                max_windows = int(shared.opts.data.get("easyphoto_animatediff_context_batch", 1))
+                if max_windows <= 1 or num_windows <= 1:
+                    return 1
+                if not torch.cuda.is_available():
+                    return min(max_windows, num_windows)
+                window_memory = AnimateDiffInfV2V.window_memory.get((tuple(x_in.shape[1:]), params.batch_size), None)
+                if window_memory is None:
+                    # the first window runs alone to measure its memory
+                    return 1
+                free_memory, _ = torch.cuda.mem_get_info()
+                return max(1, min(max_windows, num_windows, int(free_memory * 0.8 // window_memory)))
+
             def mm_sd_forward(self, x_in, sigma_in, cond_in, image_cond_in, make_condition_dict):
                 x_out = torch.zeros_like(x_in)
-                for context in AnimateDiffInfV2V.uniform(self.step, params.video_length, params.batch_size, params.stride, params.overlap, params.closed_loop):
-                    if shared.opts.batch_cond_uncond:
-                        _context = context + [c + params.video_length for c in context]
-                    else:
-                        _context = context
-                    mm_cn_select(_context)
-                    out = self.inner_model(
-                        x_in[_context], sigma_in[_context],
-                        cond=make_condition_dict(
-                            cond_in[_context] if not isinstance(cond_in, dict) else {k: v[_context] for k, v in cond_in.items()},
-                            image_cond_in[_context]))
+                windows = AnimateDiffInfV2V.context_schedule(self.step, params.video_length, params.batch_size, params.stride, params.overlap, params.closed_loop)
+                group_size = mm_group_size(x_in, len(windows))
+                measure = group_size == 1 and int(shared.opts.data.get("easyphoto_animatediff_context_batch", 1)) > 1 and torch.cuda.is_available()
+                for _context, _keep in AnimateDiffInfV2V.context_groups(
+                    self.step, params.video_length, params.batch_size, params.stride, params.overlap, params.closed_loop, group_size, shared.opts.batch_cond_uncond
+                ):
+                    mm_cn_select(_context, grouped=group_size > 1)
+                    if measure:
+                        torch.cuda.reset_peak_memory_stats()
+                        memory_before = torch.cuda.memory_allocated()
+                    if group_size > 1:
+                        TemporalTransformer3DModel.window_length = params.batch_size
+                    try:
+                        out = self.inner_model(
+                            x_in[_context], sigma_in[_context],
+                            cond=make_condition_dict(
+                                cond_in[_context] if not isinstance(cond_in, dict) else {k: v[_context] for k, v in cond_in.items()},
+                                image_cond_in[_context]))
+                    finally:
+                        TemporalTransformer3DModel.window_length = None
+                    if measure:
+                        AnimateDiffInfV2V.window_memory[(tuple(x_in.shape[1:]), params.batch_size)] = torch.cuda.max_memory_allocated() - memory_before
+                        measure = False
                     x_out = x_out.to(dtype=out.dtype)
-                    x_out[_context] = out
+                    x_out[_context[_keep]] = out[_keep]
                     mm_cn_restore(_context)
                 return x_out
 
@@ -943,6 +1031,15 @@ if video_visible:
             CFGDenoiser.forward = AnimateDiffInfV2V.cfg_original_forward
             AnimateDiffInfV2V.cfg_original_forward = None
 
+            # release the hints kept on the device
+            if self.cn_script and self.cn_script.latest_network and AnimateDiffInfV2V.cn_resident_mb > 0:
+                for control in self.cn_script.latest_network.control_params:
+                    for name in ["hint_cond", "hr_hint_cond"]:
+                        if getattr(control, f"{name}_backup", None) is not None and getattr(control, name) is not None:
+                            setattr(control, name, getattr(control, name).to(device="cpu"))
+                            setattr(control, f"{name}_backup", None)
+            AnimateDiffInfV2V.cn_resident_mb = 0
+
 
     class AnimateDiffOutput(AnimateDiffOutput):
         def output(self, p: StableDiffusionProcessing, res: Processed, params: AnimateDiffProcess):
@@ -979,107 +1076,87 @@ if video_visible:
             res: Processed,
             index: int,
         ):
+            # All the requested formats are encoded in a single pass over the frames, each encoder in its own thread.
             video_paths = []
-            video_array = [np.array(v) for v in video_list]
+            encoders = []
             infotext = None
-            use_infotext = shared.opts.enable_pnginfo and infotext is not None
             if "PNG" in params.format and shared.opts.data.get("animatediff_save_to_custom", False):
-                Path(video_path_prefix).mkdir(exist_ok=True, parents=True)
-                for i, frame in enumerate(video_list):
-                    png_filename = f"{video_path_prefix}/{i:05}.png"
-                    png_info = PngImagePlugin.PngInfo()
-                    png_info.add_text("parameters", "")
-                    imageio.imwrite(png_filename, frame, pnginfo=png_info)
+                encoders.append(PngSequenceEncoder(video_path_prefix, params.fps, pnginfo={"parameters": ""}))
 
             if "GIF" in params.format:
                 video_path_gif = video_path_prefix + ".gif"
                 video_paths.append(video_path_gif)
-                if shared.opts.data.get("animatediff_optimize_gif_palette", False):
-                    try:
-                        pass
-                    except ImportError:
-                        from launch import run_pip
-
-                        run_pip(
-                            "install imageio[pyav]",
-                            "sd-webui-animatediff GIF palette optimization requirement: imageio[pyav]",
-                        )
-                    imageio.imwrite(
-                        video_path_gif,
-                        video_array,
-                        plugin="pyav",
-                        fps=params.fps,
-                        codec="gif",
-                        out_pixel_format="pal8",
-                        filter_graph=(
-                            {"split": ("split", ""), "palgen": ("palettegen", ""), "paluse": ("paletteuse", ""), "scale": ("scale", f"{video_list[0].width}:{video_list[0].height}")},
-                            [
-                                ("video_in", "scale", 0, 0),
-                                ("scale", "split", 0, 0),
-                                ("split", "palgen", 1, 0),
-                                ("split", "paluse", 0, 0),
-                                ("palgen", "paluse", 0, 1),
-                                ("paluse", "video_out", 0, 0),
-                            ],
-                        ),
-                    )
-                    # imageio[pyav].imwrite doesn't support comment parameter
-                    if use_infotext:
-                        try:
-                            import exiftool
-                        except ImportError:
-                            from launch import run_pip
-
-                            run_pip(
-                                "install PyExifTool",
-                                "sd-webui-animatediff GIF palette optimization requirement: PyExifTool",
-                            )
-                            import exiftool
-                        finally:
-                            try:
-                                exif_tool = exiftool.ExifTool()
-                                with exif_tool:
-                                    escaped_infotext = infotext.replace("\n", r"\n")
-                                    exif_tool.execute("-overwrite_original", f"-Comment={escaped_infotext}", video_path_gif)
-                            except FileNotFoundError:
-                                logger.warn("exiftool not found, required for infotext with optimized GIF palette, try: apt install libimage-exiftool-perl or https://exiftool.org/")
-                else:
-                    imageio.imwrite(video_path_gif, video_array, plugin="pillow", duration=(1000 / params.fps), loop=params.loop_number, comment=(infotext if use_infotext else ""))
-                if shared.opts.data.get("animatediff_optimize_gif_gifsicle", False):
-                    self._optimize_gif(video_path_gif)
+                palette = "global" if shared.opts.data.get("animatediff_optimize_gif_palette", False) else "pillow"
+                encoders.append(GifEncoder(video_path_gif, params.fps, palette=palette, loop=params.loop_number))
             if "MP4" in params.format:
                 video_path_mp4 = video_path_prefix + ".mp4"
                 video_paths.append(video_path_mp4)
-                try:
-                    imageio.imwrite(video_path_mp4, video_array, fps=params.fps, codec="h264")
-                except Exception:
-                    from launch import run_pip
-
-                    run_pip(
-                        "install imageio[ffmpeg]",
-                        "sd-webui-animatediff save mp4 requirement: imageio[ffmpeg]",
-                    )
-                    imageio.imwrite(video_path_mp4, video_array, fps=params.fps, codec="h264")
+                options = {"crf": str(shared.opts.data.get("animatediff_mp4_crf", 23))}
+                for option in ["preset", "tune"]:
+                    if shared.opts.data.get(f"animatediff_mp4_{option}", "") != "":
+                        options[option] = shared.opts.data.get(f"animatediff_mp4_{option}", "")
+                encoders.append(Mp4Encoder(video_path_mp4, params.fps, options=options))
             if "TXT" in params.format and res.images[index].info is not None:
                 video_path_txt = video_path_prefix + ".txt"
-                self._save_txt(video_path_txt, infotext)
+                with open(video_path_txt, "w", encoding="utf8") as file:
+                    file.write(f"{infotext}\n")
             if "WEBP" in params.format:
                 if PIL.features.check("webp_anim"):
                     video_path_webp = video_path_prefix + ".webp"
                     video_paths.append(video_path_webp)
-                    exif_bytes = b""
-                    if use_infotext:
-                        exif_bytes = piexif.dump({"Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(infotext, encoding="unicode")}})
                     lossless = shared.opts.data.get("animatediff_webp_lossless", False)
                     quality = shared.opts.data.get("animatediff_webp_quality", 80)
                     logger.info(f"Saving {video_path_webp} with lossless={lossless} and quality={quality}")
-                    imageio.imwrite(video_path_webp, video_array, plugin="pillow", duration=int(1 / params.fps * 1000), loop=params.loop_number, lossless=lossless, quality=quality, exif=exif_bytes)
+                    encoders.append(WebpEncoder(video_path_webp, params.fps, loop=params.loop_number, lossless=lossless, quality=quality))
                     # see additional Pillow WebP options at https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#webp
                 else:
                     logger.warn("WebP animation in Pillow requires system WebP library v0.5.0 or later")
+
+            if len(encoders) > 0:
+                video_writer = MultiFormatVideoWriter(encoders)
+                video_writer.write_all(video_list)
+                video_writer.close()
+            if "GIF" in params.format and shared.opts.data.get("animatediff_optimize_gif_gifsicle", False):
+                self._optimize_gif(video_path_gif)
             return video_paths
 
     class AnimateDiffMM(AnimateDiffMM):
+        # Motion modules kept in memory as ready-cast CPU modules, ordered from the least to the most recently used.
+        mm_cache = OrderedDict()
+
+        def _mm_hash(self, model_path, model_name):
+            # The hashes are persisted next to the models and keyed by size and mtime, so a model is hashed only once.
+            hash_file = os.path.join(self.script_dir, "motion_module_hashes.json")
+            stat = os.stat(model_path)
+            try:
+                with open(hash_file, "r", encoding="utf-8") as f:
+                    mm_hashes = json.load(f)
+            except Exception:
+                mm_hashes = {}
+            cached = mm_hashes.get(model_name, {})
+            if cached.get("size") == stat.st_size and cached.get("mtime") == stat.st_mtime:
+                return cached["sha256"]
+
+            model_hash = hashes.calculate_sha256(model_path)
+            mm_hashes[model_name] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": model_hash}
+            try:
+                with open(hash_file, "w", encoding="utf-8") as f:
+                    json.dump(mm_hashes, f, indent=4)
+            except Exception as e:
+                logger.warn(f"Save motion module hashes to {hash_file} error: {e}")
+            return model_hash
+
+        def _evict(self, keep_name):
+            # LRU by memory budget, the motion module in use is always kept.
+            def mm_size(mm):
+                return sum(t.numel() * t.element_size() for t in list(mm.parameters()) + list(mm.buffers()))
+
+            cache_size = shared.opts.data.get("easyphoto_motion_module_cache_mb", 2048) * 1024**2
+            while len(AnimateDiffMM.mm_cache) > 1 and sum(mm_size(mm) for mm in AnimateDiffMM.mm_cache.values()) > cache_size:
+                name = next(name for name in AnimateDiffMM.mm_cache.keys() if name != keep_name)
+                logger.info(f"Release motion module {name} from cache.")
+                del AnimateDiffMM.mm_cache[name]
+
         def _load(self, model_name):
             from .animatediff.motion_module import (MotionModuleType,
                                                     MotionWrapper)
@@ -1088,17 +1165,34 @@ if video_visible:
             if not os.path.isfile(model_path):
                 raise RuntimeError("Please download models manually.")
             if self.mm is None or self.mm.mm_name != model_name:
-                logger.info(f"Loading motion module {model_name} from {model_path}")
-                model_hash = hashes.sha256(model_path, f"AnimateDiff/{model_name}")
-                mm_state_dict = sd_models.read_state_dict(model_path)
-                model_type = MotionModuleType.get_mm_type(mm_state_dict)
-                logger.info(f"Guessed {model_name} architecture: {model_type}")
-                self.mm = MotionWrapper(model_name, model_hash, model_type)
-                missed_keys = self.mm.load_state_dict(mm_state_dict)
-                logger.warn(f"Missing keys {missed_keys}")
+                # The motion module in use goes back to the cache on CPU, a later switch back is a device copy.
+                if self.mm is not None:
+                    self.mm.to(cpu)
+                if model_name in AnimateDiffMM.mm_cache:
+                    logger.info(f"Use cached motion module {model_name}")
+                    self.mm = AnimateDiffMM.mm_cache[model_name]
+                else:
+                    logger.info(f"Loading motion module {model_name} from {model_path}")
+                    model_hash = self._mm_hash(model_path, model_name)
+                    mm_state_dict = sd_models.read_state_dict(model_path)
+                    model_type = MotionModuleType.get_mm_type(mm_state_dict)
+                    logger.info(f"Guessed {model_name} architecture: {model_type}")
+                    self.mm = MotionWrapper(model_name, model_hash, model_type)
+                    missed_keys = self.mm.load_state_dict(mm_state_dict)
+                    logger.warn(f"Missing keys {missed_keys}")
+                    del mm_state_dict
+                    # cast once on CPU, so that moving to the device is a plain copy
+                    self.mm.eval()
+                    if not shared.cmd_opts.no_half:
+                        self.mm.half()
+                    AnimateDiffMM.mm_cache[model_name] = self.mm
+                AnimateDiffMM.mm_cache.move_to_end(model_name)
+                self._evict(model_name)
             self.mm.to(device).eval()
-            if not shared.cmd_opts.no_half:
-                self.mm.half()
+
+        def remove(self):
+            AnimateDiffMM.mm_cache.clear()
+            super().remove()
 
     motion_module = AnimateDiffMM()
     motion_module.set_script_dir(easyphoto_models_path)
@@ -1278,3 +1372,86 @@ if video_visible:
                 p.init_latent = (p.init_latent * init_alpha + last_latent * last_alpha + p.rng.next() * (1 - init_alpha - last_alpha)) * reserve_scale + p.rng.next() * (1 - reserve_scale)
             else:
                 p.init_latent = p.init_latent * reserve_scale + p.rng.next() * (1 - reserve_scale)
+
+
+    class AnimateDiffDecoder:
+        """Decode the latents of an AnimateDiff video N frames at a time.
+
+        The webui decodes the whole batch before the images are returned. During AnimateDiff sampling the decode is
+        replaced by a chunked one: every chunk is one batched VAE call and is moved to CPU before the next one starts. The
+        peak memory of the decode only depends on the chunk size, and the decode throughput is logged for each chunk size.
+
+        If `AnimateDiffDecoder.consumer` (a callable of (start_index, images)) is set, every chunk is also passed to it as
+        the webui finishes the images (color correction and overlay of the unmasked area), so that the caller can store or
+        encode the frames while the rest of the video is decoded. Nothing is streamed with face restoration, which the
+        webui runs on the whole batch.
+        """
+
+        original_decode_latent_batch = None
+        consumer = None
+        # the processing of the current video, whose images are streamed
+        p = None
+
+        def hack(self, p: StableDiffusionProcessing):
+            AnimateDiffDecoder.p = p
+            if AnimateDiffDecoder.original_decode_latent_batch is not None:
+                logger.info("decode_latent_batch already hacked.")
+                return
+
+            logger.info("Hacking decode_latent_batch.")
+            AnimateDiffDecoder.original_decode_latent_batch = processing.decode_latent_batch
+            original_decode_latent_batch = processing.decode_latent_batch
+
+            def mm_finish_image(index, sample):
+                # The same steps as process_images_inner after the decode.
+                p = AnimateDiffDecoder.p
+                image = Image.fromarray(np.uint8(torch.clamp((sample.float() + 1.0) / 2.0, 0.0, 1.0).permute(1, 2, 0).cpu().numpy() * 255))
+                if getattr(p, "color_corrections", None) is not None and index < len(p.color_corrections):
+                    image = processing.apply_color_correction(p.color_corrections[index], image)
+                overlay_images = getattr(p, "overlay_images", None)
+                if len(inspect.signature(processing.apply_overlay).parameters) == 4:
+                    return processing.apply_overlay(image, p.paste_to, index, overlay_images)
+                # since webui v1.8.0, the overlay of the image is passed and the image before the overlay is returned too
+                overlay_image = overlay_images[index] if overlay_images is not None and index < len(overlay_images) else None
+                return processing.apply_overlay(image, p.paste_to, overlay_image)[0]
+
+            def mm_decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
+                chunk_size = int(shared.opts.data.get("easyphoto_animatediff_decode_chunk", 1))
+                stream = AnimateDiffDecoder.consumer is not None and not getattr(AnimateDiffDecoder.p, "restore_faces", False)
+                if chunk_size <= 0 or (batch.shape[0] <= 1 and not stream):
+                    return original_decode_latent_batch(model, batch, target_device=target_device, check_for_nans=check_for_nans)
+
+                # an empty call returns the container type of this webui version
+                samples = original_decode_latent_batch(model, batch[:0], target_device=target_device, check_for_nans=check_for_nans)
+                start_time = time.time()
+                for start in range(0, batch.shape[0], chunk_size):
+                    chunk = batch[start : start + chunk_size]
+                    try:
+                        decoded = processing.decode_first_stage(model, chunk)
+                        if check_for_nans:
+                            devices.test_for_nans(decoded, "vae")
+                        decoded = list(decoded.to(target_device) if target_device is not None else decoded)
+                    except devices.NansException:
+                        # the original decode knows how to retry with a float32 VAE
+                        decoded = original_decode_latent_batch(model, chunk, target_device=target_device, check_for_nans=check_for_nans)
+                    samples.extend(decoded)
+
+                    if stream:
+                        AnimateDiffDecoder.consumer(start, [mm_finish_image(start + offset, sample) for offset, sample in enumerate(decoded)])
+
+                elapsed = max(time.time() - start_time, 1e-6)
+                logger.info(f"Decoded {batch.shape[0]} frames in chunks of {chunk_size}: {elapsed:.2f}s, {batch.shape[0] / elapsed:.2f} frames/s.")
+                return samples
+
+            processing.decode_latent_batch = mm_decode_latent_batch
+
+        def restore(self):
+            if AnimateDiffDecoder.original_decode_latent_batch is None:
+                logger.info("decode_latent_batch already restored.")
+                return
+
+            logger.info("Restoring decode_latent_batch.")
+            processing.decode_latent_batch = AnimateDiffDecoder.original_decode_latent_batch
+            AnimateDiffDecoder.original_decode_latent_batch = None
+            AnimateDiffDecoder.p = None
+
@@ -0,0 +1,88 @@
+"""
+Affine geometry kernels of the try-on: the transforms of an image are composed into one 3x3 matrix and the image is
+warped once, only in the bounding box of the destination it covers.
+
+The matrices map pixel centers to pixel centers as cv2.warpAffine does, the pixel (0, 0) covers [-0.5, 0.5]^2.
+"""
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+
+def stretch_affine(src_size: Tuple[int, int], target_size: Tuple[int, int]) -> np.ndarray:
+    """
+    Get the 3x3 affine matrix that fits an image of src_size (width, height) to the center of target_size, keeping the
+    aspect ratio as resize_and_stretch does.
+    """
+    width, height = src_size
+    aspect_ratio = width / height
+    new_width = max(int(min(target_size[0], target_size[1] * aspect_ratio)), 1)
+    new_height = max(int(min(target_size[1], target_size[0] / aspect_ratio)), 1)
+    offset_x = (target_size[0] - new_width) // 2
+    offset_y = (target_size[1] - new_height) // 2
+
+    # Map the pixel centers as cv2.resize does.
+    sx, sy = new_width / width, new_height / height
+    return np.array([[sx, 0, 0.5 * sx - 0.5 + offset_x], [0, sy, 0.5 * sy - 0.5 + offset_y], [0, 0, 1]], dtype=np.float64)
+
+
+def compose_affine(*matrices: np.ndarray) -> np.ndarray:
+    """Compose 2x3 or 3x3 affine matrices, the first one is applied first. Returns a 3x3 matrix."""
+    result = np.eye(3)
+    for matrix in matrices:
+        matrix = np.asarray(matrix, dtype=np.float64)
+        if matrix.shape == (2, 3):
+            matrix = np.vstack([matrix, [0, 0, 1]])
+        result = matrix @ result
+    return result
+
+
+def affine_bounds(matrix: np.ndarray, size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    Get the box (left, upper, right, lower) of the destination pixels that an image of size (width, height) warped by
+    matrix touches, including the pixels its bilinear edges blend into.
+    """
+    width, height = size
+    corners = np.array([[-0.5, -0.5, 1], [width - 0.5, -0.5, 1], [width - 0.5, height - 0.5, 1], [-0.5, height - 0.5, 1]])
+    corners = (np.asarray(matrix, dtype=np.float64)[:2] @ corners.T).T
+    left, upper = np.floor(corners.min(axis=0)).astype(int)
+    right, lower = np.ceil(corners.max(axis=0)).astype(int) + 1
+    return int(left), int(upper), int(right), int(lower)
+
+
+def intersect_box(*boxes: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+    """The intersection of boxes (left, upper, right, lower), it is empty when right <= left or lower <= upper."""
+    boxes = np.array(boxes)
+    return int(boxes[:, 0].max()), int(boxes[:, 1].max()), int(boxes[:, 2].min()), int(boxes[:, 3].min())
+
+
+def warp_affine_roi(
+    img: np.ndarray,
+    matrix: np.ndarray,
+    box: Tuple[int, int, int, int],
+    interpolation: int = cv2.INTER_LINEAR,
+    border_value: Tuple[int, ...] = (0, 0, 0),
+) -> np.ndarray:
+    """
+    Warp img by matrix and return only the box (left, upper, right, lower) of the destination.
+
+    Args:
+        img (np.ndarray): The input image or mask.
+        matrix (np.ndarray): The 2x3 or 3x3 affine matrix from img to the whole destination.
+        box (Tuple[int, int, int, int]): The box of the destination to compute, it should not be empty.
+        interpolation (int, optional): The interpolation of cv2.warpAffine (default is cv2.INTER_LINEAR).
+        border_value (Tuple[int, ...], optional): The value outside img (default is black).
+
+    Returns:
+        np.ndarray: The box of the warped image.
+    """
+    roi_matrix = compose_affine(matrix, [[1, 0, -box[0]], [0, 1, -box[1]]])[:2]
+    return cv2.warpAffine(
+        img,
+        roi_matrix,
+        (box[2] - box[0], box[3] - box[1]),
+        flags=interpolation,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=border_value,
+    )
@@ -0,0 +1,733 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from itertools import repeat
+from multiprocessing import shared_memory
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+from .common_utils import ep_logger
+from .face_process_utils import color_transfer
+
+
+def get_mov_chunks(file: str, required_fps: int, chunk_frames: int, overlap: int, max_frames: int = -1) -> tuple:
+    """Lazily extract frames from a video file in overlapping chunks.
+
+    Frames are sampled uniformly in the same way as `get_mov_all_images`, but only the frames of the current chunk
+    are kept in memory. Consecutive chunks share `overlap` frames so that their diffusion results can be cross-faded.
+
+    Args:
+        file (str): The path to the video file.
+        required_fps (int): The required frame per second to extract.
+        chunk_frames (int): The number of frames in each chunk.
+        overlap (int): The number of frames shared by two consecutive chunks.
+        max_frames (int): The maximum number of frames to extract, -1 means all frames.
+
+    Returns:
+        chunks (Iterator[List[np.ndarray]]): A generator yielding lists of RGB frames.
+        required_fps (int): The actual fps after extracting a specific number of frames uniformly from a video file.
+    """
+    if file is None:
+        return None
+    cap = cv2.VideoCapture(file)
+    if not cap.isOpened():
+        return None
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    # Frames cannot be greater than the actual fps for sampling
+    if required_fps > fps:
+        print("Waring: The set number of frames is greater than the number of video frames")
+        required_fps = fps
+    if overlap >= chunk_frames:
+        raise ValueError(f"The chunk overlap ({overlap}) must be smaller than the chunk size ({chunk_frames}).")
+
+    num_pics = int(required_fps / fps * total_frames)
+    target_indexs = np.int64(np.rint(np.linspace(0, total_frames - 1, num=num_pics)))
+    if max_frames != -1:
+        target_indexs = target_indexs[:max_frames]
+
+    def _chunks():
+        cap = cv2.VideoCapture(file)
+        # The number of times each source frame is sampled, duplicated indexes are kept as the original function does.
+        wanted = np.bincount(target_indexs, minlength=total_frames) if len(target_indexs) > 0 else np.zeros([0], np.int64)
+        chunk = []
+        frame_idx = 0
+        sampled = 0
+        try:
+            while sampled < len(target_indexs):
+                flag, frame = cap.read()
+                if not flag:
+                    break
+                if frame_idx < len(wanted) and wanted[frame_idx] > 0:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    for _ in range(wanted[frame_idx]):
+                        chunk.append(frame)
+                        sampled += 1
+                        if len(chunk) == chunk_frames:
+                            yield chunk
+                            chunk = chunk[chunk_frames - overlap :] if overlap > 0 else []
+                frame_idx += 1
+            # The last chunk only contains the overlapped frames which have been yielded before.
+            if len(chunk) > overlap or (sampled <= overlap and len(chunk) > 0):
+                yield chunk
+        finally:
+            cap.release()
+
+    return _chunks(), required_fps
+
+
+class VideoChunkBlender:
+    """Stitch the results of overlapping video chunks with a linear cross-fade.
+
+    The last `overlap` frames of each chunk are held back until the next chunk arrives, so only `overlap` frames are
+    buffered no matter how long the video is.
+    """
+
+    def __init__(self, overlap: int):
+        self.overlap = overlap
+        self.pending = []
+        self.pending_start = 0
+
+    def push(self, start: int, frames: List[Union[Image.Image, np.ndarray]]) -> List[Image.Image]:
+        """Add the frames of a chunk starting at frame index `start`, and return the frames that are finished."""
+        finished = []
+        if len(self.pending) > 0 and start >= self.pending_start + len(self.pending):
+            # The chunks are not overlapped (e.g. the previous chunk failed), emit the held frames as they are.
+            finished += self.flush()
+
+        frames = [np.array(frame, np.float32) for frame in frames]
+        # Emit the held frames before `start`, then cross-fade the overlapped part.
+        held_before = max(start - self.pending_start, 0)
+        finished += [Image.fromarray(np.uint8(frame)) for frame in self.pending[:held_before]]
+        overlapped = self.pending[held_before:]
+        for idx, pending_frame in enumerate(overlapped):
+            if idx >= len(frames):
+                break
+            alpha = (idx + 1) / (len(overlapped) + 1)
+            frames[idx] = pending_frame * (1 - alpha) + frames[idx] * alpha
+
+        keep = min(self.overlap, len(frames))
+        finished += [Image.fromarray(np.uint8(np.clip(frame, 0, 255))) for frame in frames[: len(frames) - keep]]
+        self.pending = frames[len(frames) - keep :]
+        self.pending_start = start + len(frames) - keep
+        return finished
+
+    def flush(self) -> List[Image.Image]:
+        """Return all the held frames."""
+        finished = [Image.fromarray(np.uint8(np.clip(frame, 0, 255))) for frame in self.pending]
+        self.pending_start += len(self.pending)
+        self.pending = []
+        return finished
+
+
+def get_video_prefix(path: str) -> str:
+    """Return the next output prefix in `path`, numbered in the same way as `convert_to_video`."""
+    os.makedirs(path, exist_ok=True)
+    return str(len(os.listdir(path)) + 1).zfill(8)
+
+
+def _gif_filter_graph(palette: str = "global") -> tuple:
+    # global: one palette for the whole clip, which ffmpeg builds when the stream ends.
+    # single: a new palette for every frame, so that nothing is buffered.
+    palgen, paluse = ("", "") if palette == "global" else ("stats_mode=single", "new=1")
+    return (
+        {
+            "split": ("split", ""),
+            "palgen": ("palettegen", palgen),
+            "paluse": ("paletteuse", paluse),
+        },
+        [
+            ("video_in", "split", 0, 0),
+            ("split", "palgen", 1, 0),
+            ("split", "paluse", 0, 0),
+            ("palgen", "paluse", 0, 1),
+            ("paluse", "video_out", 0, 0),
+        ],
+    )
+
+
+class VideoStreamWriter:
+    """Encode frames into a gif or mp4 file one by one, so that the whole video never needs to be in memory.
+
+    The output naming is consistent with `convert_to_video`. GIF uses a per-frame palette so that the encoder does not
+    buffer the whole clip for palette generation.
+    """
+
+    def __init__(self, path: str, fps: int, prefix: Optional[str] = None, mode: str = "gif"):
+        os.makedirs(path, exist_ok=True)
+        self.prefix = get_video_prefix(path) if prefix is None else prefix
+        self.mode = mode
+        self.video_path = os.path.join(path, self.prefix + f".{mode}")
+        if mode == "gif":
+            self.encoder = GifEncoder(self.video_path, fps, palette="single")
+        else:
+            self.encoder = Mp4Encoder(self.video_path, fps)
+        self.size = None
+
+    def write(self, frame: Union[Image.Image, np.ndarray]):
+        frame = np.array(frame, np.uint8)[:, :, :3]
+        h, w = frame.shape[:2]
+        if self.size is None:
+            self.size = (w, h)
+        elif self.size != (w, h):
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_LANCZOS4)
+        self.encoder(frame)
+
+    def close(self) -> Tuple[Optional[str], Optional[str], str]:
+        """Finish encoding, return (video_path, gif_path, prefix) like `convert_to_video`."""
+        self.encoder.finish()
+        ep_logger.info(f"Write {self.encoder.frame_num} frames to {self.video_path}.")
+        if self.mode == "gif":
+            return None, self.video_path, self.prefix
+        return self.video_path, None, self.prefix
+
+
+class VideoEncoder:
+    """Base class of the encoders driven by `MultiFormatVideoWriter`.
+
+    `encode` receives RGB uint8 frames one by one and `finish` writes what is left and returns the output path. Both are
+    called from the thread of the encoder, the frames are shared between encoders and must not be modified.
+    """
+
+    name = "video"
+
+    def __init__(self, path: str, fps: float, crop_box: Optional[List[int]] = None):
+        self.path = path
+        self.fps = fps
+        self.crop_box = crop_box
+        self.frame_num = 0
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __call__(self, frame: np.ndarray):
+        if self.crop_box is not None:
+            x1, y1, x2, y2 = self.crop_box
+            frame = frame[y1:y2, x1:x2]
+        self.encode(np.ascontiguousarray(frame))
+        self.frame_num += 1
+
+    def encode(self, frame: np.ndarray):
+        raise NotImplementedError
+
+    def finish(self) -> str:
+        return self.path
+
+
+class GifEncoder(VideoEncoder):
+    """GIF through ffmpeg palettegen / paletteuse ("global" or "single" palette), or through Pillow ("pillow").
+
+    The ffmpeg palettes run in a PyAV filter graph in front of the gif stream, as `Mp4Encoder` drives libx264.
+    """
+
+    name = "gif"
+
+    def __init__(self, path: str, fps: float, crop_box: Optional[List[int]] = None, palette: str = "global", loop: int = 0):
+        super().__init__(path, fps, crop_box)
+        self.palette = palette
+        self.loop = loop
+        self.container = None
+        self.stream = None
+        self.graph = None
+        self.frames = []
+
+    def _open(self, width: int, height: int):
+        import av
+
+        rate = Fraction(self.fps).limit_denominator(1001)
+        self.container = av.open(self.path, "w", options={"loop": str(self.loop)})
+        self.stream = self.container.add_stream("gif", rate=rate)
+        self.stream.width, self.stream.height = width, height
+        self.stream.pix_fmt = "pal8"
+        self.stream.time_base = 1 / rate
+
+        self.graph = av.filter.Graph()
+        node_descriptors, edges = _gif_filter_graph(self.palette)
+        nodes = {
+            "video_in": self.graph.add_buffer(width=width, height=height, format="rgb24", time_base=self.stream.time_base),
+            "video_out": self.graph.add("buffersink"),
+        }
+        for name, (filter_name, arguments) in node_descriptors.items():
+            nodes[name] = self.graph.add(filter_name, arguments)
+        for from_node, to_node, out_idx, in_idx in edges:
+            nodes[from_node].link_to(nodes[to_node], out_idx, in_idx)
+        self.graph.configure()
+
+    def _mux_filtered(self):
+        import av
+
+        # The global palette holds every frame until the end of the stream, a single palette returns them one by one.
+        while True:
+            try:
+                frame = self.graph.pull()
+            except (av.error.BlockingIOError, av.error.EOFError):
+                return
+            self.container.mux(self.stream.encode(frame))
+
+    def encode(self, frame: np.ndarray):
+        if self.palette == "pillow":
+            # Quantize here, so that the save at the end only writes the frames.
+            self.frames.append(Image.fromarray(frame).convert("P", palette=Image.Palette.ADAPTIVE))
+            return
+        import av
+
+        if self.container is None:
+            self._open(frame.shape[1], frame.shape[0])
+        av_frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+        av_frame.pts = self.frame_num
+        av_frame.time_base = self.stream.time_base
+        self.graph.push(av_frame)
+        self._mux_filtered()
+
+    def finish(self) -> str:
+        if self.container is not None:
+            self.graph.push(None)
+            self._mux_filtered()
+            self.container.mux(self.stream.encode(None))
+            self.container.close()
+            self.container = None
+        elif len(self.frames) > 0:
+            self.frames[0].save(
+                self.path, save_all=True, append_images=self.frames[1:], duration=1000 / self.fps, loop=self.loop, optimize=False
+            )
+            self.frames = []
+        return self.path
+
+
+class Mp4Encoder(VideoEncoder):
+    """H.264 mp4 through PyAV, `options` are passed to libx264 (e.g. crf, preset, tune).
+
+    yuv420p needs an even width and height, frames of an odd size are padded by one row or column of their edge pixels.
+    """
+
+    name = "mp4"
+
+    def __init__(self, path: str, fps: float, crop_box: Optional[List[int]] = None, options: Optional[dict] = None):
+        super().__init__(path, fps, crop_box)
+        self.options = options or {}
+        self.container = None
+        self.stream = None
+
+    def encode(self, frame: np.ndarray):
+        import av
+
+        pad_h, pad_w = frame.shape[0] % 2, frame.shape[1] % 2
+        if pad_h or pad_w:
+            frame = np.pad(frame, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+        if self.container is None:
+            self.container = av.open(self.path, "w")
+            self.stream = self.container.add_stream("libx264", rate=Fraction(self.fps).limit_denominator(1001), options=self.options)
+            self.stream.width, self.stream.height = frame.shape[1], frame.shape[0]
+            self.stream.pix_fmt = "yuv420p"
+        self.container.mux(self.stream.encode(av.VideoFrame.from_ndarray(frame, format="rgb24")))
+
+    def finish(self) -> str:
+        if self.container is not None:
+            self.container.mux(self.stream.encode(None))
+            self.container.close()
+        return self.path
+
+
+class WebpEncoder(VideoEncoder):
+    """Animated WebP through Pillow, the frames are kept until `finish` as Pillow encodes the animation at once."""
+
+    name = "webp"
+
+    def __init__(
+        self, path: str, fps: float, crop_box: Optional[List[int]] = None, loop: int = 0, lossless: bool = False, quality: int = 80
+    ):
+        super().__init__(path, fps, crop_box)
+        self.loop = loop
+        self.lossless = lossless
+        self.quality = quality
+        self.frames = []
+
+    def encode(self, frame: np.ndarray):
+        self.frames.append(Image.fromarray(frame))
+
+    def finish(self) -> str:
+        if len(self.frames) > 0:
+            self.frames[0].save(
+                self.path,
+                save_all=True,
+                append_images=self.frames[1:],
+                duration=int(1000 / self.fps),
+                loop=self.loop,
+                lossless=self.lossless,
+                quality=self.quality,
+            )
+            self.frames = []
+        return self.path
+
+
+class PngSequenceEncoder(VideoEncoder):
+    """Write every frame as {path}/{index:05}.png."""
+
+    name = "png"
+
+    def __init__(self, path: str, fps: float, crop_box: Optional[List[int]] = None, pnginfo: Optional[dict] = None):
+        super().__init__(path, fps, crop_box)
+        os.makedirs(path, exist_ok=True)
+        self.pnginfo = pnginfo
+
+    def encode(self, frame: np.ndarray):
+        png_info = PngImagePlugin.PngInfo()
+        for key, value in (self.pnginfo or {}).items():
+            png_info.add_text(key, value)
+        Image.fromarray(frame).save(os.path.join(self.path, f"{self.frame_num:05}.png"), pnginfo=png_info)
+
+
+def get_video_encoder(mode: str, path: str, fps: float, **kwargs) -> VideoEncoder:
+    """Create the encoder of `mode` (gif, mp4, webp or png) writing to `path`."""
+    encoders = {encoder.name: encoder for encoder in [GifEncoder, Mp4Encoder, WebpEncoder, PngSequenceEncoder]}
+    if mode.lower() not in encoders:
+        raise ValueError(f"Unsupported video format {mode}, choose from {list(encoders.keys())}.")
+    return encoders[mode.lower()](path, fps, **kwargs)
+
+
+class MultiFormatVideoWriter:
+    """Fan a single stream of frames out to several encoders in one pass.
+
+    Every encoder runs in its own thread behind a bounded queue, so the frames are produced (or decoded) only once while
+    GIF palette generation, H.264 encoding and so on run in parallel. The time spent in each encoder is logged on close.
+    """
+
+    def __init__(self, encoders: List[VideoEncoder], queue_size: int = 8):
+        self.encoders = encoders
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in encoders]
+        self.errors = [None for _ in encoders]
+        self.timings = [0.0 for _ in encoders]
+        self.threads = [threading.Thread(target=self._run, args=(idx,), daemon=True) for idx in range(len(encoders))]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self, idx: int):
+        encoder, frames = self.encoders[idx], self.queues[idx]
+        while True:
+            frame = frames.get()
+            # Keep draining the queue after an error, so that the producer is never blocked.
+            if self.errors[idx] is not None and frame is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                if frame is None:
+                    encoder.finish()
+                else:
+                    encoder(frame)
+            except Exception:
+                self.errors[idx] = traceback.format_exc()
+            self.timings[idx] += time.perf_counter() - start
+            if frame is None:
+                break
+
+    def write(self, frame: Union[Image.Image, np.ndarray]):
+        frame = np.asarray(frame, np.uint8)[:, :, :3]
+        for frames in self.queues:
+            frames.put(frame)
+
+    def write_all(self, frames: Iterable[Union[Image.Image, np.ndarray]]):
+        for frame in frames:
+            self.write(frame)
+
+    def close(self) -> List[str]:
+        """Finish all the encoders and return their output paths, in the order of the encoders."""
+        if self.threads is None:
+            return [encoder.path for encoder in self.encoders]
+        for frames in self.queues:
+            frames.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = None
+
+        for encoder, error, timing in zip(self.encoders, self.errors, self.timings):
+            if error is None:
+                ep_logger.info(
+                    f"{encoder.name} encoder: {encoder.frame_num} frames in {timing:.2f}s "
+                    f"({encoder.frame_num / max(timing, 1e-6):.1f} fps), saved to {encoder.path}."
+                )
+        for encoder, error in zip(self.encoders, self.errors):
+            if error is not None:
+                raise RuntimeError(f"{encoder.name} encoder failed to write {encoder.path}: {error}")
+        return [encoder.path for encoder in self.encoders]
+
+
+def read_video_frames(video_path: str) -> Iterator[np.ndarray]:
+    """Iterate the RGB frames of a gif or mp4 file without decoding the whole video."""
+    import imageio.v3 as imageio
+
+    for frame in imageio.imiter(video_path, plugin="pyav"):
+        yield frame[:, :, :3]
+
+
+class FrameSequence(Sequence):
+    """A read-only list-like view of a frame array, which creates the PIL image of a frame only when it is accessed."""
+
+    def __init__(self, frames: np.ndarray):
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FrameSequence(self.frames[index])
+        return Image.fromarray(self.frames[index])
+
+
+def _cleanup_frame_store(root: Optional[str], shms: dict):
+    for shm in shms.values():
+        try:
+            shm.close()
+        except BufferError:
+            # Some views are still alive, the mapping is released when they are garbage collected.
+            pass
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    shms.clear()
+    if root is not None:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+class FrameStore:
+    """Named, preallocated uint8 frame arrays shared by the stages of a video request.
+
+    Each named entry is a [num_frames, height, width, channels] uint8 array, stages read and write it in place or
+    through views instead of keeping lists of (deep-copied) PIL images. The backend decides where the arrays live:
+        - memory: ordinary numpy arrays.
+        - memmap: numpy memmap files on local disk, so that the page cache instead of the process holds the frames.
+        - shm: shared memory, which can be attached by other processes without pickling the frames.
+    All the arrays are released by `close`, which is also called when the store is garbage collected.
+    """
+
+    def __init__(self, backend: str = "memory", root: Optional[str] = None):
+        if backend not in ["memory", "memmap", "shm"]:
+            raise ValueError(f"Unsupported frame store backend: {backend}.")
+        self.backend = backend
+        self.arrays = {}
+        self.shms = {}
+        self.root = None
+        if backend == "memmap":
+            self.root = os.path.join(root, str(uuid.uuid4()))
+            os.makedirs(self.root, exist_ok=True)
+        self._finalizer = weakref.finalize(self, _cleanup_frame_store, self.root, self.shms)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.arrays
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def create(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        """Allocate (or reuse if the shape is the same) the array `name` and return it."""
+        shape = tuple(int(_) for _ in shape)
+        if name in self.arrays:
+            if self.arrays[name].shape == shape:
+                return self.arrays[name]
+            self.release(name)
+
+        if self.backend == "memmap":
+            array = np.memmap(os.path.join(self.root, f"{name}.bin"), dtype=np.uint8, mode="w+", shape=shape)
+        elif self.backend == "shm":
+            shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+            self.shms[name] = shm
+            array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        else:
+            array = np.empty(shape, dtype=np.uint8)
+        self.arrays[name] = array
+        return array
+
+    def put(self, name: str, frames: Sequence[Union[Image.Image, np.ndarray]]) -> np.ndarray:
+        """Copy a list of frames with the same size into the array `name`."""
+        first = np.asarray(frames[0], np.uint8)
+        array = self.create(name, (len(frames),) + first.shape)
+        for index, frame in enumerate(frames):
+            self.write(name, index, frame)
+        return array
+
+    def write(self, name: str, index: int, frame: Union[Image.Image, np.ndarray]):
+        """Write a frame into the array `name` in place, resizing it if the size does not match."""
+        array = self.arrays[name]
+        frame = np.asarray(frame, np.uint8)
+        if frame.shape != array.shape[1:]:
+            frame = cv2.resize(frame, (array.shape[2], array.shape[1]), interpolation=cv2.INTER_LANCZOS4)
+        array[index] = frame
+
+    def images(self, name: str) -> FrameSequence:
+        """Return a list-like sequence of PIL images backed by the array `name`."""
+        return FrameSequence(self.arrays[name])
+
+    def spec(self, name: str) -> dict:
+        """Return what another process needs to attach the array `name`."""
+        array = self.arrays[name]
+        spec = {"backend": self.backend, "shape": array.shape}
+        if self.backend == "shm":
+            spec["shm_name"] = self.shms[name].name
+        elif self.backend == "memmap":
+            spec["path"] = array.filename
+        return spec
+
+    def release(self, name: str):
+        """Drop the array `name`."""
+        array = self.arrays.pop(name, None)
+        if isinstance(array, np.memmap):
+            path = array.filename
+            del array
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        shm = self.shms.pop(name, None)
+        if shm is not None:
+            _cleanup_frame_store(None, {name: shm})
+
+    def clear(self):
+        """Drop all the arrays but keep the store usable."""
+        for name in list(self.arrays.keys()):
+            self.release(name)
+
+    def close(self):
+        self.arrays.clear()
+        self._finalizer()
+
+
+def _attach_frame_arrays(specs: dict) -> Tuple[dict, list]:
+    arrays, shms = {}, []
+    for name, spec in specs.items():
+        if spec["backend"] == "shm":
+            shm = shared_memory.SharedMemory(name=spec["shm_name"])
+            shms.append(shm)
+            arrays[name] = np.ndarray(spec["shape"], dtype=np.uint8, buffer=shm.buf)
+        else:
+            arrays[name] = np.memmap(spec["path"], dtype=np.uint8, mode="r+", shape=spec["shape"])
+    return arrays, shms
+
+
+def _run_frame_task(fn, specs: dict, task: tuple):
+    arrays, shms = _attach_frame_arrays(specs)
+    try:
+        return fn(arrays, *task)
+    finally:
+        del arrays
+        for shm in shms:
+            shm.close()
+
+
+def _init_frame_worker():
+    # Each worker handles one frame at a time, avoid oversubscribing the cores with the threads of cv2.
+    cv2.setNumThreads(1)
+
+
+class FramePool:
+    """Run independent per-frame CPU work in a pool of worker processes.
+
+    The frames are not sent to the workers: a task only carries the frame index and small parameters, the workers
+    attach the arrays of the frame store (shm or memmap backend) and modify the frames in place. Results are returned in
+    the order of the tasks, so the output does not depend on the scheduling. With 0 workers, or on platforms without
+    fork, the tasks run in the current process.
+    """
+
+    def __init__(self, num_workers: int = 0):
+        self.executor = None
+        if num_workers > 0:
+            if "fork" not in multiprocessing.get_all_start_methods():
+                ep_logger.warning("Post-processing workers require the fork start method, run in the current process instead.")
+            else:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=num_workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_frame_worker
+                )
+        self.num_workers = num_workers if self.executor is not None else 0
+
+    def map(self, fn, frame_store: FrameStore, names: List[str], tasks: List[tuple]) -> list:
+        """Call fn(arrays, *task) for each task, where arrays maps each name in `names` to the array in `frame_store`."""
+        if self.executor is None or frame_store.backend == "memory" or len(tasks) == 0:
+            arrays = {name: frame_store[name] for name in names}
+            return [fn(arrays, *task) for task in tasks]
+        specs = {name: frame_store.spec(name) for name in names}
+        chunksize = max(len(tasks) // (self.num_workers * 4), 1)
+        return list(self.executor.map(_run_frame_task, repeat(fn), repeat(specs), tasks, chunksize=chunksize))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def color_shift_frame(arrays: dict, index: int, box: list, template_face_area: np.ndarray, face_skin_mask: np.ndarray) -> Optional[str]:
+    """Transfer the color of the original template face to the face of frame `index` inside `box`, blended by the skin mask."""
+    try:
+        frame = arrays["frames"][index]
+        crop = np.array(frame[box[1] : box[3], box[0] : box[2], :])
+        crop_color_shift = color_transfer(np.array(crop), template_face_area)
+
+        face_skin_mask = cv2.blur(np.float32(face_skin_mask), (32, 32)) / 255
+        frame[box[1] : box[3], box[0] : box[2], :] = crop_color_shift * face_skin_mask + crop * (1 - face_skin_mask)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def face_fusion_frame(arrays: dict, index: int, face_fusion_ratio: float) -> Optional[str]:
+    """Blend the face fusion result into frame `index`.
+
+    The face is divided into three parts: the eyes are taken from the results of face fusion, the skin is derived from the
+    proportional blending of both sources and the lips are taken from the diffusion.
+    """
+    try:
+        frame = arrays["frames"][index]
+        fusion_image_mask = np.int32(np.float32(arrays["fusion_mask"][index]) > 128)
+        input_image_mask = np.int32(np.float32(arrays["input_mask"][index]) > 128)
+        combine_mask = np.uint8(input_image_mask * fusion_image_mask * 255)
+        combine_mask = (
+            cv2.erode(
+                cv2.dilate(combine_mask, np.ones((8, 8), np.uint8), iterations=1),
+                np.ones((16, 16), np.uint8),
+                iterations=1,
+            )
+            * face_fusion_ratio
+        )
+        combine_mask[cv2.dilate(np.float32(arrays["fusion_eyes_mask"][index]), np.ones((16, 16), np.uint8), iterations=1) > 128] = 255
+        combine_mask[np.float32(arrays["input_lips_mask"][index]) > 128] = 0
+        combine_mask = cv2.blur(np.array(combine_mask), (8, 8)) / 255
+
+        # paste back to photo
+        frame[:] = np.uint8(np.array(arrays["fusion"][index]) * combine_mask + np.array(frame) * (1 - combine_mask))
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def paste_back_frame(arrays: dict, index: int, box: list, from_template: bool = False) -> Optional[str]:
+    """Resize frame `index` (or the template frame itself if `from_template`) into `box` of the template frame."""
+    try:
+        x1, y1, x2, y2 = box
+        source = arrays["template"][index] if from_template else arrays["frames"][index]
+        arrays["template"][index][y1:y2, x1:x2] = np.array(
+            Image.fromarray(np.array(source)).resize([x2 - x1, y2 - y1], Image.Resampling.LANCZOS)
+        )
+    except Exception:
+        return traceback.format_exc()
+    return None
@@ -1,14 +1,22 @@
 import argparse
+import hashlib
 import json
 import logging
 import math
 import os
 import platform
+import queue
 import sys
 import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from shutil import copyfile
 
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "easyphoto_utils"))
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), "train_kohya"))
 
 import cv2
 import numpy as np
@@ -19,6 +27,7 @@ from modelscope.pipelines import pipeline
 from modelscope.utils.constant import Tasks
 from PIL import Image
 from tqdm import tqdm
+from utils.progress_events import ProgressEvents
 
 
 def parse_args():
@@ -69,10 +78,169 @@ def parse_args():
         action="store_true",
         help=("Whether to train scene lora"),
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help=("The directory caching the outputs of each photo by its content hash, reused by the later preprocessing."),
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help=("The number of threads decoding the photos ahead of the model stages."),
+    )
+    parser.add_argument(
+        "--progress_file",
+        type=str,
+        default=None,
+        help=("Append the structured progress events (JSON lines) of the preprocessing to this file."),
+    )
     args = parser.parse_args()
     return args
 
 
+class StageTimer:
+    """Accumulate the time and the number of calls of each preprocessing stage, for a summary at the end."""
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.times[stage] += seconds
+            self.counts[stage] += 1
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def summary(self, total_time):
+        lines = [f"preprocess stage timing (total {total_time:.2f}s, decode and write overlap the model stages):"]
+        for stage, stage_time in sorted(self.times.items(), key=lambda item: -item[1]):
+            count = self.counts[stage]
+            lines.append(f"    {stage:<22} {stage_time:8.2f}s  {count:4d} calls  {stage_time / count * 1000:8.1f}ms/call")
+        return "\n".join(lines)
+
+
+def decode_images(paths, timer, num_workers, prefetch):
+    """
+    Decode the photos in a thread pool, at most prefetch photos ahead of the consumer.
+
+    Yields:
+        (path, image, error): The photos in the order of paths, error is the exception raised by the decoding if any.
+    """
+
+    def decode(path):
+        with timer("decode"):
+            image = Image.open(path)
+            image.load()
+            return image
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        pending = queue.Queue()
+        paths = iter(paths)
+        for path in paths:
+            pending.put((path, executor.submit(decode, path)))
+            if pending.qsize() >= prefetch:
+                break
+        while not pending.empty():
+            path, future = pending.get()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.put((next_path, executor.submit(decode, next_path)))
+            try:
+                yield path, future.result(), None
+            except Exception as e:
+                yield path, None, e
+
+
+class AsyncWriter:
+    """Run the writes in a background thread, behind a bounded queue, so that the model stages do not wait for the disk."""
+
+    def __init__(self, timer, maxsize=8):
+        self.timer = timer
+        self.tasks = queue.Queue(maxsize=maxsize)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            fn, args = task
+            try:
+                with self.timer("write"):
+                    fn(*args)
+            except Exception as e:
+                self.errors.append(e)
+
+    def submit(self, fn, *args):
+        self.tasks.put((fn, args))
+
+    def close(self):
+        """Wait for the pending writes, the first error of the writes is raised."""
+        self.tasks.put(None)
+        self.thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+
+class PreprocessCache:
+    """
+    The outputs of the preprocessing of each photo, keyed by the content hash of the photo and the options, so that an
+    incremental training only processes its new photos. The outputs are saved as .npz files in cache_dir.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def photo_key(path, *options):
+        hash_sha256 = hashlib.sha256(repr(options).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hash_sha256.update(chunk)
+        return hash_sha256.hexdigest()
+
+    def load(self, key, name):
+        path = os.path.join(self.cache_dir, f"{key}_{name}.npz")
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return {k: data[k] for k in data.files}
+        except Exception as e:
+            logging.error(f"Load preprocess cache {path} error, error info: {e}")
+            return None
+
+    def save(self, key, name, **arrays):
+        try:
+            np.savez(os.path.join(self.cache_dir, f"{key}_{name}.npz"), **arrays)
+        except Exception as e:
+            logging.error(f"Save preprocess cache error, error info: {e}")
+
+
+def save_processed_image(images_save_path, index, image, validation_prompt):
+    image = image.convert("RGB")
+    image.save(os.path.join(images_save_path, str(index) + ".jpg"))
+    print("save processed image to " + os.path.join(images_save_path, str(index) + ".jpg"))
+    with open(os.path.join(images_save_path, str(index) + ".txt"), "w") as f:
+        if isinstance(validation_prompt, list):
+            f.write(validation_prompt[index])
+        else:
+            f.write(validation_prompt)
+
+
 def compare_jpg_with_face_id(embedding_list):
     embedding_array = np.vstack(embedding_list)
     # Take mean from the user image to obtain the average features of the real person image
@@ -96,6 +264,10 @@ if __name__ == "__main__":
     ref_image_path = args.ref_image_path
     skin_retouching_bool = args.skin_retouching_bool
     train_scene_lora_bool = args.train_scene_lora_bool
+    timer = StageTimer()
+    start_time = time.perf_counter()
+    progress_events = ProgressEvents(args.progress_file)
+    progress_events.start_phase("preprocess", stage="load models")
 
     logging.info(
         f"""
@@ -132,6 +304,10 @@ if __name__ == "__main__":
     except Exception as e:
         portrait_enhancement = None
         logging.info(f"Portrait Enhancement model load error, but pass. Error info {e}")
+    timer.add("load models", time.perf_counter() - start_time)
+    writer = AsyncWriter(timer)
+    preprocess_cache = PreprocessCache(args.cache_dir) if args.cache_dir is not None else None
+    extensions = (".bmp", ".dib", ".png", ".jpg", ".jpeg", ".pbm", ".pgm", ".ppm", ".tif", ".tiff")
 
     if not train_scene_lora_bool:
         # jpg list
@@ -142,38 +318,57 @@ if __name__ == "__main__":
         copy_jpgs = []
         selected_paths = []
         sub_images = []
-        for index, jpg in enumerate(tqdm(jpgs)):
+        photo_keys = []
+        jpgs = [jpg for jpg in jpgs if jpg.lower().endswith(extensions)]
+        progress_events.start_phase("preprocess", total_steps=len(jpgs), stage="face id")
+        decoded = decode_images([os.path.join(inputs_dir, jpg) for jpg in jpgs], timer, args.num_workers, 2 * args.num_workers)
+        for done, (_image_path, image, error) in enumerate(tqdm(decoded, total=len(jpgs))):
+            progress_events.step(done)
+            jpg = os.path.basename(_image_path)
             try:
-                if not jpg.lower().endswith((".bmp", ".dib", ".png", ".jpg", ".jpeg", ".pbm", ".pgm", ".ppm", ".tif", ".tiff")):
-                    continue
-                _image_path = os.path.join(inputs_dir, jpg)
-                image = Image.open(_image_path)
-
-                h, w, c = np.shape(image)
+                if error is not None:
+                    raise error
+
+                # Reuse the outputs of the photo in a previous preprocessing, e.g. for an incremental training.
+                photo_key = preprocess_cache.photo_key(_image_path, skin_retouching_bool) if preprocess_cache is not None else None
+                cached = preprocess_cache.load(photo_key, "face") if photo_key is not None else None
+                if cached is not None:
+                    embedding, angle, sub_image = cached["embedding"], float(cached["angle"]), Image.fromarray(cached["sub_image"])
+                else:
+                    cacheable = True
+                    h, w, c = np.shape(image)
 
-                retinaface_boxes, retinaface_keypoints, _ = call_face_crop(retinaface_detection, image, 3, prefix="tmp")
-                retinaface_box = retinaface_boxes[0]
-                retinaface_keypoint = retinaface_keypoints[0]
+                    with timer("retinaface"):
+                        retinaface_boxes, retinaface_keypoints, _ = call_face_crop(retinaface_detection, image, 3, prefix="tmp")
+                    retinaface_box = retinaface_boxes[0]
+                    retinaface_keypoint = retinaface_keypoints[0]
 
-                # get key point
-                retinaface_keypoint = np.reshape(retinaface_keypoint, [5, 2])
-                # get angle
-                x = retinaface_keypoint[0, 0] - retinaface_keypoint[1, 0]
-                y = retinaface_keypoint[0, 1] - retinaface_keypoint[1, 1]
-                angle = 0 if x == 0 else abs(math.atan(y / x) * 180 / math.pi)
-                angle = (90 - angle) / 90
+                    # get key point
+                    retinaface_keypoint = np.reshape(retinaface_keypoint, [5, 2])
+                    # get angle
+                    x = retinaface_keypoint[0, 0] - retinaface_keypoint[1, 0]
+                    y = retinaface_keypoint[0, 1] - retinaface_keypoint[1, 1]
+                    angle = 0 if x == 0 else abs(math.atan(y / x) * 180 / math.pi)
+                    angle = (90 - angle) / 90
 
-                # face crop
-                sub_image = image.crop(retinaface_box)
-                if skin_retouching_bool:
-                    try:
-                        sub_image = Image.fromarray(cv2.cvtColor(skin_retouching(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB))
-                    except Exception as e:
-                        torch.cuda.empty_cache()
-                        logging.error(f"Photo skin_retouching error, error info: {e}")
-
-                # get embedding
-                embedding = face_recognition(dict(user=image))[OutputKeys.IMG_EMBEDDING]
+                    # face crop
+                    sub_image = image.crop(retinaface_box)
+                    if skin_retouching_bool:
+                        try:
+                            with timer("skin_retouching"):
+                                sub_image = Image.fromarray(
+                                    cv2.cvtColor(skin_retouching(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB)
+                                )
+                        except Exception as e:
+                            cacheable = False
+                            torch.cuda.empty_cache()
+                            logging.error(f"Photo skin_retouching error, error info: {e}")
+
+                    # get embedding
+                    with timer("face_recognition"):
+                        embedding = face_recognition(dict(user=image))[OutputKeys.IMG_EMBEDDING]
+                    if photo_key is not None and cacheable and embedding is not None:
+                        preprocess_cache.save(photo_key, "face", embedding=embedding, angle=angle, sub_image=np.array(sub_image))
 
                 face_id_scores.append(embedding)
                 face_angles.append(angle)
@@ -181,6 +376,7 @@ if __name__ == "__main__":
                 copy_jpgs.append(jpg)
                 selected_paths.append(_image_path)
                 sub_images.append(sub_image)
+                photo_keys.append(photo_key)
             except Exception as e:
                 torch.cuda.empty_cache()
                 logging.error(f"Photo detect and count score error, error info: {e}")
@@ -200,28 +396,49 @@ if __name__ == "__main__":
         selected_jpgs = []
         selected_scores = []
         selected_sub_images = []
+        selected_keys = []
         for index in indexes:
             selected_jpgs.append(copy_jpgs[index])
             selected_scores.append(ref_total_scores[index])
             selected_sub_images.append(sub_images[index])
+            selected_keys.append(photo_keys[index])
             print("jpg:", copy_jpgs[index], "face_id_scores", ref_total_scores[index])
 
         images = []
         enhancement_num = 0
         max_enhancement_num = len(selected_jpgs) // 2
+        progress_events.start_phase("preprocess", total_steps=len(selected_jpgs), stage="face crop and mask")
         for index, jpg in tqdm(enumerate(selected_jpgs[::-1])):
+            progress_events.step(index)
             try:
                 sub_image = selected_sub_images[index]
+                enhance = (np.shape(sub_image)[0] < 512 or np.shape(sub_image)[1] < 512) and enhancement_num < max_enhancement_num
+                mask_name = "mask_enhanced" if enhance else "mask"
+                cached = preprocess_cache.load(selected_keys[index], mask_name) if selected_keys[index] is not None else None
+                if cached is not None:
+                    enhancement_num += int(cached["enhanced"])
+                    if cached["mask_sub_image"].size > 0:
+                        mask_sub_image = Image.fromarray(cached["mask_sub_image"])
+                        writer.submit(save_processed_image, images_save_path, len(images), mask_sub_image, validation_prompt)
+                        images.append(mask_sub_image)
+                    continue
+
+                enhanced = False
                 try:
-                    if (np.shape(sub_image)[0] < 512 or np.shape(sub_image)[1] < 512) and enhancement_num < max_enhancement_num:
-                        sub_image = Image.fromarray(cv2.cvtColor(portrait_enhancement(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB))
+                    if enhance:
+                        with timer("portrait_enhancement"):
+                            sub_image = Image.fromarray(
+                                cv2.cvtColor(portrait_enhancement(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB)
+                            )
                         enhancement_num += 1
+                        enhanced = True
                 except Exception as e:
                     torch.cuda.empty_cache()
                     logging.error(f"Photo enhance error, error info: {e}")
 
                 # Correct the mask area of the face
-                sub_boxes, _, sub_masks = call_face_crop(retinaface_detection, sub_image, 1, prefix="tmp")
+                with timer("retinaface"):
+                    sub_boxes, _, sub_masks = call_face_crop(retinaface_detection, sub_image, 1, prefix="tmp")
                 sub_box = sub_boxes[0]
                 sub_mask = sub_masks[0]
 
@@ -236,14 +453,19 @@ if __name__ == "__main__":
                 sub_mask[sub_box[1] : sub_box[3], sub_box[0] : sub_box[2]] = 1
 
                 # Significance detection, merging facial masks
-                result = salient_detect(sub_image)[OutputKeys.MASKS]
+                with timer("salient_detect"):
+                    result = salient_detect(sub_image)[OutputKeys.MASKS]
                 mask = np.float32(np.expand_dims(result > 128, -1)) * sub_mask
 
                 # Obtain the image after the mask
                 mask_sub_image = np.array(sub_image) * np.array(mask) + np.ones_like(sub_image) * 255 * (1 - np.array(mask))
                 mask_sub_image = Image.fromarray(np.uint8(mask_sub_image))
                 if np.sum(np.array(mask)) != 0:
+                    writer.submit(save_processed_image, images_save_path, len(images), mask_sub_image, validation_prompt)
                     images.append(mask_sub_image)
+                if selected_keys[index] is not None and enhanced == enhance:
+                    cached_mask_sub_image = np.array(mask_sub_image) if np.sum(np.array(mask)) != 0 else np.zeros([0], np.uint8)
+                    preprocess_cache.save(selected_keys[index], mask_name, enhanced=enhanced, mask_sub_image=cached_mask_sub_image)
             except Exception as e:
                 torch.cuda.empty_cache()
                 logging.error(f"Photo face crop and salient_detect error, error info: {e}")
@@ -253,18 +475,22 @@ if __name__ == "__main__":
         # sort photo files to correspond with captions.
         jpgs = sorted(jpgs, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
         images = []
-        for index, jpg in enumerate(tqdm(jpgs)):
+        jpgs = [jpg for jpg in jpgs if jpg.lower().endswith(extensions)]
+        progress_events.start_phase("preprocess", total_steps=len(jpgs), stage="scene")
+        decoded = decode_images([os.path.join(inputs_dir, jpg) for jpg in jpgs], timer, args.num_workers, 2 * args.num_workers)
+        for done, (_image_path, image, error) in enumerate(tqdm(decoded, total=len(jpgs))):
+            progress_events.step(done)
+            jpg = os.path.basename(_image_path)
             try:
-                if not jpg.lower().endswith((".bmp", ".dib", ".png", ".jpg", ".jpeg", ".pbm", ".pgm", ".ppm", ".tif", ".tiff")):
-                    continue
-                _image_path = os.path.join(inputs_dir, jpg)
-                image = Image.open(_image_path)
+                if error is not None:
+                    raise error
 
                 # Use original training photos if crop_ratio < 1.
                 if float(args.crop_ratio) >= 1:
                     h, w, c = np.shape(image)
 
-                    retinaface_boxes, retinaface_keypoints, _ = call_face_crop(retinaface_detection, image, 1, prefix="tmp")
+                    with timer("retinaface"):
+                        retinaface_boxes, retinaface_keypoints, _ = call_face_crop(retinaface_detection, image, 1, prefix="tmp")
                     retinaface_box = retinaface_boxes[0]
                     retinaface_keypoint = retinaface_keypoints[0]
 
@@ -295,18 +521,23 @@ if __name__ == "__main__":
                     sub_image = image
                 if skin_retouching_bool:
                     try:
-                        sub_image = Image.fromarray(cv2.cvtColor(skin_retouching(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB))
+                        with timer("skin_retouching"):
+                            sub_image = Image.fromarray(cv2.cvtColor(skin_retouching(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB))
                     except Exception as e:
                         torch.cuda.empty_cache()
                         logging.error(f"Photo skin_retouching error, error info: {e}")
 
                 try:
                     if np.shape(sub_image)[0] < 768 or np.shape(sub_image)[1] < 768:
-                        sub_image = Image.fromarray(cv2.cvtColor(portrait_enhancement(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB))
+                        with timer("portrait_enhancement"):
+                            sub_image = Image.fromarray(
+                                cv2.cvtColor(portrait_enhancement(sub_image)[OutputKeys.OUTPUT_IMG], cv2.COLOR_BGR2RGB)
+                            )
                 except Exception as e:
                     torch.cuda.empty_cache()
                     logging.error(f"Photo enhance error, error info: {e}")
 
+                writer.submit(save_processed_image, images_save_path, len(images), sub_image, validation_prompt)
                 images.append(sub_image)
             except Exception as e:
                 torch.cuda.empty_cache()
@@ -316,16 +547,8 @@ if __name__ == "__main__":
             # Save the reference image displayed in the Scene Lora gallery.
             images[0].save(ref_image_path)
 
-    # write results
-    for index, base64_pilimage in enumerate(images):
-        image = base64_pilimage.convert("RGB")
-        image.save(os.path.join(images_save_path, str(index) + ".jpg"))
-        print("save processed image to " + os.path.join(images_save_path, str(index) + ".jpg"))
-        with open(os.path.join(images_save_path, str(index) + ".txt"), "w") as f:
-            if isinstance(validation_prompt, list):
-                f.write(validation_prompt[index])
-            else:
-                f.write(validation_prompt)
+    # wait for the results written in the background
+    writer.close()
 
     with open(json_save_path, "w", encoding="utf-8") as f:
         for root, dirs, files in os.walk(images_save_path, topdown=False):
@@ -349,3 +572,10 @@ if __name__ == "__main__":
     del portrait_enhancement
     del face_recognition
     torch.cuda.empty_cache()
+    print(timer.summary(time.perf_counter() - start_time))
+    progress_events.end_phase(
+        total_time=round(time.perf_counter() - start_time, 3),
+        stage_times={stage: round(stage_time, 3) for stage, stage_time in timer.times.items()},
+        num_images=len(images),
+    )
+    progress_events.close()
@@ -20,6 +20,7 @@ from modules.timer import Timer
 
 from scripts.easyphoto_utils import (
     AnimateDiffControl,
+    AnimateDiffDecoder,
     AnimateDiffI2VLatent,
     AnimateDiffInfV2V,
     AnimateDiffLora,
@@ -162,6 +163,7 @@ if video_visible:
             self.lora_hacker = None
             self.cfg_hacker = None
             self.cn_hacker = None
+            self.decode_hacker = None
             self.prompt_scheduler = None
             self.hacked = False
             self.name = self.title()
@@ -185,6 +187,7 @@ if video_visible:
                     self.cn_hacker.restore()
                     self.cfg_hacker.restore()
                     self.lora_hacker.restore()
+                    self.decode_hacker.restore()
                     motion_module.restore(p.sd_model)
                     self.hacked = False
                 ep_logger.info("AnimateDiff process start.")
@@ -197,12 +200,15 @@ if video_visible:
                 self.cfg_hacker.hack(params)
                 self.cn_hacker = AnimateDiffControl(p, self.prompt_scheduler)
                 self.cn_hacker.hack(params)
+                self.decode_hacker = AnimateDiffDecoder()
+                self.decode_hacker.hack(p)
                 update_infotext(p, params)
                 self.hacked = True
             elif self.hacked:
                 self.cn_hacker.restore()
                 self.cfg_hacker.restore()
                 self.lora_hacker.restore()
+                self.decode_hacker.restore()
                 motion_module.restore(p.sd_model)
                 self.hacked = False
 
@@ -220,6 +226,7 @@ if video_visible:
                 self.cn_hacker.restore()
                 self.cfg_hacker.restore()
                 self.lora_hacker.restore()
+                self.decode_hacker.restore()
                 motion_module.restore(p.sd_model)
                 self.hacked = False
                 AnimateDiffOutput().output(p, res, params)
@@ -541,6 +548,7 @@ def i2i_inpaint_call(
     p_img2img = StableDiffusionProcessingImg2Img(
         outpath_samples=outpath_samples,
         do_not_save_samples=do_not_save_samples,
+        do_not_save_grid=do_not_save_grid,
         outpath_grids=opts.outdir_grids or opts.outdir_img2img_grids,
         prompt=prompt,
         negative_prompt=negative_prompt,
@@ -32,6 +32,7 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 import ddpo_pytorch.prompts
 import ddpo_pytorch.rewards
 import utils.lora_utils as network_module
+from utils.progress_events import ProgressEvents
 from ddpo_pytorch.diffusers_patch.ddim_with_logprob import ddim_step_with_logprob
 from ddpo_pytorch.diffusers_patch.pipeline_with_logprob import pipeline_with_logprob
 from ddpo_pytorch.stat_tracking import PerPromptStatTracker
@@ -85,6 +86,12 @@ def parse_args():
         default="train_kohya_log.txt",
         help="The output log file path. Use the same log file as train_lora.py",
     )
+    parser.add_argument(
+        "--progress_file",
+        type=str,
+        default=None,
+        help="Append the structured progress events (JSON lines) of the reinforcement learning to this file.",
+    )
     parser.add_argument(
         "--num_epochs",
         type=int,
@@ -585,6 +592,10 @@ def main():
     if accelerator.is_main_process:
         output_log = open(args.cache_log_file, "w")
 
+    # The structured progress events are written by the main process only, a step is an epoch of sampling and training
+    progress_events = ProgressEvents(args.progress_file if accelerator.is_main_process else None, samples_per_step=samples_per_epoch)
+    progress_events.start_phase("rl", total_steps=args.num_epochs, start_step=first_epoch)
+
     global_step = 0
     for epoch in range(first_epoch, args.num_epochs):
         # SAMPLING
@@ -671,6 +682,7 @@ def main():
         if accelerator.is_main_process:
             output_log.write(log_line)
             output_log.flush()
+        progress_events.emit("scores", step=epoch + 1, reward_mean=float(rewards.mean()), reward_std=float(rewards.std()))
 
         # Tensorboard does not support adding caption for image data.
         if is_wandb_available() and args.report_to == "wandb":
@@ -807,6 +819,7 @@ def main():
 
             # make sure we did an optimization step at the end of the inner epoch
             assert accelerator.sync_gradients
+        progress_events.step(epoch + 1, reward_mean=float(rewards.mean()))
 
         # Save the best checkpoint and maintain a heap (except for epoch 0) with length `num_checkpoint_limit - 1`
         # by `reward_mean`. Note that, `reward_mean` corresponds to the model saved in last epoch.
@@ -844,6 +857,9 @@ def main():
             np.savetxt(os.path.join(args.logdir, "reward_mean.txt"), np.array(reward_mean_list), delimiter=",", fmt="%.4f")
             np.savetxt(os.path.join(args.logdir, "reward_std.txt"), np.array(reward_std_list), delimiter=",", fmt="%.4f")
 
+    best_reward_mean = cur_best_reward_mean[0] if np.isfinite(cur_best_reward_mean[0]) else None
+    progress_events.end_phase(best_reward_mean=None if best_reward_mean is None else float(best_reward_mean))
+    progress_events.close()
     # Save the lora layers
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
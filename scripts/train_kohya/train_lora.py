@@ -16,6 +16,7 @@
 import os
 import sys
 import gc
+import json
 
 import argparse
 import logging
@@ -56,6 +57,12 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 import utils.lora_utils as network_module
 from utils.model_utils import load_models_from_stable_diffusion_checkpoint
 from utils.gpu_info import gpu_monitor_decorator
+from utils.latent_cache import LatentCache
+from utils.text_embedding_cache import TextEmbeddingCache
+from utils.face_id_scorer import FaceIDScorer
+from utils.image_tensor_dataset import ImageTensorDataset, adaptive_num_workers
+from utils.early_stopping import FaceIDEarlyStopping
+from utils.progress_events import ProgressEvents
 
 torch.backends.cudnn.benchmark = True
 
@@ -67,6 +74,45 @@ check_min_version("0.18.0")
 
 logger = get_logger(__name__, log_level="INFO")
 
+# The validation pipeline is built once per run and kept between the validations.
+validation_pipeline = None
+# The face id scorer is shared by the evaluations of a run.
+face_id_scorer = None
+# The structured progress events of the run, written by the main process with --progress_file.
+progress_events = ProgressEvents()
+
+
+def get_validation_pipeline(noise_scheduler, tokenizer, args, accelerator, weight_dtype):
+    """
+    Get the inpaint pipeline of the validation on the accelerator device. It is built from the original checkpoint at
+    the first call, the later calls reuse it, because the LoRA is merged reversibly in `log_validation`.
+    """
+    global validation_pipeline
+    if validation_pipeline is None:
+        text_encoder, vae, unet = load_models_from_stable_diffusion_checkpoint(False, args.pretrained_model_ckpt)
+        pipeline = StableDiffusionInpaintPipeline(
+            tokenizer=tokenizer,
+            scheduler=noise_scheduler,
+            unet=unet.to(accelerator.device, weight_dtype),
+            text_encoder=text_encoder.to(accelerator.device, weight_dtype),
+            vae=vae.to(accelerator.device, weight_dtype),
+            safety_checker=None,
+            feature_extractor=None,
+        )
+        pipeline.safety_checker = None
+        pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
+        pipeline.set_progress_bar_config(disable=True)
+        validation_pipeline = pipeline
+    return validation_pipeline.to(accelerator.device)
+
+
+def release_validation_pipeline():
+    """Free the validation pipeline after the last validation."""
+    global validation_pipeline
+    validation_pipeline = None
+    gc.collect()
+    torch.cuda.empty_cache()
+
 
 def log_validation(
     network, noise_scheduler, vae, text_encoder, tokenizer, unet, args, accelerator, weight_dtype, epoch, global_step, **kwargs
@@ -92,24 +138,30 @@ def log_validation(
     Returns:
         None
     """
-    # When template_dir doesn't exist, generate randomly based on validation prompts.
-    text_encoder, vae, unet = load_models_from_stable_diffusion_checkpoint(False, args.pretrained_model_ckpt)
+    pipeline = get_validation_pipeline(noise_scheduler, tokenizer, args, accelerator, weight_dtype)
+    # Merge the current LoRA into the resident pipeline, the original weights are restored after the validation.
+    lora_backup = {}
+    network_module.merge_lora(pipeline, network.state_dict(), 1, "cuda", torch.float16, backup=lora_backup)
+    try:
+        with progress_events.interlude("validation", step=global_step):
+            images = generate_validation_images(pipeline, args, accelerator, global_step, **kwargs)
+    finally:
+        network_module.restore_lora(lora_backup)
+        if not args.validation_pipeline_on_gpu:
+            pipeline.to("cpu")
+        torch.cuda.empty_cache()
 
-    pipeline = StableDiffusionInpaintPipeline(
-        tokenizer=tokenizer,
-        scheduler=noise_scheduler,
-        unet=unet.to(accelerator.device, weight_dtype),
-        text_encoder=text_encoder.to(accelerator.device, weight_dtype),
-        vae=vae.to(accelerator.device, weight_dtype),
-        safety_checker=None,
-        feature_extractor=None,
-    )
-    pipeline = pipeline.to(accelerator.device)
-    pipeline.safety_checker = None
-    pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
-    pipeline.set_progress_bar_config(disable=True)
-
-    network_module.merge_lora(pipeline, network.state_dict(), 1, "cuda", torch.float16)
+    # Wandb or tensorboard if we have
+    for tracker in accelerator.trackers:
+        if tracker.name == "tensorboard":
+            for index, image in enumerate(images):
+                tracker.writer.add_images("validation_" + str(index), np.asarray(image), epoch, dataformats="HWC")
+        if tracker.name == "wandb":
+            tracker.log({"validation": [wandb.Image(image, caption=f"{i}: {args.validation_prompt}") for i, image in enumerate(images)]})
+
+
+def generate_validation_images(pipeline, args, accelerator, global_step, **kwargs):
+    """Generate the validation images with the pipeline and save them in the validation folder."""
     generator = torch.Generator(device=accelerator.device)
 
     if args.seed is not None:
@@ -159,18 +211,7 @@ def log_validation(
             if not os.path.exists(os.path.join(args.output_dir, "validation")):
                 os.makedirs(os.path.join(args.output_dir, "validation"))
             image.save(os.path.join(args.output_dir, "validation", f"global_step_{global_step}_" + str(index) + ".jpg"))
-
-    # Wandb or tensorboard if we have
-    for tracker in accelerator.trackers:
-        if tracker.name == "tensorboard":
-            for index, image in enumerate(images):
-                tracker.writer.add_images("validation_" + str(index), np.asarray(image), epoch, dataformats="HWC")
-        if tracker.name == "wandb":
-            tracker.log({"validation": [wandb.Image(image, caption=f"{i}: {args.validation_prompt}") for i, image in enumerate(images)]})
-
-    del pipeline
-    torch.cuda.empty_cache()
-    vae.to(accelerator.device, dtype=weight_dtype)
+    return images
 
 
 def safe_get_box_mask_keypoints(image, retinaface_result, crop_ratio, face_seg, mask_type):
@@ -235,30 +276,23 @@ def call_face_crop(retinaface_detection, image, crop_ratio, prefix="tmp"):
     return retinaface_box, retinaface_keypoints, retinaface_mask_pil
 
 
-def eval_jpg_with_faceid(pivot_dir, test_img_dir, top_merge=10):
+def face_id_pivot_array(pivot_dir, batch_size=1):
     """
-    Evaluate images using local face identification.
-
-    Args:
-        pivot_dir (str): Directory containing reference real human images.
-        test_img_dir (str): Directory pointing to generated validation images for training.
-            Image names follow the format xxxx_{step}_{indx}.jpg.
-        top_merge (int, optional): Number of top weights to select for merging. Defaults to 10.
-
-    Returns:
-        list: List of evaluated results.
-
-    Function:
-        - Obtain faceid features locally.
-        - Calculate the average feature of real human images.
-        - Select top_merge weights for merging based on generated validation images.
+    The face id embeddings [512, n] of the real human images, sorted with cosine distance to their mean. None if the face
+    recognition model fails to load or no face is detected.
     """
+    global face_id_scorer
     try:
         # embedding
-        face_recognition = modelscope_pipeline("face_recognition", model="bubbliiiing/cv_retinafce_recognition", model_revision="v1.0.3")
+        if face_id_scorer is None:
+            face_id_scorer = FaceIDScorer()
+            # Build the face recognition now to catch the loading error
+            face_id_scorer.face_recognition
+        face_id_scorer.batch_size = batch_size
     except Exception as e:
+        face_id_scorer = None
         print(f"Load face recognition model failed. {e}")
-        return [], [], []
+        return None
 
     # get ID list
     face_image_list = (
@@ -267,41 +301,50 @@ def eval_jpg_with_faceid(pivot_dir, test_img_dir, top_merge=10):
         + glob(os.path.join(pivot_dir, "*.png"))
         + glob(os.path.join(pivot_dir, "*.PNG"))
     )
-
-    #  vstack all embedding
-    embedding_list = []
-    for img in face_image_list:
-        try:
-            image = Image.open(img)
-            embedding = face_recognition(dict(user=image))[OutputKeys.IMG_EMBEDDING]
-            if embedding is not None:
-                embedding_list.append(embedding)
-        except Exception as e:
-            print("error at:", str(e))
+    embedding_list = [embedding for embedding in face_id_scorer.embed(face_image_list) if embedding is not None]
 
     if len(embedding_list) == 0:
         print("Can't detect faces in processed images, return empty list")
-        return [], [], []
+        return None
+
+    return face_id_scorer.pivot_embeddings(embedding_list)
 
-    # exception cause by embedding = None
-    try:
-        embedding_array = np.vstack(embedding_list)
-    except Exception as e:
-        print(f"vstack embedding failed, caused by {str(e)}")
-        return [], [], []
 
-    #  mean, get pivot
-    pivot_feature = np.mean(embedding_array, axis=0)
-    pivot_feature = np.reshape(pivot_feature, [512, 1])
+def face_id_scores_at_step(pivot_array, validation_dir, global_step):
+    """The face id scores of the validation images generated at global_step, for the images with a detected face."""
+    img_list = [
+        img
+        for img in glob(os.path.join(validation_dir, "*.jpg")) + glob(os.path.join(validation_dir, "*.png"))
+        if os.path.basename(img).split("_")[-2] == str(global_step)
+    ]
+    # The embeddings are cached next to the images and reused when ranking the validation images after training
+    embeddings = [embedding for embedding in face_id_scorer.embed(img_list) if embedding is not None]
+    _, scores = face_id_scorer.rank(embeddings, pivot_array, len(embeddings))
+    return [float(score) for score in scores]
+
+
+def eval_jpg_with_faceid(pivot_dir, test_img_dir, top_merge=10, batch_size=1):
+    """
+    Evaluate images using local face identification.
+
+    Args:
+        pivot_dir (str): Directory containing reference real human images.
+        test_img_dir (str): Directory pointing to generated validation images for training.
+            Image names follow the format xxxx_{step}_{indx}.jpg.
+        top_merge (int, optional): Number of top weights to select for merging. Defaults to 10.
+        batch_size (int, optional): Number of images embedded together. Defaults to 1.
 
-    # sort with cosine distance
-    embedding_list = [[np.dot(emb, pivot_feature)[0][0], emb] for emb in embedding_list]
-    embedding_list = sorted(embedding_list, key=lambda a: -a[0])
+    Returns:
+        list: List of evaluated results.
 
-    top10_embedding = [emb[1] for emb in embedding_list]
-    top10_embedding_array = np.vstack(top10_embedding)
-    # [512, n]
-    top10_embedding_array = np.swapaxes(top10_embedding_array, 0, 1)
+    Function:
+        - Obtain faceid features locally, cached next to the images by the face id scorer.
+        - Calculate the average feature of real human images.
+        - Select top_merge weights for merging based on generated validation images.
+    """
+    pivot_array = face_id_pivot_array(pivot_dir, batch_size=batch_size)
+    if pivot_array is None:
+        return [], [], []
 
     # sort all validation image
     result_list = []
@@ -312,17 +355,12 @@ def eval_jpg_with_faceid(pivot_dir, test_img_dir, top_merge=10):
             + glob(os.path.join(test_img_dir, "*.png"))
             + glob(os.path.join(test_img_dir, "*.PNG"))
         )
-        for img in img_list:
-            try:
-                # a average above all
-                image = Image.open(img)
-                embedding = face_recognition(dict(user=image))[OutputKeys.IMG_EMBEDDING]
-
-                res = np.mean(np.dot(embedding, top10_embedding_array))
-                result_list.append([res, img])
-                result_list = sorted(result_list, key=lambda a: -a[0])
-            except Exception as e:
-                print("error at:", str(e))
+        embeddings = face_id_scorer.embed(img_list)
+        img_list = [img for img, embedding in zip(img_list, embeddings) if embedding is not None]
+        embeddings = [embedding for embedding in embeddings if embedding is not None]
+        # a average above all
+        indexes, scores = face_id_scorer.rank(embeddings, pivot_array, top_merge)
+        result_list = [[score, img_list[index]] for index, score in zip(indexes, scores)]
 
     # pick most similar using faceid
     t_result_list = [i[1] for i in result_list][:top_merge]
@@ -392,6 +430,45 @@ def parse_args():
         action="store_true",
         help="whether to validation in whole training.",
     )
+    parser.add_argument(
+        "--face_id_batch_size",
+        type=int,
+        default=1,
+        help="The number of images embedded together by the face recognition when ranking the validation images.",
+    )
+    parser.add_argument(
+        "--progress_file",
+        type=str,
+        default=None,
+        help="Append the structured progress events (JSON lines) of the training, validations and merge to this file.",
+    )
+    parser.add_argument(
+        "--early_stopping_patience",
+        type=int,
+        default=None,
+        help=(
+            "Stop the training when the mean face id score of the validation images has not improved by"
+            " --early_stopping_min_delta for this number of validations (run every --validation_steps). The scores are"
+            " saved in face_id_curve.json of the output dir. Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--early_stopping_min_delta",
+        type=float,
+        default=0.005,
+        help="The smallest increase of the face id score counted as an improvement by the early stopping.",
+    )
+    parser.add_argument(
+        "--early_stopping_min_steps",
+        type=int,
+        default=0,
+        help="The early stopping never stops the training before this step.",
+    )
+    parser.add_argument(
+        "--validation_pipeline_on_gpu",
+        action="store_true",
+        help="Keep the resident validation pipeline on the GPU between the validations instead of offloading it to the CPU.",
+    )
     parser.add_argument("--validation_prompt", type=str, default=None, help="A prompt that is sampled during training for inference.")
     parser.add_argument(
         "--num_validation_images",
@@ -463,6 +540,28 @@ def parse_args():
         action="store_true",
         help="whether to randomly flip images horizontally",
     )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        help=(
+            "Whether to encode the training images (and their flips with --random_flip) by the VAE once before training and"
+            " sample the latents from the cache, the images are center cropped and the VAE is moved off the GPU."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help="Keep the latent cache in memory-mapped files in this directory instead of in memory.",
+    )
+    parser.add_argument(
+        "--cache_text_encoder_outputs",
+        action="store_true",
+        help=(
+            "Whether to encode each caption once before training and move the text encoder off the GPU. It only takes"
+            " effect without --train_text_encoder."
+        ),
+    )
     parser.add_argument("--train_batch_size", type=int, default=16, help="Batch size (per device) for the training dataloader.")
     parser.add_argument("--num_train_epochs", type=int, default=100)
     parser.add_argument(
@@ -529,7 +628,18 @@ def parse_args():
         "--dataloader_num_workers",
         type=int,
         default=0,
-        help=("Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."),
+        help=(
+            "The maximum number of subprocesses to use for data loading, the number used adapts to the size of the dataset. 0"
+            " means that the data will be loaded in the main process."
+        ),
+    )
+    parser.add_argument(
+        "--disable_in_memory_dataset",
+        action="store_true",
+        help=(
+            "Decode and transform the images in the data loader at every epoch instead of decoding and resizing them once"
+            " into memory, e.g. for a dataset too large to fit in memory."
+        ),
     )
     parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
     parser.add_argument("--adam_beta2", type=float, default=0.999, help="The beta2 parameter for the Adam optimizer.")
@@ -644,6 +754,26 @@ def parse_args():
         action="store_true",
         help=("Merge the best loras based on face_id."),
     )
+    parser.add_argument(
+        "--network_weights",
+        type=str,
+        default=None,
+        help=("Initialize the LoRA from these weights, e.g. the best LoRA of a previous training for an incremental training."),
+    )
+    parser.add_argument(
+        "--baseline_best_outputs_dir",
+        type=str,
+        default=None,
+        help=(
+            "The best outputs of a previous training. The face id score of its best validation image on the current training"
+            " images is saved with the new best score in best_outputs/face_id_score.json."
+        ),
+    )
+    parser.add_argument(
+        "--merge_weighted_by_face_id",
+        action="store_true",
+        help=("Weight the best loras by the face id scores of their validation images when merging, instead of the mean."),
+    )
     parser.add_argument(
         "--merge_best_lora_name",
         type=str,
@@ -776,6 +906,9 @@ def main():
         neuron_dropout=None,
     )
     network.apply_to(text_encoder, unet, args.train_text_encoder, True)
+    if args.network_weights is not None:
+        info = network.load_weights(args.network_weights)
+        logger.info(f"Load network weights from {args.network_weights}: {info}.")
     trainable_params = network.prepare_optimizer_params(args.learning_rate / 2, args.learning_rate, args.learning_rate)
 
     if args.enable_xformers_memory_efficient_attention:
@@ -930,28 +1063,118 @@ def main():
         examples["input_ids"] = tokenize_captions(examples)
         return examples
 
+    def preprocess_train_cached(examples):
+        examples["latent_flip"] = [int(args.random_flip and random.random() < 0.5) for _ in examples["latent_index"]]
+        examples["input_ids"] = tokenize_captions(examples)
+        return examples
+
     with accelerator.main_process_first():
         if args.max_train_samples is not None:
             dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
         # Set the training transforms
         train_dataset = dataset["train"].with_transform(preprocess_train)
 
+    latent_cache = None
+    if args.cache_latents:
+        if not args.center_crop:
+            logger.warning("The latent cache uses center cropped images, random crops are disabled.")
+        cache_transforms = transforms.Compose(
+            [
+                transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
+                transforms.CenterCrop(args.resolution),
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5]),
+            ]
+        )
+        start_time = time.time()
+        latent_cache = LatentCache.build(
+            vae,
+            dataset["train"][image_column],
+            cache_transforms,
+            accelerator.device,
+            weight_dtype,
+            flip=args.random_flip,
+            cache_dir=args.latent_cache_dir,
+        )
+        logger.info(f"Cached the latents of {len(latent_cache)} images in {time.time() - start_time:.2f}s, move the VAE to CPU.")
+        vae.to("cpu")
+        torch.cuda.empty_cache()
+
+        # The images are not decoded anymore, a sample only gives the index of its cached latents
+        train_dataset = dataset["train"].add_column("latent_index", list(range(len(dataset["train"]))))
+        train_dataset = train_dataset.remove_columns([image_column]).with_transform(preprocess_train_cached)
+
+    image_tensor_dataset = None
+    if latent_cache is None and not args.disable_in_memory_dataset:
+        start_time = time.time()
+        image_tensor_dataset = ImageTensorDataset.build(
+            dataset["train"][image_column],
+            dataset["train"][caption_column],
+            lambda captions: tokenizer(
+                captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+            ).input_ids,
+            args.resolution,
+            center_crop=args.center_crop,
+            random_flip=args.random_flip,
+        )
+        logger.info(
+            f"Decoded {len(image_tensor_dataset)} images into {image_tensor_dataset.nbytes / 2 ** 20:.1f}MB of memory in"
+            f" {time.time() - start_time:.2f}s."
+        )
+        # A sample only gives the index of its image, the crop and flip run on the GPU per batch
+        train_dataset = image_tensor_dataset
+
+    text_embedding_cache = None
+    if args.cache_text_encoder_outputs and not args.train_text_encoder:
+        captions = []
+        for caption in dataset["train"][caption_column]:
+            for _caption in [caption] if isinstance(caption, str) else list(caption):
+                if _caption not in captions:
+                    captions.append(_caption)
+        input_ids = tokenizer(
+            captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+        ).input_ids
+
+        text_embedding_cache = TextEmbeddingCache(
+            lambda input_ids_list: (text_encoder(input_ids_list[0].to(text_encoder.device))[0],), accelerator.device
+        )
+        text_embedding_cache.build([input_ids])
+        logger.info(f"Cached the text encoder outputs of {len(text_embedding_cache)} captions, move the text encoder to CPU.")
+        text_encoder.to("cpu")
+        torch.cuda.empty_cache()
+    elif args.cache_text_encoder_outputs:
+        logger.warning("The text encoder is trained, its outputs are not cached.")
+
     def collate_fn(examples):
+        input_ids = torch.stack([example["input_ids"] for example in examples])
+        if latent_cache is not None:
+            latent_index = torch.tensor([example["latent_index"] for example in examples])
+            latent_flip = torch.tensor([example["latent_flip"] for example in examples])
+            return {"latent_index": latent_index, "latent_flip": latent_flip, "input_ids": input_ids}
+        if image_tensor_dataset is not None:
+            image_index = torch.tensor([example["image_index"] for example in examples])
+            return {"image_index": image_index, "input_ids": input_ids}
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
         pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-        input_ids = torch.stack([example["input_ids"] for example in examples])
         return {"pixel_values": pixel_values, "input_ids": input_ids}
 
     # DataLoaders creation:
+    # The cached samples are only indices, workers pay off for large datasets only. Otherwise a worker decodes a batch,
+    # more workers than the batches of an epoch would stay idle.
+    if image_tensor_dataset is not None or latent_cache is not None:
+        dataloader_num_workers = adaptive_num_workers(len(train_dataset), args.dataloader_num_workers, 256)
+    else:
+        dataloader_num_workers = adaptive_num_workers(len(train_dataset), args.dataloader_num_workers, args.train_batch_size)
+    logger.info(f"Use {dataloader_num_workers} data loader workers for {len(train_dataset)} training images.")
     persistent_workers = True
-    if args.dataloader_num_workers == 0:
+    if dataloader_num_workers == 0:
         persistent_workers = False
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         shuffle=True,
         collate_fn=collate_fn,
         batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
+        num_workers=dataloader_num_workers,
         persistent_workers=persistent_workers,
     )
 
@@ -1098,6 +1321,30 @@ def main():
     if accelerator.is_main_process:
         output_log = open(args.cache_log_file, "w")
 
+    # Score the validations against the face id embeddings of the training images, computed once, to stop on a plateau
+    early_stopping = None
+    face_id_curve_path = os.path.join(args.output_dir, "face_id_curve.json")
+    if args.early_stopping_patience is not None and args.validation and args.validation_steps is not None:
+        early_stopping = FaceIDEarlyStopping(args.early_stopping_patience, args.early_stopping_min_delta, args.early_stopping_min_steps)
+        early_stopping_pivot_array = None
+        if accelerator.is_main_process:
+            early_stopping_pivot_array = face_id_pivot_array(os.path.join(args.train_data_dir, "train"), batch_size=args.face_id_batch_size)
+            if early_stopping_pivot_array is None:
+                logger.warning("No face id embedding of the training images, the early stopping is disabled.")
+        # All the processes have to agree to keep or disable the early stopping, only the main process has the pivot
+        disable_early_stopping = int(accelerator.is_main_process and early_stopping_pivot_array is None)
+        if accelerator.reduce(torch.tensor(disable_early_stopping, device=accelerator.device), reduction="sum").item() > 0:
+            early_stopping = None
+    elif args.early_stopping_patience is not None:
+        logger.warning("The early stopping needs --validation and --validation_steps, it is disabled.")
+    stop_training = False
+
+    global progress_events
+    if accelerator.is_main_process and args.progress_file is not None:
+        samples_per_step = args.train_batch_size * args.gradient_accumulation_steps * accelerator.num_processes
+        progress_events = ProgressEvents(args.progress_file, samples_per_step=samples_per_step)
+    progress_events.start_phase("train", total_steps=args.max_train_steps, start_step=global_step)
+
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
         train_loss = 0.0
@@ -1110,7 +1357,15 @@ def main():
 
             with accelerator.accumulate(unet):
                 # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                if latent_cache is not None:
+                    latents = latent_cache.sample(batch["latent_index"], batch["latent_flip"], device=accelerator.device)
+                    latents = latents.to(dtype=weight_dtype)
+                else:
+                    if image_tensor_dataset is not None:
+                        pixel_values = image_tensor_dataset.pixel_values(batch["image_index"], device=accelerator.device)
+                    else:
+                        pixel_values = batch["pixel_values"]
+                    latents = vae.encode(pixel_values.to(dtype=weight_dtype)).latent_dist.sample()
                 latents = latents * vae.config.scaling_factor
 
                 # Sample noise that we'll add to the latents
@@ -1129,7 +1384,10 @@ def main():
                 noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
                 # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(batch["input_ids"])[0]
+                if text_embedding_cache is not None:
+                    encoder_hidden_states = text_embedding_cache([batch["input_ids"]])[0]
+                else:
+                    encoder_hidden_states = text_encoder(batch["input_ids"])[0]
 
                 # Get the target for loss depending on the prediction type
                 if args.prediction_type is not None:
@@ -1185,6 +1443,7 @@ def main():
                 progress_bar.update(1)
                 global_step += 1
                 accelerator.log({"train_loss": train_loss}, step=global_step)
+                progress_events.step(global_step, loss=train_loss, lr=lr_scheduler.get_last_lr()[0])
                 train_loss = 0.0
 
                 if global_step % args.checkpointing_steps == 0:
@@ -1260,6 +1519,38 @@ def main():
                             torch.cuda.ipc_collect()
                             logger.info(f"Running validation error, skip it." f"Error info: {e}.")
 
+                if early_stopping is not None and global_step % args.validation_steps == 0:
+                    if accelerator.is_main_process:
+                        scores = face_id_scores_at_step(
+                            early_stopping_pivot_array, os.path.join(args.output_dir, "validation"), global_step
+                        )
+                        stop_training = early_stopping.update(global_step, scores)
+                        early_stopping.save(face_id_curve_path)
+                        progress_events.emit(
+                            "scores", phase="validation", step=global_step, scores=scores, best_score=early_stopping.best_score
+                        )
+                        logger.info(
+                            f"Face id scores at step {global_step}: {scores}, best {early_stopping.best_score} at step {early_stopping.best_step}."
+                        )
+                    # The validation runs in the main process only, it decides for all the processes
+                    stop_training = (
+                        accelerator.reduce(torch.tensor(int(stop_training), device=accelerator.device), reduction="sum").item() > 0
+                    )
+                    if stop_training:
+                        log_line = (
+                            f"{str(time.asctime(time.localtime(time.time())))} early stopping lora of {user_id} at step {global_step},"
+                            f" the face id score has not improved since step {early_stopping.best_step}\n"
+                        )
+                        logger.info(log_line.strip())
+                        if accelerator.is_main_process:
+                            output_log.write(log_line)
+                            output_log.flush()
+                        progress_events.emit("early_stop", step=global_step, best_step=early_stopping.best_step)
+                        break
+
+        if stop_training:
+            break
+
         if accelerator.is_main_process:
             if (
                 args.validation_steps is None
@@ -1294,6 +1585,7 @@ def main():
                     torch.cuda.empty_cache()
                     torch.cuda.ipc_collect()
                     logger.info(f"Running validation error, skip it." f"Error info: {e}.")
+    progress_events.end_phase(step=global_step)
     # Save the lora layers
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -1328,7 +1620,9 @@ def main():
                 torch.cuda.empty_cache()
                 torch.cuda.ipc_collect()
                 logger.info(f"Running validation error, skip it." f"Error info: {e}.")
+            release_validation_pipeline()
 
+        progress_events.start_phase("merge")
         img_list = (
             glob(os.path.join(os.path.join(args.output_dir, "validation"), "*.jpg"))
             + glob(os.path.join(os.path.join(args.output_dir, "validation"), "*.JPG"))
@@ -1339,11 +1633,14 @@ def main():
         if args.merge_best_lora_based_face_id and args.validation and len(img_list) != 0:
             pivot_dir = os.path.join(args.train_data_dir, "train")
             merge_best_lora_name = args.train_data_dir.split("/")[-1] if args.merge_best_lora_name is None else args.merge_best_lora_name
-            t_result_list, tlist, scores = eval_jpg_with_faceid(pivot_dir, os.path.join(args.output_dir, "validation"))
+            t_result_list, tlist, scores = eval_jpg_with_faceid(
+                pivot_dir, os.path.join(args.output_dir, "validation"), batch_size=args.face_id_batch_size
+            )
 
             for index, line in enumerate(zip(tlist, scores)):
                 print(f"Top-{str(index)}: {str(line)}")
                 logger.info(f"Top-{str(index)}: {str(line)}")
+            progress_events.emit("scores", steps=[int(step) for step in tlist], scores=[float(score) for score in scores])
 
             best_outputs_dir = os.path.join(args.output_dir, "best_outputs")
             os.makedirs(best_outputs_dir, exist_ok=True)
@@ -1372,12 +1669,30 @@ def main():
                     os.path.join(best_outputs_dir, merge_best_lora_name + ".safetensors"),
                 )
             else:
-                lora_save_path = network_module.merge_from_name_and_index(merge_best_lora_name, tlist, output_dir=args.output_dir)
+                lora_save_path = network_module.merge_from_name_and_index(
+                    merge_best_lora_name,
+                    tlist,
+                    output_dir=args.output_dir,
+                    scores=scores if args.merge_weighted_by_face_id else None,
+                )
                 logger.info(f"Save Best Merged Loras To:{lora_save_path}.")
 
                 for result in t_result_list[:1]:
                     copyfile(result, os.path.join(best_outputs_dir, os.path.basename(result)))
                 copyfile(lora_save_path, os.path.join(best_outputs_dir, os.path.basename(lora_save_path)))
+
+                # Record the best face id score, with the score of the previous best outputs on the same training images for
+                # an incremental training to decide whether the new LoRA is better.
+                face_id_score = {"score": float(scores[0]), "baseline_score": None}
+                if args.baseline_best_outputs_dir is not None and os.path.exists(args.baseline_best_outputs_dir):
+                    _, _, baseline_scores = eval_jpg_with_faceid(
+                        pivot_dir, args.baseline_best_outputs_dir, top_merge=1, batch_size=args.face_id_batch_size
+                    )
+                    if len(baseline_scores) > 0:
+                        face_id_score["baseline_score"] = float(baseline_scores[0])
+                    logger.info(f"Face id score {face_id_score['score']}, baseline face id score {face_id_score['baseline_score']}.")
+                with open(os.path.join(best_outputs_dir, "face_id_score.json"), "w") as f:
+                    json.dump(face_id_score, f)
         else:
             best_outputs_dir = os.path.join(args.output_dir, "best_outputs")
             os.makedirs(best_outputs_dir, exist_ok=True)
@@ -1387,6 +1702,9 @@ def main():
                 os.path.join(best_outputs_dir, merge_best_lora_name + ".safetensors"),
             )
 
+        progress_events.end_phase()
+        progress_events.close()
+
         # we will remove cache_log_file after train
         open(args.cache_log_file, "w")
 
@@ -48,6 +48,9 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 import utils.lora_utils as network_module
 from utils.model_utils import load_models_from_sdxl_checkpoint
 from utils.lora_utils_diffusers import merge_lora_weights
+from utils.latent_cache import LatentCache
+from utils.text_embedding_cache import TextEmbeddingCache
+from utils.progress_events import ProgressEvents
 
 torch.backends.cudnn.benchmark = True
 
@@ -165,6 +168,28 @@ def parse_args():
         action="store_true",
         help="whether to randomly flip images horizontally",
     )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        help=(
+            "Whether to encode the training images (and their flips with --random_flip) by the VAE once before training and"
+            " sample the latents from the cache, the images are center cropped and the VAE is moved off the GPU."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help="Keep the latent cache in memory-mapped files in this directory instead of in memory.",
+    )
+    parser.add_argument(
+        "--cache_text_encoder_outputs",
+        action="store_true",
+        help=(
+            "Whether to encode each caption once before training and move the text encoders off the GPU. It only takes"
+            " effect without --train_text_encoder."
+        ),
+    )
     parser.add_argument(
         "--dataset_name",
         type=str,
@@ -453,6 +478,12 @@ def parse_args():
         default="train_kohya_log.txt",
         help=("The output log file path."),
     )
+    parser.add_argument(
+        "--progress_file",
+        type=str,
+        default=None,
+        help=("Append the structured progress events (JSON lines) of the training and validations to this file."),
+    )
     parser.add_argument(
         "--train_scene_lora_bool",
         action="store_true",
@@ -850,22 +881,96 @@ def main():
     with accelerator.main_process_first():
         # Set the training transforms
         train_dataset = dataset["train"].with_transform(preprocess_train)
+
+    latent_cache = None
+    if args.cache_latents:
+        if not args.center_crop:
+            logger.warning("The latent cache uses center cropped images, random crops are disabled.")
+        cache_images = [image.convert("RGB") for image in dataset["train"][image_column]]
+        cache_original_sizes = [(image.height, image.width) for image in cache_images]
+        cache_crop_top_lefts = []
+        for image in cache_images:
+            image = train_resize(image)
+            y1 = max(0, int(round((image.height - args.resolution) / 2.0)))
+            x1 = max(0, int(round((image.width - args.resolution) / 2.0)))
+            cache_crop_top_lefts.append((y1, x1))
+        cache_transforms = transforms.Compose([train_resize, transforms.CenterCrop(args.resolution), train_transforms])
+
+        start_time = time.time()
+        latent_cache = LatentCache.build(
+            vae,
+            cache_images,
+            cache_transforms,
+            accelerator.device,
+            vae.dtype,
+            flip=args.random_flip,
+            cache_dir=args.latent_cache_dir,
+        )
+        logger.info(f"Cached the latents of {len(latent_cache)} images in {time.time() - start_time:.2f}s, move the VAE to CPU.")
+        vae.to("cpu")
+        torch.cuda.empty_cache()
+
+        def preprocess_train_cached(examples):
+            examples["latent_flip"] = [int(args.random_flip and random.random() < 0.5) for _ in examples["latent_index"]]
+            examples["original_sizes"] = [cache_original_sizes[index] for index in examples["latent_index"]]
+            examples["crop_top_lefts"] = [cache_crop_top_lefts[index] for index in examples["latent_index"]]
+            tokens_one, tokens_two = tokenize_captions(examples)
+            examples["input_ids_one"] = tokens_one
+            examples["input_ids_two"] = tokens_two
+            return examples
+
+        # The images are not decoded anymore, a sample only gives the index of its cached latents
+        train_dataset = dataset["train"].add_column("latent_index", list(range(len(dataset["train"]))))
+        train_dataset = train_dataset.remove_columns([image_column]).with_transform(preprocess_train_cached)
     
     
+    text_embedding_cache = None
+    if args.cache_text_encoder_outputs and not args.train_text_encoder:
+        captions = []
+        for caption in dataset["train"][caption_column]:
+            for _caption in [caption] if isinstance(caption, str) else list(caption):
+                if _caption not in captions:
+                    captions.append(_caption)
+
+        text_embedding_cache = TextEmbeddingCache(
+            lambda input_ids_list: encode_prompt([text_encoder_one, text_encoder_two], None, None, text_input_ids_list=input_ids_list),
+            accelerator.device,
+        )
+        text_embedding_cache.build([tokenize_prompt(tokenizer_one, captions), tokenize_prompt(tokenizer_two, captions)])
+        logger.info(f"Cached the text encoder outputs of {len(text_embedding_cache)} captions, move the text encoders to CPU.")
+        text_encoder_one.to("cpu")
+        text_encoder_two.to("cpu")
+        torch.cuda.empty_cache()
+    elif args.cache_text_encoder_outputs:
+        logger.warning("The text encoders are trained, their outputs are not cached.")
+
+    # The time ids only depend on the original size and the crop of an image, so they are computed once per pair.
+    time_ids_cache = {}
+
+    def get_time_ids(original_size, crops_coords_top_left):
+        key = (tuple(original_size), tuple(crops_coords_top_left))
+        if key not in time_ids_cache:
+            time_ids_cache[key] = compute_time_ids(original_size, crops_coords_top_left)
+        return time_ids_cache[key]
+
     def collate_fn(examples):
-        pixel_values = torch.stack([example["pixel_values"] for example in examples])
-        pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
         original_sizes = [example["original_sizes"] for example in examples]
         crop_top_lefts = [example["crop_top_lefts"] for example in examples]
         input_ids_one = torch.stack([example["input_ids_one"] for example in examples])
         input_ids_two = torch.stack([example["input_ids_two"] for example in examples])
-        return {
-            "pixel_values": pixel_values,
+        batch = {
             "input_ids_one": input_ids_one,
             "input_ids_two": input_ids_two,
             "original_sizes": original_sizes,
             "crop_top_lefts": crop_top_lefts,
         }
+        if latent_cache is not None:
+            batch["latent_index"] = torch.tensor([example["latent_index"] for example in examples])
+            batch["latent_flip"] = torch.tensor([example["latent_flip"] for example in examples])
+        else:
+            pixel_values = torch.stack([example["pixel_values"] for example in examples])
+            batch["pixel_values"] = pixel_values.to(memory_format=torch.contiguous_format).float()
+        return batch
 
     # DataLoaders creation:
     persistent_workers = True
@@ -982,6 +1087,11 @@ def main():
     if accelerator.is_main_process:
         output_log = open(args.cache_log_file, "w")
 
+    # The structured progress events are written by the main process only
+    samples_per_step = args.train_batch_size * args.gradient_accumulation_steps * accelerator.num_processes
+    progress_events = ProgressEvents(args.progress_file if accelerator.is_main_process else None, samples_per_step=samples_per_step)
+    progress_events.start_phase("train", total_steps=args.max_train_steps, start_step=global_step)
+
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
         train_loss = 0.0
@@ -996,13 +1106,16 @@ def main():
                 continue
 
             with accelerator.accumulate(unet):
-                if args.pretrained_vae_model_name_or_path is None:
-                    pixel_values = batch["pixel_values"]
-                else:
-                    pixel_values = batch["pixel_values"].to(dtype=weight_dtype)
-
                 # Convert images to latent space
-                model_input = vae.encode(pixel_values).latent_dist.sample()
+                if latent_cache is not None:
+                    model_input = latent_cache.sample(batch["latent_index"], batch["latent_flip"], device=accelerator.device)
+                    model_input = model_input.to(dtype=vae.dtype)
+                else:
+                    if args.pretrained_vae_model_name_or_path is None:
+                        pixel_values = batch["pixel_values"]
+                    else:
+                        pixel_values = batch["pixel_values"].to(dtype=weight_dtype)
+                    model_input = vae.encode(pixel_values).latent_dist.sample()
                 model_input = model_input * vae.config.scaling_factor
                 if args.pretrained_vae_model_name_or_path is None:
                     model_input = model_input.to(weight_dtype)
@@ -1021,17 +1134,18 @@ def main():
                 # (this is the forward diffusion process)
                 noisy_model_input = noise_scheduler.add_noise(model_input, noise, timesteps)
 
-                add_time_ids = torch.cat(
-                    [compute_time_ids(s, c) for s, c in zip(batch["original_sizes"], batch["crop_top_lefts"])]
-                )
+                add_time_ids = torch.cat([get_time_ids(s, c) for s, c in zip(batch["original_sizes"], batch["crop_top_lefts"])])
 
                 # Predict the noise residual
-                prompt_embeds, pooled_prompt_embeds = encode_prompt(
-                    text_encoders=[text_encoder_one, text_encoder_two],
-                    tokenizers=None,
-                    prompt=None,
-                    text_input_ids_list=[batch["input_ids_one"], batch["input_ids_two"]],
-                )
+                if text_embedding_cache is not None:
+                    prompt_embeds, pooled_prompt_embeds = text_embedding_cache([batch["input_ids_one"], batch["input_ids_two"]])
+                else:
+                    prompt_embeds, pooled_prompt_embeds = encode_prompt(
+                        text_encoders=[text_encoder_one, text_encoder_two],
+                        tokenizers=None,
+                        prompt=None,
+                        text_input_ids_list=[batch["input_ids_one"], batch["input_ids_two"]],
+                    )
                 unet_added_conditions = {"time_ids": add_time_ids}
                 unet_added_conditions.update({"text_embeds": pooled_prompt_embeds})
 
@@ -1073,6 +1187,7 @@ def main():
                 progress_bar.update(1)
                 global_step += 1
                 accelerator.log({"train_loss": train_loss}, step=global_step)
+                progress_events.step(global_step, loss=train_loss, lr=lr_scheduler.get_last_lr()[0])
                 train_loss = 0.0
 
                 if global_step % args.checkpointing_steps == 0:
@@ -1123,7 +1238,8 @@ def main():
                         f"Running validation... \n Generating {args.num_validation_images} images with prompt:"
                         f" {args.validation_prompt}."
                     )
-                    log_validation(args, accelerator, weight_dtype, network, global_step)
+                    with progress_events.interlude("validation", step=global_step):
+                        log_validation(args, accelerator, weight_dtype, network, global_step)
 
         # Epoch-level validation.
         if accelerator.is_main_process:
@@ -1136,8 +1252,10 @@ def main():
                 logger.info(
                     f"Running validation... \n Generating {args.num_validation_images} images with prompt:" f" {args.validation_prompt}."
                 )
-                log_validation(args, accelerator, weight_dtype, network, global_step)
+                with progress_events.interlude("validation", step=global_step):
+                    log_validation(args, accelerator, weight_dtype, network, global_step)
 
+    progress_events.end_phase(step=global_step)
     # Save the lora layers
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -1148,7 +1266,9 @@ def main():
             accelerator.save_state(accelerator_save_path)
 
         if args.validation:
-            log_validation(args, accelerator, weight_dtype, network, global_step)
+            with progress_events.interlude("validation", step=global_step):
+                log_validation(args, accelerator, weight_dtype, network, global_step)
+        progress_events.close()
         # TODO: Model selection.
 
         # we will remove cache_log_file after train
@@ -0,0 +1,108 @@
+"""
+A scheduler running the preprocessing and training commands of concurrent trainings on a pool of GPU slots.
+
+Each command waits for a free GPU, runs with `CUDA_VISIBLE_DEVICES` set to it, gets a free rendezvous port for
+`accelerate launch` and writes its outputs to the log of its job. The queued commands start in order as soon as a GPU
+is released.
+"""
+import os
+import socket
+import subprocess
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+def find_free_port():
+    """Get a free TCP port on localhost from the OS."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_gpus(gpus):
+    """Parse the GPU ids of the setting, e.g. "0,1,2,3", an empty string gives no GPU."""
+    return [gpu.strip() for gpu in str(gpus).split(",") if gpu.strip() != ""]
+
+
+class TrainingScheduler:
+    """A pool of GPU slots shared by the training jobs, with a first-in first-out queue of the waiting commands."""
+
+    def __init__(self, gpus, log_dir):
+        """
+        Args:
+            gpus (List[str]): The ids of the GPUs, one slot per GPU.
+            log_dir (str): The directory of the logs of the jobs.
+        """
+        self.gpus = list(gpus)
+        self.log_dir = log_dir
+        self.free_gpus = deque(self.gpus)
+        self.waiting = deque()
+        self.used_ports = set()
+        self.condition = threading.Condition()
+
+    def job_log_path(self, job_name):
+        return os.path.join(self.log_dir, f"train_job_{job_name}.log")
+
+    def job_progress_path(self, job_name):
+        """The progress file of a job, read by the UI as the shared `cache_log_file_path` of a single training."""
+        return os.path.join(self.log_dir, f"train_kohya_log_{job_name}.txt")
+
+    def _allocate_port(self):
+        while True:
+            port = find_free_port()
+            if port not in self.used_ports:
+                self.used_ports.add(port)
+                return port
+
+    @contextmanager
+    def slot(self):
+        """Wait for a free GPU and a rendezvous port, and release them afterwards."""
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or len(self.free_gpus) == 0:
+                self.condition.wait()
+            self.waiting.popleft()
+            gpu = self.free_gpus.popleft()
+            port = self._allocate_port()
+            # The next waiting command may take another free GPU.
+            self.condition.notify_all()
+        try:
+            yield gpu, port
+        finally:
+            with self.condition:
+                self.free_gpus.append(gpu)
+                self.used_ports.discard(port)
+                self.condition.notify_all()
+
+    def run(self, command, job_name, env=None):
+        """
+        Run a command in a GPU slot like `subprocess.run(command, env=env, check=True)`, with its outputs appended to
+        the log of the job. The `--main_process_port` of an `accelerate launch` command is replaced by a free port.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        with self.slot() as (gpu, port):
+            command = [f"--main_process_port={port}" if arg.startswith("--main_process_port=") else arg for arg in command]
+            env = dict(os.environ if env is None else env)
+            env["CUDA_VISIBLE_DEVICES"] = gpu
+            with open(self.job_log_path(job_name), "a") as log_file:
+                log_file.write(f"Run on GPU {gpu} with port {port}: {' '.join(command)}\n")
+                log_file.flush()
+                return subprocess.run(command, env=env, stdout=log_file, stderr=subprocess.STDOUT, check=True)
+
+
+training_scheduler = None
+training_scheduler_lock = threading.Lock()
+
+
+def get_training_scheduler(gpus, log_dir):
+    """Get the scheduler of the GPUs, None without GPUs. It is rebuilt when the GPUs change."""
+    global training_scheduler
+    gpus = parse_gpus(gpus)
+    with training_scheduler_lock:
+        if len(gpus) == 0:
+            training_scheduler = None
+        elif training_scheduler is None or training_scheduler.gpus != gpus or training_scheduler.log_dir != log_dir:
+            training_scheduler = TrainingScheduler(gpus, log_dir)
+        return training_scheduler
@@ -0,0 +1,274 @@
+"""
+A persistent worker that runs the preprocessing and training scripts of EasyPhoto in one long-lived process.
+
+Every job started by `subprocess.run` imports torch, diffusers and modelscope again and reloads the preprocessing
+models from disk. The worker imports them once, keeps the modelscope pipelines built by the jobs warm, and runs each
+job in-process with `runpy`, streaming its output back over a local socket. The jobs run one at a time.
+
+The client side (`run_training_command`) falls back to `subprocess.run` when the worker is disabled, cannot start, or
+the command cannot run in-process (multi-process accelerate launches or a custom environment).
+"""
+import argparse
+import atexit
+import gc
+import os
+import runpy
+import secrets
+import subprocess
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener
+
+READY_PREFIX = "EASYPHOTO_TRAIN_WORKER_READY"
+AUTHKEY_ENV = "EASYPHOTO_TRAIN_WORKER_AUTHKEY"
+
+
+def command_to_job(command):
+    """
+    Convert a `python script.py ...` or `python -m accelerate.commands.launch ... script.py ...` command to a job of the
+    worker. None is returned for the commands that cannot run in-process.
+    """
+    if len(command) >= 2 and command[1].endswith(".py"):
+        return dict(script=command[1], argv=list(command[2:]), env={})
+    if len(command) < 4 or command[1:3] != ["-m", "accelerate.commands.launch"]:
+        return None
+
+    env = {}
+    for index, arg in enumerate(command[3:], start=3):
+        if arg.endswith(".py"):
+            return dict(script=arg, argv=list(command[index + 1 :]), env=env)
+        name, _, value = arg.partition("=")
+        if name == "--mixed_precision":
+            env["ACCELERATE_MIXED_PRECISION"] = value
+        elif name == "--num_processes":
+            if int(value) != 1:
+                return None
+        elif name != "--main_process_port":
+            return None
+    return None
+
+
+class JobOutput:
+    """
+    A text stream installed once as the stdout/stderr of the worker. The writes are sent to the client of the running
+    job, or go to the original stream between the jobs and from the forked processes (e.g. the dataloader workers).
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.conn = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if self.conn is None or os.getpid() != self.pid:
+            return self.stream.write(data)
+        if len(data) > 0:
+            with self.lock:
+                try:
+                    self.conn.send(dict(type="output", data=data))
+                except (EOFError, OSError):
+                    # The client is gone, the job goes on and writes to the original stream.
+                    self.conn = None
+                    self.stream.write(data)
+        return len(data)
+
+    def flush(self):
+        if self.conn is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+
+def keep_modelscope_pipelines_warm():
+    """Memoize `modelscope.pipelines.pipeline`, so the jobs reuse the models built by the previous jobs."""
+    import modelscope.pipelines
+
+    build_pipeline = modelscope.pipelines.pipeline
+    pipelines = {}
+
+    def pipeline(*args, **kwargs):
+        key = repr((args, sorted(kwargs.items())))
+        if key not in pipelines:
+            pipelines[key] = build_pipeline(*args, **kwargs)
+        return pipelines[key]
+
+    modelscope.pipelines.pipeline = pipeline
+
+
+def reset_job_state():
+    """Release the memory of a finished job and the global state of accelerate, so the next job starts clean."""
+    gc.collect()
+    try:
+        import torch
+
+        torch.cuda.empty_cache()
+    except Exception:
+        pass
+    try:
+        from accelerate.state import AcceleratorState, GradientState
+
+        AcceleratorState._reset_state(reset_partial_state=True)
+        GradientState._reset_state()
+    except Exception:
+        pass
+
+
+def run_job(job, conn):
+    """Run the script of a job as `__main__` with its arguments and environment, and return its exit code."""
+    saved_argv, saved_path, saved_environ = sys.argv, list(sys.path), dict(os.environ)
+    sys.argv = [job["script"]] + job["argv"]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(job["script"])))
+    os.environ.update(job["env"])
+    sys.stdout.conn = sys.stderr.conn = conn
+    try:
+        runpy.run_path(job["script"], run_name="__main__")
+        returncode = 0
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        sys.stderr.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        sys.stdout.conn = sys.stderr.conn = None
+        sys.argv, sys.path[:] = saved_argv, saved_path
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        reset_job_state()
+    return returncode
+
+
+def serve():
+    # Import the heavy libraries once, the jobs reuse them.
+    import diffusers  # noqa: F401
+    import torch  # noqa: F401
+    import transformers  # noqa: F401
+
+    keep_modelscope_pipelines_warm()
+
+    listener = Listener(("127.0.0.1", 0), authkey=os.environ[AUTHKEY_ENV].encode())
+    print(f"{READY_PREFIX} {listener.address[1]}", flush=True)
+    # The logging handlers created by the jobs keep the streams, so they are replaced once for all the jobs.
+    sys.stdout, sys.stderr = JobOutput(sys.stdout), JobOutput(sys.stderr)
+    while True:
+        conn = listener.accept()
+        try:
+            message = conn.recv()
+            if message["type"] == "shutdown":
+                break
+            returncode = run_job(message["job"], conn)
+            conn.send(dict(type="done", returncode=returncode))
+        except (EOFError, OSError) as e:
+            print(f"Train worker lost the client: {e}", flush=True)
+        finally:
+            conn.close()
+    listener.close()
+
+
+class TrainWorker:
+    """The client of a worker process started by it."""
+
+    def __init__(self, python_executable):
+        self.python_executable = python_executable
+        self.authkey = secrets.token_hex(16)
+        self.process = None
+        self.port = None
+
+    def start(self):
+        env = os.environ.copy()
+        env[AUTHKEY_ENV] = self.authkey
+        self.process = subprocess.Popen(
+            [self.python_executable, os.path.abspath(__file__)], env=env, stdout=subprocess.PIPE, text=True, bufsize=1
+        )
+        for line in self.process.stdout:
+            if line.startswith(READY_PREFIX):
+                self.port = int(line.split()[1])
+                break
+            sys.stdout.write(line)
+        if self.port is None:
+            raise RuntimeError(f"Train worker exited during start with code {self.process.wait()}.")
+        # Forward the later outputs of the worker which are not part of a job.
+        threading.Thread(target=self._forward_stdout, daemon=True).start()
+
+    def _forward_stdout(self):
+        for line in self.process.stdout:
+            sys.stdout.write(line)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, command, job):
+        """Run a job in the worker, raise `subprocess.CalledProcessError` if it fails as `subprocess.run` does."""
+        conn = Client(("127.0.0.1", self.port), authkey=self.authkey.encode())
+        try:
+            conn.send(dict(type="job", job=job))
+            while True:
+                message = conn.recv()
+                if message["type"] == "output":
+                    sys.stdout.write(message["data"])
+                    sys.stdout.flush()
+                elif message["type"] == "done":
+                    returncode = message["returncode"]
+                    break
+        except (EOFError, OSError):
+            returncode = self.process.poll() if self.process.poll() is not None else 1
+        finally:
+            conn.close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+
+    def close(self):
+        if not self.is_alive():
+            return
+        try:
+            conn = Client(("127.0.0.1", self.port), authkey=self.authkey.encode())
+            conn.send(dict(type="shutdown"))
+            conn.close()
+            self.process.wait(timeout=30)
+        except Exception:
+            self.process.kill()
+
+
+train_worker = None
+train_worker_lock = threading.Lock()
+
+
+def get_train_worker(python_executable):
+    """Get the worker process, it is started at the first call and again if it has died."""
+    global train_worker
+    if train_worker is None or not train_worker.is_alive():
+        train_worker = TrainWorker(python_executable)
+        train_worker.start()
+        atexit.register(train_worker.close)
+    return train_worker
+
+
+def run_training_command(command, env=None, use_worker=False, scheduler=None, job_name=None):
+    """
+    Run a preprocessing or training command like `subprocess.run(command, env=env, check=True)`.
+
+    With a scheduler (train_scheduler.py), the command runs as a subprocess in a GPU slot of the scheduler, with the
+    outputs in the log of job_name. Otherwise with use_worker, the command runs in the persistent worker when it can run
+    in-process, or as a subprocess when it cannot or if the worker cannot start.
+    """
+    if scheduler is not None:
+        return scheduler.run(command, job_name, env=env)
+    job = command_to_job(command) if use_worker and env is None else None
+    if job is not None:
+        with train_worker_lock:
+            try:
+                worker = get_train_worker(command[0])
+            except Exception as e:
+                print(f"Start train worker failed, run the command as a subprocess. Error info: {e}")
+                worker = None
+            if worker is not None:
+                return worker.run(command, job)
+    return subprocess.run(command, env=env, check=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="The persistent preprocessing and training worker of EasyPhoto.")
+    parser.parse_args()
+    serve()
@@ -0,0 +1,63 @@
+import json
+from typing import List, Optional
+
+import numpy as np
+
+
+class FaceIDEarlyStopping:
+    """
+    Stop the training when the face id score of the validation images plateaus.
+
+    The score of a validation is the mean face id score of its images with a detected face. The training stops once the
+    best score has not improved by more than min_delta for patience validations in a row, after min_steps. The scores of
+    all the validations are recorded as a curve.
+    """
+
+    def __init__(self, patience: int, min_delta: float = 0.0, min_steps: int = 0):
+        """
+        Args:
+            patience (int): The number of validations without improvement before stopping.
+            min_delta (float, optional): The smallest increase of the score counted as an improvement. Defaults to 0.0.
+            min_steps (int, optional): The training never stops before this step. Defaults to 0.
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_steps = min_steps
+        self.best_score: Optional[float] = None
+        self.best_step: Optional[int] = None
+        self.stopped_step: Optional[int] = None
+        self.num_bad_validations = 0
+        self.curve = []
+
+    def update(self, step: int, scores: List[float]) -> bool:
+        """
+        Record the face id scores of the validation images at step.
+
+        Returns:
+            bool: Whether to stop the training.
+        """
+        if len(scores) == 0:
+            # No face is detected in the validation images, it says nothing about the plateau
+            self.curve.append({"step": step, "score": None, "max_score": None, "num_faces": 0})
+            return False
+
+        score = float(np.mean(scores))
+        self.curve.append({"step": step, "score": score, "max_score": float(np.max(scores)), "num_faces": len(scores)})
+        if self.best_score is None or score > self.best_score + self.min_delta:
+            self.best_score, self.best_step = score, step
+            self.num_bad_validations = 0
+        else:
+            self.num_bad_validations += 1
+
+        if step >= self.min_steps and self.num_bad_validations >= self.patience:
+            self.stopped_step = step
+            return True
+        return False
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(
+                {"best_step": self.best_step, "best_score": self.best_score, "stopped_step": self.stopped_step, "curve": self.curve},
+                f,
+                indent=2,
+            )
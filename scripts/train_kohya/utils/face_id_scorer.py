@@ -0,0 +1,155 @@
+import hashlib
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# The embeddings of the images in a directory are cached in this sidecar file, keyed by the hash of the image files.
+FACE_ID_CACHE_NAME = "face_id_embeddings.npz"
+
+
+class FaceIDScorer:
+    """
+    Face ID embeddings of image files and their ranking against the embeddings of the real person.
+
+    The face recognition pipeline is built once and shared by the calls. The embeddings are cached in a .npz sidecar
+    next to the images, so an image is only embedded again when its file changes. An image without a detected face is
+    cached as an empty embedding, an image whose embedding failed (e.g. out of memory) is not cached and is embedded again
+    by the next call.
+    """
+
+    def __init__(self, face_recognition=None, batch_size: int = 1):
+        """
+        Args:
+            face_recognition (optional): A modelscope face_recognition pipeline, built at the first use if None.
+            batch_size (int, optional): The number of images embedded by one call of the pipeline. Defaults to 1.
+        """
+        self._face_recognition = face_recognition
+        self.batch_size = batch_size
+
+    @property
+    def face_recognition(self):
+        if self._face_recognition is None:
+            from modelscope.pipelines import pipeline as modelscope_pipeline
+
+            self._face_recognition = modelscope_pipeline(
+                "face_recognition", model="bubbliiiing/cv_retinafce_recognition", model_revision="v1.0.3"
+            )
+        return self._face_recognition
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def _load_cache(cache_path: str) -> Dict[str, np.ndarray]:
+        if not os.path.exists(cache_path):
+            return {}
+        try:
+            with np.load(cache_path) as data:
+                return {key: data[key] for key in data.files}
+        except Exception as e:
+            print(f"Load face id cache {cache_path} failed, rebuild it. {e}")
+            return {}
+
+    @staticmethod
+    def _save_cache(cache_path: str, cache: Dict[str, np.ndarray]):
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **cache)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"Save face id cache {cache_path} failed. {e}")
+
+    def _embedding(self, output) -> np.ndarray:
+        from modelscope.outputs import OutputKeys
+
+        embedding = output[OutputKeys.IMG_EMBEDDING]
+        if embedding is None:
+            return np.zeros([0, 512], np.float32)
+        return np.reshape(embedding, [1, -1])
+
+    def embed_images(self, images: List[Image.Image]) -> List[Optional[np.ndarray]]:
+        """
+        Embed the images, an image without a detected face gives an empty [0, 512] embedding and an image whose face
+        recognition failed gives None.
+        """
+        embeddings = []
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start : start + self.batch_size]
+            if len(batch) > 1:
+                try:
+                    outputs = self.face_recognition([dict(user=image) for image in batch], batch_size=len(batch))
+                    embeddings.extend(self._embedding(output) for output in outputs)
+                    continue
+                except Exception as e:
+                    print(f"Batched face recognition failed, embed the images one by one. {e}")
+            for image in batch:
+                try:
+                    embeddings.append(self._embedding(self.face_recognition(dict(user=image))))
+                except Exception as e:
+                    print("error at:", str(e))
+                    embeddings.append(None)
+        return embeddings
+
+    def embed(self, image_paths: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Get the embeddings [1, 512] of the image files, from the sidecar cache of their directory when possible.
+
+        Returns:
+            List[Optional[np.ndarray]]: The embeddings in the order of image_paths, None for the images without a face or
+                whose face recognition failed.
+        """
+        results: List[Optional[np.ndarray]] = [None] * len(image_paths)
+        groups: Dict[str, List[int]] = {}
+        for index, path in enumerate(image_paths):
+            groups.setdefault(os.path.dirname(os.path.abspath(path)), []).append(index)
+
+        for directory, indexes in groups.items():
+            cache_path = os.path.join(directory, FACE_ID_CACHE_NAME)
+            cache = self._load_cache(cache_path)
+            keys = {index: self.file_hash(image_paths[index]) for index in indexes}
+            missing = [index for index in indexes if keys[index] not in cache]
+            if len(missing) > 0:
+                images = []
+                for index in missing:
+                    with Image.open(image_paths[index]) as image:
+                        image.load()
+                        images.append(image)
+                for index, embedding in zip(missing, self.embed_images(images)):
+                    # A failure is not a missing face, it is retried by the next call
+                    if embedding is not None:
+                        cache[keys[index]] = embedding
+                self._save_cache(cache_path, cache)
+            for index in indexes:
+                embedding = cache.get(keys[index], None)
+                results[index] = embedding if embedding is not None and embedding.shape[0] > 0 else None
+        return results
+
+    @staticmethod
+    def pivot_embeddings(embeddings: List[np.ndarray]) -> np.ndarray:
+        """Stack the embeddings of the real person into [512, n], ordered by their similarity to the mean embedding."""
+        embedding_array = np.vstack(embeddings)
+        pivot_feature = np.reshape(np.mean(embedding_array, axis=0), [-1, 1])
+        order = np.argsort(-np.dot(embedding_array, pivot_feature)[:, 0], kind="stable")
+        return np.swapaxes(embedding_array[order], 0, 1)
+
+    @staticmethod
+    def rank(embeddings: List[np.ndarray], pivot_array: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rank the embeddings by their mean cosine similarity to the pivot embeddings [512, n].
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The indexes of the top_k embeddings from the most similar, and their scores.
+        """
+        if len(embeddings) == 0:
+            return np.zeros([0], np.int64), np.zeros([0], np.float32)
+        scores = np.mean(np.dot(np.vstack(embeddings), pivot_array), axis=1)
+        top_k = min(top_k, len(scores))
+        indexes = np.argpartition(-scores, top_k - 1)[:top_k]
+        # Sort the top_k only, the ties keep the order of the embeddings
+        indexes = indexes[np.lexsort((indexes, -scores[indexes]))]
+        return indexes, scores[indexes]
@@ -0,0 +1,146 @@
+import os
+import random
+from typing import Callable, Iterable, List, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+def adaptive_num_workers(num_samples: int, max_workers: int, samples_per_worker: int) -> int:
+    """
+    The number of data loader workers for a dataset: one worker per samples_per_worker samples, at most max_workers and the
+    number of CPUs. A small dataset is loaded in the main process, where forking the workers would cost more than loading.
+    """
+    return max(0, min(max_workers, os.cpu_count() or 1, num_samples // max(samples_per_worker, 1)))
+
+
+class ImageTensorDataset(torch.utils.data.Dataset):
+    """
+    The training images decoded and resized once into a uint8 tensor in shared memory, with their captions tokenized once.
+
+    A sample is the index of its image and the token ids of one of its captions, so the data loader does no image work. The
+    random crop and flip of a batch run on its device in `pixel_values`. The images smaller than the largest one are padded
+    in the tensor, their sizes bound the random crops.
+    """
+
+    def __init__(
+        self,
+        images: torch.Tensor,
+        sizes: torch.Tensor,
+        input_ids: torch.Tensor,
+        caption_ranges: torch.Tensor,
+        resolution: int,
+        random_flip: bool = False,
+    ):
+        """
+        Args:
+            images (torch.Tensor): The resized images [N, 3, H, W] in uint8.
+            sizes (torch.Tensor): The height and width of each image before padding [N, 2].
+            input_ids (torch.Tensor): The token ids of all the captions [M, L].
+            caption_ranges (torch.Tensor): The first caption and the number of captions of each image [N, 2].
+            resolution (int): The size of the square crops.
+            random_flip (bool, optional): Flip the crops horizontally at random. Defaults to False.
+        """
+        self.images = images
+        self.sizes = sizes
+        self.input_ids = input_ids
+        self.caption_ranges = caption_ranges
+        self.resolution = resolution
+        self.random_flip = random_flip
+
+    @classmethod
+    def build(
+        cls,
+        images: Iterable[Image.Image],
+        captions: List[Union[str, List[str]]],
+        tokenize: Callable[[List[str]], torch.Tensor],
+        resolution: int,
+        center_crop: bool = False,
+        random_flip: bool = False,
+    ) -> "ImageTensorDataset":
+        """
+        Decode, resize and tokenize the training set.
+
+        Args:
+            images (Iterable[Image.Image]): The training images.
+            captions (List[Union[str, List[str]]]): The caption of each image, or a list of captions to pick from at random.
+            tokenize (Callable[[List[str]], torch.Tensor]): Map the captions to their token ids [B, L].
+            resolution (int): The shorter side of the resized images and the size of the crops.
+            center_crop (bool, optional): Crop the center of the images once here instead of random crops. Defaults to False.
+            random_flip (bool, optional): Flip the crops horizontally at random. Defaults to False.
+
+        Returns:
+            ImageTensorDataset: The dataset, indexed in the order of images.
+        """
+        resize = transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR)
+        crop = transforms.CenterCrop(resolution)
+        arrays = []
+        for image in images:
+            image = resize(image.convert("RGB"))
+            arrays.append(np.array(crop(image) if center_crop else image))
+
+        sizes = torch.tensor([array.shape[:2] for array in arrays], dtype=torch.int64).reshape(-1, 2)
+        height, width = sizes.max(dim=0).values.tolist() if len(arrays) > 0 else (resolution, resolution)
+        tensor = torch.zeros([len(arrays), 3, height, width], dtype=torch.uint8)
+        for index, array in enumerate(arrays):
+            tensor[index, :, : array.shape[0], : array.shape[1]] = torch.from_numpy(array).permute(2, 0, 1)
+
+        all_captions, caption_ranges = [], []
+        for caption in captions:
+            if isinstance(caption, str):
+                caption = [caption]
+            elif isinstance(caption, (list, np.ndarray)):
+                caption = list(caption)
+            else:
+                raise ValueError("Captions should contain either strings or lists of strings.")
+            caption_ranges.append([len(all_captions), len(caption)])
+            all_captions.extend(caption)
+        input_ids = tokenize(all_captions)
+
+        # The data loader workers read the tensors without copying them
+        return cls(
+            tensor.share_memory_(),
+            sizes.share_memory_(),
+            input_ids.share_memory_(),
+            torch.tensor(caption_ranges, dtype=torch.int64).reshape(-1, 2).share_memory_(),
+            resolution,
+            random_flip=random_flip,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.images.element_size() * self.images.nelement() + self.input_ids.element_size() * self.input_ids.nelement()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        start, count = self.caption_ranges[index].tolist()
+        return {"image_index": index, "input_ids": self.input_ids[start + random.randrange(count)]}
+
+    def pixel_values(self, image_index, device=None) -> torch.Tensor:
+        """
+        Get the pixel values of a batch, as Resize, RandomCrop (or CenterCrop), RandomHorizontalFlip, ToTensor and
+        Normalize([0.5], [0.5]) give.
+
+        Args:
+            image_index: The indices of the images in the batch.
+            device (optional): The device to crop, flip and normalize on.
+
+        Returns:
+            torch.Tensor: The pixel values [B, 3, resolution, resolution] in float32 within [-1, 1].
+        """
+        image_index = torch.as_tensor(image_index).cpu()
+        images = self.images[image_index].to(device, non_blocking=True)
+        crops = []
+        for offset, (height, width) in enumerate(self.sizes[image_index].tolist()):
+            top = random.randint(0, height - self.resolution)
+            left = random.randint(0, width - self.resolution)
+            crop = images[offset, :, top : top + self.resolution, left : left + self.resolution]
+            if self.random_flip and random.random() < 0.5:
+                crop = torch.flip(crop, dims=[-1])
+            crops.append(crop)
+        pixel_values = torch.stack(crops).float().div(255)
+        return pixel_values.sub_(0.5).div_(0.5).contiguous()
@@ -0,0 +1,111 @@
+import os
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class LatentCache:
+    """
+    The VAE latent distributions (mean and std) of the training images, and of their horizontal flips if needed.
+
+    The training images do not change over the steps, so they are encoded once and a step only samples a latent from
+    the cached distribution instead of running the VAE encoder. The cache is kept in memory, or in memory-mapped .npy
+    files when cache_dir is given.
+    """
+
+    def __init__(self, mean, std):
+        # [N, F, C, H, W], F is 2 with the flipped images
+        self.mean = mean
+        self.std = std
+
+    def __len__(self):
+        return len(self.mean)
+
+    @property
+    def num_flips(self) -> int:
+        return self.mean.shape[1]
+
+    @classmethod
+    @torch.no_grad()
+    def build(
+        cls,
+        vae,
+        images: List[Image.Image],
+        transform: Callable,
+        device,
+        dtype,
+        flip: bool = False,
+        batch_size: int = 8,
+        cache_dir: Optional[str] = None,
+    ) -> "LatentCache":
+        """
+        Encode the images with the VAE.
+
+        Args:
+            vae: The VAE, on device with dtype.
+            images (List[Image.Image]): The training images.
+            transform (Callable): The deterministic transform from an image to its normalized pixel tensor.
+            device: The device to encode on.
+            dtype: The dtype of the VAE inputs.
+            flip (bool, optional): Also encode the horizontal flip of each image. Defaults to False.
+            batch_size (int, optional): The number of images encoded together. Defaults to 8.
+            cache_dir (Optional[str], optional): Save the cache to memory-mapped files in this directory. Defaults to None.
+
+        Returns:
+            LatentCache: The cache, indexed in the order of images.
+        """
+        means, stds = [], []
+        for start in range(0, len(images), batch_size):
+            pixel_values = torch.stack([transform(image.convert("RGB")) for image in images[start : start + batch_size]])
+            variants = [pixel_values, torch.flip(pixel_values, dims=[-1])] if flip else [pixel_values]
+            batch_means, batch_stds = [], []
+            for variant in variants:
+                latent_dist = vae.encode(variant.to(device, dtype=dtype)).latent_dist
+                batch_means.append(latent_dist.mean.float().cpu())
+                batch_stds.append(latent_dist.std.float().cpu())
+            means.append(torch.stack(batch_means, dim=1))
+            stds.append(torch.stack(batch_stds, dim=1))
+        mean, std = torch.cat(means), torch.cat(stds)
+
+        if cache_dir is None:
+            return cls(mean, std)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = []
+        for name, tensor in [("latent_mean.npy", mean), ("latent_std.npy", std)]:
+            path = os.path.join(cache_dir, name)
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=tuple(tensor.shape))
+            array[:] = tensor.numpy()
+            array.flush()
+            del array
+            arrays.append(np.load(path, mmap_mode="r"))
+        return cls(*arrays)
+
+    def _gather(self, array, indices: np.ndarray, flips: np.ndarray) -> torch.Tensor:
+        if isinstance(array, torch.Tensor):
+            return array[torch.from_numpy(indices), torch.from_numpy(flips)]
+        return torch.from_numpy(np.ascontiguousarray(array[indices, flips]))
+
+    def sample(self, indices, flips=None, device=None, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+        """
+        Sample the latents of a batch, as `vae.encode(pixel_values).latent_dist.sample()` does (before the scaling factor).
+
+        Args:
+            indices: The indices of the images in the batch.
+            flips (optional): 1 for the images to flip, all 0 if None.
+            device (optional): The device of the returned latents.
+            generator (Optional[torch.Generator], optional): The generator of the noise.
+
+        Returns:
+            torch.Tensor: The latents [B, C, H, W] in float32.
+        """
+        indices = np.asarray(torch.as_tensor(indices).cpu(), dtype=np.int64)
+        flips = np.zeros_like(indices) if flips is None else np.asarray(torch.as_tensor(flips).cpu(), dtype=np.int64)
+        flips = np.minimum(flips, self.num_flips - 1)
+
+        mean = self._gather(self.mean, indices, flips).to(device)
+        std = self._gather(self.std, indices, flips).to(device)
+        noise = torch.randn(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+        return mean + std * noise
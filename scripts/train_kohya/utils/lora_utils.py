@@ -4,13 +4,16 @@
 # https://github.com/cloneofsimo/lora/blob/master/lora_diffusion/lora.py
 
 import hashlib
+import json
 import math
 import os
 import re
 from collections import defaultdict
+from contextlib import ExitStack
 from io import BytesIO
 from typing import Dict, List, Optional, Tuple, Type, Union
 
+import safetensors
 import safetensors.torch
 import torch
 from diffusers import AutoencoderKL
@@ -1222,51 +1225,142 @@ class LoRANetwork(torch.nn.Module):
         return keys_scaled, sum(norms) / len(norms), max(norms)
 
 
-def merge_different_loras(loras_load_path, lora_save_path, ratios=None):
-    if ratios is None:
-        ratios = [1 / float(len(loras_load_path)) for _ in loras_load_path]
-
-    state_dict = {}
-    for lora_load, ratio in zip(loras_load_path, ratios):
-        if os.path.splitext(lora_load)[1] == ".safetensors":
-            from safetensors.torch import load_file
+def fill_safetensors_hashes(path: str):
+    """
+    Compute the hashes of `precalculate_safetensors_hashes` by streaming over a written .safetensors file, and fill them
+    in place into the sshs_model_hash and sshs_legacy_hash metadata saved as placeholders of the same length.
 
-            weights_sd = load_file(lora_load)
+    The hashes are defined on the file saved with only the ss_ metadata. Its tensor data are the same as the written
+    file, only its header differs, so the header is rebuilt to locate the bytes of the legacy hash in the data.
+    """
+    with open(path, "r+b") as f:
+        n = int.from_bytes(f.read(8), "little")
+        header_bytes = f.read(n)
+        header = json.loads(header_bytes)
+        metadata = header.pop("__metadata__", {})
+        ss_metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+        hashed_header = dict(__metadata__=ss_metadata, **header)
+        hashed_n = len(json.dumps(hashed_header, separators=(",", ":")).encode())
+        hashed_n += -hashed_n % 8
+
+        model_hash = addnet_hash_safetensors(f)
+        if 0x100000 >= hashed_n + 8:
+            f.seek(8 + n + 0x100000 - hashed_n - 8)
+            legacy_hash = hashlib.sha256(f.read(0x10000)).hexdigest()[0:8]
         else:
-            weights_sd = torch.load(lora_load, map_location="cpu")
+            # The header is larger than the offset of the legacy hash, hash the rebuilt bytes in memory.
+            f.seek(8 + n)
+            hashed_bytes = hashed_n.to_bytes(8, "little") + json.dumps(hashed_header, separators=(",", ":")).encode().ljust(hashed_n)
+            legacy_hash = addnet_hash_legacy(BytesIO(hashed_bytes + f.read()))
+
+        for key, value in [("sshs_model_hash", model_hash), ("sshs_legacy_hash", legacy_hash)]:
+            placeholder = json.dumps({key: "0" * len(value)}, separators=(",", ":"))[1:-1].encode()
+            assert header_bytes.count(placeholder) == 1, f"No placeholder of {key} in {path}."
+            header_bytes = header_bytes.replace(placeholder, json.dumps({key: value}, separators=(",", ":"))[1:-1].encode())
+        f.seek(8)
+        f.write(header_bytes)
+    return model_hash, legacy_hash
 
-        for key in weights_sd.keys():
-            if key not in state_dict.keys():
-                state_dict[key] = weights_sd[key] * ratio
-            else:
-                state_dict[key] += weights_sd[key] * ratio
 
-        if os.path.splitext(lora_save_path)[1] == ".safetensors":
-            from safetensors.torch import save_file
+def merge_different_loras(loras_load_path, lora_save_path, ratios=None, memory_budget=256 * 1024**2):
+    """
+    Merge the LoRAs as the weighted sum of their tensors, and save the result once.
 
-            metadata = {}
-            model_hash, legacy_hash = precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
+    The .safetensors inputs are read lazily with `safe_open`. The keys are merged a group at a time, the float32
+    accumulators of a group fit in memory_budget bytes, and each merged tensor keeps the dtype of its first input. The
+    hashes of the saved .safetensors are computed over the written file.
 
-            save_file(state_dict, lora_save_path, metadata)
-        else:
-            torch.save(state_dict, lora_save_path)
+    Args:
+        loras_load_path (List[str]): The paths of the LoRAs, a path may repeat to count it several times.
+        lora_save_path (str): The path of the merged LoRA.
+        ratios (List[float], optional): The weight of each LoRA. Defaults to the mean.
+        memory_budget (int, optional): The bytes of the float32 accumulators of a group. Defaults to 256MB.
+    """
+    if ratios is None:
+        ratios = [1 / float(len(loras_load_path)) for _ in loras_load_path]
+
+    with ExitStack() as stack:
+        # A .safetensors is a lazy handle, other formats are loaded into a state dict.
+        handles = []
+        for lora_load in loras_load_path:
+            if os.path.splitext(lora_load)[1] == ".safetensors":
+                handles.append(stack.enter_context(safetensors.safe_open(lora_load, framework="pt", device="cpu")))
+            else:
+                handles.append(torch.load(lora_load, map_location="cpu"))
+
+        def numel(handle, key):
+            return math.prod(handle.get_slice(key).get_shape()) if not isinstance(handle, dict) else handle[key].numel()
+
+        # Group the keys in the order of their first appearance, by the memory of their accumulators.
+        groups, group, group_bytes = [], [], 0
+        seen = set()
+        for handle in handles:
+            for key in handle.keys():
+                if key in seen:
+                    continue
+                seen.add(key)
+                key_bytes = numel(handle, key) * 4
+                if len(group) > 0 and group_bytes + key_bytes > memory_budget:
+                    groups.append(group)
+                    group, group_bytes = [], 0
+                group.append(key)
+                group_bytes += key_bytes
+        if len(group) > 0:
+            groups.append(group)
+
+        state_dict = {}
+        handles_keys = [set(handle.keys()) for handle in handles]
+        for group in groups:
+            accumulators, dtypes = {}, {}
+            for handle, keys, ratio in zip(handles, handles_keys, ratios):
+                for key in group:
+                    if key not in keys:
+                        continue
+                    tensor = handle.get_tensor(key) if not isinstance(handle, dict) else handle[key]
+                    if key not in accumulators:
+                        dtypes[key] = tensor.dtype
+                        accumulators[key] = tensor.to(torch.float32) * ratio
+                    else:
+                        accumulators[key] += tensor.to(torch.float32) * ratio
+            for key in group:
+                state_dict[key] = accumulators.pop(key).to(dtypes[key])
+
+    if os.path.splitext(lora_save_path)[1] == ".safetensors":
+        from safetensors.torch import save_file
+
+        # The hashes are filled in place after the single write.
+        metadata = {"sshs_model_hash": "0" * 64, "sshs_legacy_hash": "0" * 8}
+        save_file(state_dict, lora_save_path, metadata)
+        fill_safetensors_hashes(lora_save_path)
+    else:
+        torch.save(state_dict, lora_save_path)
     return
 
 
-def merge_from_name_and_index(name, index_list, output_dir="output_dir/"):
+def face_id_merge_ratios(scores):
+    """The merge weights of the LoRAs, proportional to the face id scores of their validation images."""
+    scores = [max(float(score), 0.0) for score in scores]
+    if sum(scores) <= 0:
+        return [1 / float(len(scores)) for _ in scores]
+    return [score / sum(scores) for score in scores]
+
+
+def merge_from_name_and_index(name, index_list, output_dir="output_dir/", scores=None):
     loras_load_path = [os.path.join(output_dir, f"checkpoint-{i}.safetensors") for i in index_list]
     lora_save_path = os.path.join(output_dir, f"{name}.safetensors")
     for lora_load_path in loras_load_path:
         assert os.path.exists(lora_load_path) is True
-    merge_different_loras(loras_load_path, lora_save_path)
+    ratios = face_id_merge_ratios(scores) if scores is not None else None
+    merge_different_loras(loras_load_path, lora_save_path, ratios=ratios)
     return lora_save_path
 
 
-def merge_lora(pipeline, lora_state_dict, multiplier=1, device="cpu", dtype=torch.float32):
+def merge_lora(pipeline, lora_state_dict, multiplier=1, device="cpu", dtype=torch.float32, backup=None):
     """Merge state_dict in LoRANetwork to the pipeline in diffusers.
 
+    When a dict is given as backup, the original weight of each merged layer is copied to it on CPU (only at the
+    first merge into the layer), so that `restore_lora` can remove the LoRA afterwards.
+
     Reference:
     1. https://github.com/huggingface/diffusers/issues/3064#issuecomment-1512429695.
     """
@@ -1304,6 +1398,8 @@ def merge_lora(pipeline, lora_state_dict, multiplier=1, device="cpu", dtype=torc
             alpha = elems["alpha"].item() / weight_up.shape[1]
         else:
             alpha = 1.0
+        if backup is not None and curr_layer not in backup:
+            backup[curr_layer] = curr_layer.weight.data.to("cpu", copy=True)
         curr_layer.weight.data = curr_layer.weight.data.to(device)
         if len(weight_up.shape) == 4:
             curr_layer.weight.data += (
@@ -1314,6 +1410,13 @@ def merge_lora(pipeline, lora_state_dict, multiplier=1, device="cpu", dtype=torc
     return pipeline
 
 
+def restore_lora(backup):
+    """Restore the layer weights backed up by `merge_lora`, which removes the merged LoRA exactly."""
+    for layer, weight in backup.items():
+        layer.weight.data = weight.to(layer.weight.device, dtype=layer.weight.dtype)
+    backup.clear()
+
+
 def convert_lora_to_safetensors(in_lora_file: str, out_lora_file: str):
     """Converts the diffusers format (.bin/.pkl) lora file `in_lora_file`
     into the SD webUI format (.safetensors) lora file `out_lora_file`.
@@ -0,0 +1,157 @@
+"""
+Structured progress events of the preprocessing and training scripts, written as JSON lines.
+
+Each line is one event with the time, the phase (preprocess, train, validation, merge or rl) and the event name:
+- phase_start / phase_end: a phase starts (with its total number of steps) or ends (with its elapsed time);
+- step: the step and total steps of the phase, the loss, steps/s, samples/s, the ETA of the phase and the peak GPU memory;
+- scores: the face id or reward scores of a validation.
+
+The scripts of a training append to the same file in turn. Readers tail it from a byte offset, so a client polling the
+progress only reads the events written since its last call. The module only depends on the standard library, it is
+imported by the scripts and by the webui.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+
+def peak_memory_mb() -> Optional[float]:
+    """The peak GPU memory allocated by torch in this process, None without CUDA or before torch is imported."""
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return None
+    try:
+        if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+            return None
+        return round(torch.cuda.max_memory_allocated() / 2**20, 1)
+    except Exception:
+        return None
+
+
+class ProgressEvents:
+    """The writer of the progress events of a script, it writes nothing without a path (e.g. in the non-main processes)."""
+
+    def __init__(self, path: Optional[str] = None, samples_per_step: int = 1, min_interval: float = 1.0):
+        """
+        Args:
+            path (Optional[str]): The JSON lines file the events are appended to. Defaults to None.
+            samples_per_step (int, optional): The number of samples of a step, for samples/s. Defaults to 1.
+            min_interval (float, optional): The step events are written at most once per min_interval seconds, except the
+                last step of a phase. Defaults to 1.0.
+        """
+        self.path = path
+        self.samples_per_step = samples_per_step
+        self.min_interval = min_interval
+        self.file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, "a")
+        self.phase = None
+        self.total_steps = None
+        self.phase_start_time = None
+        self.last_step = None
+        self.last_step_time = None
+
+    def emit(self, event: str, **fields):
+        if self.file is None:
+            return
+        record = {"time": round(time.time(), 3), "phase": self.phase, "event": event}
+        record.update({key: value for key, value in fields.items() if value is not None})
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def start_phase(self, phase: str, total_steps: Optional[int] = None, start_step: int = 0, **fields):
+        self.phase = phase
+        self.total_steps = total_steps
+        self.phase_start_time = self.last_step_time = time.time()
+        self.last_step = start_step
+        self.emit("phase_start", total_steps=total_steps, **fields)
+
+    def end_phase(self, **fields):
+        elapsed = None if self.phase_start_time is None else round(time.time() - self.phase_start_time, 3)
+        self.emit("phase_end", elapsed=elapsed, peak_memory_mb=peak_memory_mb(), **fields)
+
+    def step(self, step: int, loss: Optional[float] = None, **fields):
+        """Report the step of the current phase, the rates are measured since the previous step event."""
+        now = time.time()
+        last = self.total_steps is not None and step >= self.total_steps
+        if self.file is None or (not last and self.last_step_time is not None and now - self.last_step_time < self.min_interval):
+            return
+        steps_per_second = None
+        if self.last_step is not None and self.last_step_time is not None and now > self.last_step_time and step > self.last_step:
+            steps_per_second = (step - self.last_step) / (now - self.last_step_time)
+        eta = None
+        if steps_per_second is not None and self.total_steps is not None:
+            eta = round(max(self.total_steps - step, 0) / steps_per_second, 1)
+        self.emit(
+            "step",
+            step=step,
+            total_steps=self.total_steps,
+            loss=None if loss is None else float(loss),
+            steps_per_second=None if steps_per_second is None else round(steps_per_second, 4),
+            samples_per_second=None if steps_per_second is None else round(steps_per_second * self.samples_per_step, 4),
+            eta_seconds=eta,
+            peak_memory_mb=peak_memory_mb(),
+            **fields,
+        )
+        self.last_step, self.last_step_time = step, now
+
+    @contextmanager
+    def interlude(self, phase: str, **fields):
+        """A phase inside the current one (e.g. a validation during training), excluded from the rates of the current phase."""
+        start_time = time.time()
+        self.emit("phase_start", phase=phase, **fields)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            self.emit("phase_end", phase=phase, elapsed=round(elapsed, 3), peak_memory_mb=peak_memory_mb(), **fields)
+            if self.last_step_time is not None:
+                self.last_step_time += elapsed
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_progress_events(path: str, offset: int = 0) -> Tuple[List[dict], int]:
+    """
+    Read the events written after a byte offset of the progress file.
+
+    Args:
+        path (str): The progress file.
+        offset (int, optional): The offset returned by the previous call, 0 to read from the start. Defaults to 0.
+
+    Returns:
+        Tuple[List[dict], int]: The complete events after offset and the offset for the next call. A file restarted by a
+            new training (smaller than offset) is read from the start.
+    """
+    if not os.path.exists(path):
+        return [], 0
+    if offset > os.path.getsize(path):
+        offset = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    # A line being written is read by the next call
+    end = data.rfind(b"\n") + 1
+    events = []
+    for line in data[:end].splitlines():
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    return events, offset + end
+
+
+def latest_progress_event(path: str, tail_bytes: int = 65536) -> Optional[dict]:
+    """The last complete event of the progress file, from its tail only, None if there is none."""
+    if not os.path.exists(path):
+        return None
+    offset = max(os.path.getsize(path) - tail_bytes, 0)
+    events, _ = read_progress_events(path, offset)
+    return events[-1] if len(events) > 0 else None
@@ -0,0 +1,54 @@
+from typing import Callable, List, Tuple
+
+import torch
+
+
+class TextEmbeddingCache:
+    """
+    The outputs of the frozen text encoder(s) keyed by the token ids of the caption.
+
+    Without training the text encoder, a caption always gives the same embeddings. The captions of a training set are
+    few, so they are encoded once before training and a step only gathers the cached outputs, the text encoders can then
+    be moved off the GPU.
+    """
+
+    def __init__(self, encode: Callable[[List[torch.Tensor]], Tuple[torch.Tensor, ...]], device=None):
+        """
+        Args:
+            encode (Callable): Map a list of token ids [B, L] (one per tokenizer) to a tuple of outputs with batch size B.
+            device (optional): The device of the cached outputs.
+        """
+        self.encode = encode
+        self.device = device
+        self.cache = {}
+
+    @staticmethod
+    def _keys(input_ids_list: List[torch.Tensor]) -> List[tuple]:
+        rows = [input_ids.tolist() for input_ids in input_ids_list]
+        return [tuple(tuple(row[index]) for row in rows) for index in range(len(rows[0]))]
+
+    @torch.no_grad()
+    def build(self, input_ids_list: List[torch.Tensor], batch_size: int = 16):
+        """Encode the unique captions in the token ids (one tensor [N, L] per tokenizer)."""
+        keys = self._keys(input_ids_list)
+        unique, seen = [], set(self.cache)
+        for index, key in enumerate(keys):
+            if key not in seen:
+                seen.add(key)
+                unique.append(index)
+        for start in range(0, len(unique), batch_size):
+            indices = unique[start : start + batch_size]
+            outputs = self.encode([input_ids[indices] for input_ids in input_ids_list])
+            for offset, index in enumerate(indices):
+                self.cache[keys[index]] = tuple(output[offset].detach().to(self.device) for output in outputs)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __call__(self, input_ids_list: List[torch.Tensor]) -> Tuple[torch.Tensor, ...]:
+        """Get the outputs of a batch of token ids, the captions missing from the cache are encoded first."""
+        keys = self._keys(input_ids_list)
+        if any(key not in self.cache for key in keys):
+            self.build([input_ids.cpu() for input_ids in input_ids_list])
+        outputs = [self.cache[key] for key in keys]
+        return tuple(torch.stack(output) for output in zip(*outputs))
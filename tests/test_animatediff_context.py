@@ -0,0 +1,94 @@
+"""
+The context windows of AnimateDiff without the webui: the precomputed schedule and the grouped windows have to give the
+same result as the original per-window loop over `uniform`.
+
+The scheduling methods of AnimateDiffInfV2V only depend on numpy and torch, they are taken from the source of
+animatediff_utils.py, which imports the webui modules.
+"""
+import ast
+import itertools
+import os
+from functools import lru_cache
+
+import numpy as np
+import pytest
+import torch
+
+ANIMATEDIFF_UTILS_PATH = os.path.join(os.path.dirname(__file__), "..", "scripts", "easyphoto_utils", "animatediff_utils.py")
+SCHEDULE_METHODS = ["ordered_halving", "uniform", "context_schedule", "context_groups"]
+
+
+def load_scheduler():
+    with open(ANIMATEDIFF_UTILS_PATH, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef) and node.name == "AnimateDiffInfV2V":
+            methods = [item for item in node.body if isinstance(item, ast.FunctionDef) and item.name in SCHEDULE_METHODS]
+            if len(methods) == len(SCHEDULE_METHODS):
+                break
+    else:
+        raise RuntimeError("The scheduling methods of AnimateDiffInfV2V are not found.")
+    module = ast.Module(
+        body=[ast.ClassDef(name="AnimateDiffInfV2V", bases=[], keywords=[], body=methods, decorator_list=[])], type_ignores=[]
+    )
+    namespace = {"np": np, "torch": torch, "lru_cache": lru_cache}
+    exec(compile(ast.fix_missing_locations(module), ANIMATEDIFF_UTILS_PATH, "exec"), namespace)
+    return namespace["AnimateDiffInfV2V"]
+
+
+AnimateDiffInfV2V = load_scheduler()
+
+SETTINGS = list(
+    itertools.product(
+        [0, 1, 5, 17],  # step
+        [16, 24, 37, 64],  # video_length
+        [8, 16],  # batch_size
+        [1, 3],  # stride
+        [0, 4],  # overlap
+        ["N", "R-P", "R+P", "A"],  # loop_setting
+    )
+)
+
+
+def fake_model(x, window_length):
+    """A model whose output of a frame depends on the other frames of its window, so the order of the windows matters."""
+    windows = x.reshape(-1, window_length, *x.shape[1:])
+    return (windows * 2 + windows.mean(dim=1, keepdim=True)).reshape(x.shape)
+
+
+def per_window_forward(x_in, video_length, batch_size, windows, batch_cond_uncond):
+    x_out = torch.zeros_like(x_in)
+    for context in windows:
+        _context = context + [c + video_length for c in context] if batch_cond_uncond else context
+        # cond and uncond are separate windows of the model
+        x_out[_context] = fake_model(x_in[_context], batch_size)
+    return x_out
+
+
+def grouped_forward(x_in, setting, group_size, batch_cond_uncond):
+    step, video_length, batch_size, stride, overlap, loop_setting = setting
+    x_out = torch.zeros_like(x_in)
+    for _context, _keep in AnimateDiffInfV2V.context_groups(
+        step, video_length, batch_size, stride, overlap, loop_setting, group_size, batch_cond_uncond
+    ):
+        out = fake_model(x_in[_context], batch_size)
+        x_out[_context[_keep]] = out[_keep]
+    return x_out
+
+
+@pytest.mark.parametrize("setting", SETTINGS)
+def test_context_schedule_matches_uniform(setting):
+    windows = list(AnimateDiffInfV2V.uniform(*setting))
+    assert AnimateDiffInfV2V.context_schedule(*setting).tolist() == windows
+
+
+@pytest.mark.parametrize("batch_cond_uncond", [False, True])
+@pytest.mark.parametrize("group_size", [1, 2, 3, 100])
+@pytest.mark.parametrize("setting", [setting for setting in SETTINGS if setting[1] > setting[2]])
+def test_grouped_windows_match_per_window(setting, group_size, batch_cond_uncond):
+    _, video_length, batch_size, _, _, _ = setting
+    generator = torch.Generator().manual_seed(SETTINGS.index(setting))
+    x_in = torch.randn([video_length * (2 if batch_cond_uncond else 1), 4, 2, 2], generator=generator, dtype=torch.float64)
+
+    expected = per_window_forward(x_in, video_length, batch_size, list(AnimateDiffInfV2V.uniform(*setting)), batch_cond_uncond)
+    assert torch.equal(grouped_forward(x_in, setting, group_size, batch_cond_uncond), expected)
@@ -0,0 +1,102 @@
+"""
+The training scheduler with fake GPUs and a dummy trainer: the concurrent jobs wait for a GPU slot, each running job has
+its own GPU, port, log and progress file, and the slots are released after a failure.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from scripts.train_kohya.train_scheduler import TrainingScheduler, get_training_scheduler, parse_gpus  # noqa: E402
+
+# Records its GPU, its port and when it ran, like a training would hold the GPU for a while.
+DUMMY_TRAINER = """
+import json, os, sys, time
+start = time.time()
+time.sleep(0.5)
+port = [arg for arg in sys.argv if arg.startswith("--main_process_port=")][0].split("=")[1]
+with open(sys.argv[-1], "w") as f:
+    json.dump({"gpu": os.environ["CUDA_VISIBLE_DEVICES"], "port": int(port), "start": start, "end": time.time()}, f)
+print("dummy training done")
+"""
+
+
+def run_jobs(scheduler, tmp_path, num_jobs):
+    errors = []
+
+    def run(job_name):
+        command = [sys.executable, "-c", DUMMY_TRAINER, "--main_process_port=3456", str(tmp_path / f"{job_name}.json")]
+        try:
+            scheduler.run(command, job_name)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(f"user{index}",)) for index in range(num_jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    runs = {}
+    for index in range(num_jobs):
+        with open(tmp_path / f"user{index}.json") as f:
+            runs[f"user{index}"] = json.load(f)
+    return runs
+
+
+def test_concurrent_jobs_share_the_gpu_slots(tmp_path):
+    scheduler = TrainingScheduler(["0", "1", "2"], str(tmp_path / "logs"))
+    runs = run_jobs(scheduler, tmp_path, 7)
+
+    assert {run["gpu"] for run in runs.values()} <= {"0", "1", "2"}
+    for name, run in runs.items():
+        overlapping = [
+            other
+            for other_name, other in runs.items()
+            if other_name != name and other["start"] < run["end"] and run["start"] < other["end"]
+        ]
+        # at most one job per GPU, so at most 3 jobs at a time, and no port is shared by running jobs
+        assert len(overlapping) <= 2
+        assert run["gpu"] not in [other["gpu"] for other in overlapping]
+        assert run["port"] not in [other["port"] for other in overlapping]
+
+        with open(scheduler.job_log_path(name)) as f:
+            log = f.read()
+        assert f"Run on GPU {run['gpu']} with port {run['port']}" in log
+        assert "dummy training done" in log
+
+    assert sorted(scheduler.free_gpus) == ["0", "1", "2"]
+    assert scheduler.used_ports == set()
+
+
+def test_failed_job_releases_its_slot(tmp_path):
+    scheduler = TrainingScheduler(["0"], str(tmp_path / "logs"))
+    with pytest.raises(subprocess.CalledProcessError):
+        scheduler.run([sys.executable, "-c", "import sys; sys.exit(1)", "--main_process_port=3456"], "failed")
+    assert list(scheduler.free_gpus) == ["0"]
+    assert scheduler.used_ports == set()
+
+    # the next job gets the GPU
+    runs = run_jobs(scheduler, tmp_path, 1)
+    assert runs["user0"]["gpu"] == "0"
+
+
+def test_each_user_has_its_own_progress_file(tmp_path):
+    scheduler = TrainingScheduler(["0", "1"], str(tmp_path))
+    assert scheduler.job_progress_path("alice") != scheduler.job_progress_path("bob")
+    assert os.path.dirname(scheduler.job_progress_path("alice")) == str(tmp_path)
+
+
+def test_get_training_scheduler(tmp_path):
+    assert parse_gpus(" 0, 1,,2 ") == ["0", "1", "2"]
+    assert get_training_scheduler("", str(tmp_path)) is None
+
+    scheduler = get_training_scheduler("0,1", str(tmp_path))
+    assert scheduler.gpus == ["0", "1"]
+    assert get_training_scheduler("0, 1", str(tmp_path)) is scheduler
+    assert get_training_scheduler("0,1,2", str(tmp_path)) is not scheduler
+    get_training_scheduler("", str(tmp_path))
@@ -0,0 +1,120 @@
+"""
+The composed warp of align_and_overlay_images against the resize -> rotate -> paste chain it replaces: img1 is sampled
+once instead of twice, so the results are compared within the tolerance stated in its docstring, away from the edges.
+
+tryon_utils is loaded with its sibling geometry_utils only, the package __init__ imports the webui.
+"""
+import importlib
+import os
+import sys
+import types
+
+import cv2
+import numpy as np
+import pytest
+
+EASYPHOTO_UTILS_PATH = os.path.join(os.path.dirname(__file__), "..", "scripts", "easyphoto_utils")
+
+
+def load_tryon_utils():
+    package = types.ModuleType("tryon_geometry_test_package")
+    package.__path__ = [EASYPHOTO_UTILS_PATH]
+    sys.modules[package.__name__] = package
+    return importlib.import_module(f"{package.__name__}.tryon_utils")
+
+
+tryon_utils = load_tryon_utils()
+
+
+def make_cloth(size, rng):
+    """A cloth mask of size (width, height) and its image, a dominant color with a print of 8 px blocks on white."""
+    width, height = size
+    mask = np.zeros((height, width), np.uint8)
+    points = np.array([[0.35, 0.05], [0.65, 0.05], [0.95, 0.3], [0.8, 0.4], [0.75, 0.95], [0.25, 0.95], [0.2, 0.4], [0.05, 0.3]])
+    cv2.fillPoly(mask, [np.round(points * [width, height]).astype(np.int32)], 255)
+
+    blocks = cv2.resize(
+        rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8), None, fx=8, fy=8, interpolation=cv2.INTER_NEAREST
+    )
+    image = np.full((height, width, 3), 255, np.uint8)
+    image[mask > 0] = (120, 60, 200)
+    printed = (mask > 0) & (blocks[:height, :width, 0] < 80)
+    image[printed] = blocks[:height, :width][printed]
+    return image, mask
+
+
+def reference_align(img1, img2, mask1, mask2, angle, ratio, dx, dy):
+    """resize_and_stretch to the size of img2, rotate in the bound of the rotated image, pad by (dx, dy), paste centered."""
+    size = (img2.shape[1], img2.shape[0])
+    img1 = tryon_utils.resize_and_stretch(img1, size, white_back=True)
+    mask1 = tryon_utils.resize_and_stretch(mask1, size)[:, :, 0]
+
+    def rotate(array):
+        height, width = array.shape[:2]
+        rotation_mat = cv2.getRotationMatrix2D((width / 2, height / 2), angle, ratio)
+        sin, cos = abs(np.sin(np.radians(angle))), abs(np.cos(np.radians(angle)))
+        bound_w, bound_h = int(height * sin + width * cos), int(height * cos + width * sin)
+        rotation_mat[0, 2] += (bound_w - width) / 2
+        rotation_mat[1, 2] += (bound_h - height) / 2
+        array = cv2.warpAffine(array, rotation_mat, (bound_w, bound_h))
+        return cv2.copyMakeBorder(array, max(0, int(dy)), max(0, -int(dy)), max(0, int(dx)), max(0, -int(dx)), cv2.BORDER_CONSTANT, value=0)
+
+    img1, mask1 = rotate(img1), rotate(mask1)
+    h_max, w_max = max(img1.shape[0], img2.shape[0]), max(img1.shape[1], img2.shape[1])
+
+    def paste(array):
+        canvas = np.zeros((h_max, w_max) + array.shape[2:], np.uint8)
+        x, y = (w_max - array.shape[1]) // 2, (h_max - array.shape[0]) // 2
+        canvas[y : y + array.shape[0], x : x + array.shape[1]] = array
+        return canvas
+
+    img1, img2, mask1, mask2 = paste(img1), paste(img2), paste(mask1), paste(mask2)
+    iou = np.count_nonzero((mask1 > 0) & (mask2 > 0)) / np.count_nonzero((mask1 > 0) | (mask2 > 0))
+    merge_mask = (mask1 > 128) & (mask2 > 128)
+    result = img2.copy()
+    result[merge_mask] = img1[merge_mask]
+    return result, img1, mask1, mask2, iou
+
+
+def near_edges(image, *masks, radius=2):
+    """The pixels within radius of an edge of image or of the masks."""
+    kernel = np.ones((3, 3), np.uint8)
+    edges = cv2.morphologyEx(image, cv2.MORPH_GRADIENT, kernel).max(axis=-1) > 8
+    for mask in masks:
+        edges |= cv2.morphologyEx(mask, cv2.MORPH_GRADIENT, kernel) > 0
+    return cv2.dilate(np.uint8(edges), np.ones((2 * radius + 1, 2 * radius + 1), np.uint8)) > 0
+
+
+def max_difference(a, b, where):
+    diff = np.abs(a.astype(np.int32) - b.astype(np.int32))
+    diff = diff.max(axis=-1) if diff.ndim == 3 else diff
+    return int(diff[where].max()) if np.any(where) else 0
+
+
+@pytest.mark.parametrize(
+    "angle, ratio, dx, dy",
+    [(0.0, 1.0, 0.0, 0.0), (-5.0, 1.1, 30.0, -20.0), (12.0, 0.9, -15.0, 40.0), (30.0, 1.0, 0.0, 0.0), (-3.0, 1.25, 7.0, 3.0)],
+)
+@pytest.mark.parametrize("ref_size, template_size", [((700, 900), (600, 760)), ((500, 420), (640, 700))])
+def test_align_and_overlay_images_matches_the_resize_rotate_chain(angle, ratio, dx, dy, ref_size, template_size):
+    rng = np.random.default_rng(0)
+    img1, mask1 = make_cloth(ref_size, rng)
+    img2, mask2 = make_cloth(template_size, rng)
+    # the template cloth is a bit smaller and off-center, as a worn cloth
+    mask2 = cv2.warpAffine(mask2, np.float64([[0.9, 0, 20], [0, 0.92, 15]]), template_size)
+
+    expected = reference_align(img1, img2, np.stack([mask1] * 3, axis=-1), mask2, angle, ratio, dx, dy)
+    result = tryon_utils.align_and_overlay_images(img1, img2, np.stack([mask1] * 3, axis=-1), mask2, angle, ratio, dx, dy)
+
+    for expected_array, array in zip(expected[:4], result[:4]):
+        assert array.shape == expected_array.shape and array.dtype == np.uint8
+    assert np.array_equal(result[3], expected[3])
+    assert abs(result[4] - expected[4]) <= 0.005
+
+    # Sampled once or twice, the images only differ on the edges; the white letterbox and the black outside of the
+    # rotated canvas are where the chain puts them
+    flat = ~near_edges(expected[1], expected[2])
+    assert max_difference(result[1], expected[1], flat) <= 8
+    assert max_difference(result[2], expected[2], flat) <= 8
+    flat &= ~near_edges(expected[0], expected[3])
+    assert max_difference(result[0], expected[0], flat) <= 8